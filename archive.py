@@ -0,0 +1,203 @@
+import os
+import shutil
+import tarfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from protocol import Protocol
+
+class StreamPipe:
+    # Tampon borné entre un thread qui écrit et un thread qui lit: l'écrivain
+    # attend quand le tampon est plein, le lecteur quand il est vide. Sert de
+    # fichier à tarfile des deux côtés (modes 'w|' et 'r|').
+    def __init__(self, limit=4 * 1024 * 1024):
+        self.limit = limit
+        self.buffer = bytearray()
+        self.cond = threading.Condition()
+        # Fin du flux côté écrivain
+        self.closed = False
+        # Abandon par l'un des deux côtés
+        self.error: Optional[Exception] = None
+    
+    def write(self, data) -> int:
+        with self.cond:
+            while len(self.buffer) >= self.limit and self.error is None:
+                self.cond.wait()
+            if self.error is not None:
+                raise OSError(str(self.error))
+            self.buffer += data
+            self.cond.notify_all()
+        return len(data)
+    
+    def read(self, size=-1) -> bytes:
+        # Renvoie size octets, moins seulement à la fin du flux
+        with self.cond:
+            while (self.error is None and not self.closed
+                   and (size < 0 or len(self.buffer) < size)):
+                self.cond.wait()
+            if self.error is not None:
+                raise OSError(str(self.error))
+            if size < 0:
+                size = len(self.buffer)
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            self.cond.notify_all()
+        return data
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+    
+    def abort(self, error: Exception):
+        with self.cond:
+            if self.error is None:
+                self.error = error
+            self.buffer.clear()
+            self.cond.notify_all()
+
+class DirectoryArchive:
+    # Archive tar d'un dossier produite au fil de l'envoi, sans fichier
+    # temporaire: un thread écrit l'archive dans un StreamPipe et read() en
+    # retire un bloc à la fois. Avec compression, les blocs sont compressés
+    # à l'avance sur un pool de threads (zlib et zstd relâchent le GIL).
+    # Chaque bloc commence par RAW (données telles quelles) ou est une trame
+    # de Protocol.compress.
+    RAW = b"\x00"
+    
+    def __init__(self, root: str, compression: Optional[str] = None, workers: Optional[int] = None):
+        self.root = root
+        self.name = os.path.basename(os.path.normpath(root))
+        self.compression = compression
+        self.pipe = StreamPipe()
+        # Octets de l'archive non compressée déjà rendus par read()
+        self.raw_bytes = 0
+        self.pool = None
+        self.pending = deque()
+        if compression:
+            workers = workers or os.cpu_count() or 1
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+            # Blocs compressés d'avance
+            self.depth = workers * 2
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+    
+    def produce(self):
+        try:
+            with tarfile.open(fileobj=self.pipe, mode='w|') as tar:
+                tar.add(self.root, arcname=self.name)
+        except Exception as e:
+            self.pipe.abort(e)
+            return
+        self.pipe.close()
+    
+    def read(self, size: int) -> bytes:
+        # Prochain bloc pour size octets d'archive; vide à la fin
+        if self.pool is None:
+            data = self.pipe.read(size)
+            self.raw_bytes += len(data)
+            return self.RAW + data if data else b""
+        
+        while len(self.pending) < self.depth:
+            data = self.pipe.read(size)
+            if not data:
+                break
+            self.pending.append((len(data), self.pool.submit(compress_block, data, self.compression)))
+        if not self.pending:
+            return b""
+        count, future = self.pending.popleft()
+        self.raw_bytes += count
+        return future.result()
+    
+    def close(self):
+        # Arrête aussi le thread d'archivage s'il attend de la place
+        self.pipe.abort(OSError("Envoi annulé"))
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+class ArchiveExtractor:
+    # Extraction d'une DirectoryArchive au fil de la réception: write()
+    # reçoit les blocs dans l'ordre, un thread les extrait sous parent/name.
+    # Mémoire et disque supplémentaires bornés par le StreamPipe, quelle que
+    # soit la taille de l'arborescence. Seuls les dossiers et fichiers
+    # ordinaires situés sous name sont créés.
+    def __init__(self, parent: str, name: str):
+        self.parent = parent
+        self.name = name
+        self.pipe = StreamPipe()
+        self.thread = threading.Thread(target=self.extract, daemon=True)
+        self.thread.start()
+    
+    @property
+    def path(self) -> str:
+        return os.path.join(self.parent, self.name)
+    
+    def write(self, block: bytes) -> int:
+        # Renvoie le nombre d'octets d'archive décompressés
+        if block[:1] == DirectoryArchive.RAW:
+            data = block[1:]
+        elif block[:1] == bytes((Protocol.FRAME_COMPRESSED,)):
+            data = Protocol.decompress(block)
+        else:
+            raise ValueError("Bloc d'archive invalide")
+        return self.pipe.write(data)
+    
+    def extract(self):
+        try:
+            with tarfile.open(fileobj=self.pipe, mode='r|') as tar:
+                for member in tar:
+                    path = self.member_path(member)
+                    if member.isdir():
+                        os.makedirs(path, exist_ok=True)
+                    elif member.isfile():
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        with open(path, 'wb') as f:
+                            shutil.copyfileobj(tar.extractfile(member), f, 1024 * 1024)
+            # Remplissage de fin d'archive
+            while self.pipe.read(65536):
+                pass
+        except Exception as e:
+            self.pipe.abort(e)
+    
+    def member_path(self, member: tarfile.TarInfo) -> str:
+        name = os.path.normpath(member.name)
+        parts = name.split(os.sep)
+        if os.path.isabs(name) or ".." in parts or parts[0] != self.name:
+            raise ValueError(f"Chemin refusé dans l'archive: {member.name}")
+        return os.path.join(self.parent, name)
+    
+    def close(self):
+        # Fin de la réception: attend la fin de l'extraction
+        self.pipe.close()
+        self.thread.join()
+        if self.pipe.error is not None:
+            raise OSError(f"Extraction de {self.name} impossible: {self.pipe.error}")
+    
+    def abort(self):
+        self.pipe.abort(OSError("Réception annulée"))
+        self.thread.join()
+
+def compress_block(data: bytes, algorithm: str) -> bytes:
+    compressed = Protocol.compress(data, algorithm)
+    # Fichiers déjà compressés (images, archives): envoyés tels quels
+    if len(compressed) > len(data):
+        return DirectoryArchive.RAW + data
+    return compressed
+
+def archive_size(root: str) -> int:
+    # Taille approximative de l'archive non compressée (en-têtes de 512
+    # octets, données complétées à 512), pour la barre de progression
+    total = 1024
+    for dirpath, dirnames, filenames in os.walk(root):
+        total += 512
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            total += 512
+            if not os.path.islink(path):
+                try:
+                    total += (os.path.getsize(path) + 511) // 512 * 512
+                except OSError:
+                    pass
+    return total
\ No newline at end of file
@@ -0,0 +1,222 @@
+import asyncio
+import threading
+from typing import Optional, Set
+
+from protocol import Protocol, MessageType, FrameDecoder
+from server import Server
+from outbound import OutboundQueue, SlowConsumerPolicy, FileRegion
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class StreamSocket(OutboundQueue):
+    # File d'envoi d'une connexion asyncio: les handlers (exécutés dans des
+    # threads) y déposent leurs trames, une tâche de la boucle les écrit en
+    # respectant drain(), donc sans tampon illimité pour un client lent.
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop,
+                 max_size=1024, policy=SlowConsumerPolicy.DROP, name=""):
+        super().__init__(max_size, policy, name)
+        self.writer = writer
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.task = loop.create_task(self.drain_queue())
+    
+    def push(self, data):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, data)
+        except RuntimeError:
+            # Boucle déjà arrêtée
+            pass
+    
+    async def drain_queue(self):
+        data = None
+        try:
+            while True:
+                data = await self.queue.get()
+                if data is None:
+                    break
+                requeue = False
+                try:
+                    if isinstance(data, FileRegion):
+                        requeue = await self.send_region(data)
+                    else:
+                        self.writer.write(data)
+                        await self.writer.drain()
+                except (ConnectionError, OSError):
+                    break
+                finally:
+                    if requeue:
+                        self.queue.put_nowait(data)
+                    else:
+                        self.sent()
+        finally:
+            # Connexion perdue, fermée ou tâche annulée à l'arrêt: les plages
+            # en cours ou encore en file ne partiront plus
+            if isinstance(data, FileRegion):
+                data.close()
+            while not self.queue.empty():
+                data = self.queue.get_nowait()
+                if isinstance(data, FileRegion):
+                    data.close()
+            self.writer.close()
+    
+    async def send_region(self, region: FileRegion) -> bool:
+        # Comme FileRegion.send_next, avec le sendfile de la boucle
+        try:
+            if not region.done:
+                header, offset, count = region.next_chunk()
+                self.writer.write(header)
+                await self.writer.drain()
+                sent = await self.loop.sendfile(self.writer.transport, region.file, offset, count)
+                if sent != count:
+                    raise OSError(f"Fichier tronqué pendant l'envoi de {region.file_id}")
+            if not region.done:
+                return True
+            self.writer.write(region.trailer)
+            await self.writer.drain()
+        finally:
+            if region.done:
+                region.close()
+        return False
+    
+    def abort(self):
+        with self.lock:
+            self.closed = True
+        try:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+        except RuntimeError:
+            pass
+        self.push(None)
+
+class AsyncServer(Server):
+    # Même protocole et mêmes handlers que Server, mais toutes les connexions
+    # sont servies par une seule boucle asyncio au lieu d'un thread chacune.
+    def __init__(self, host='0.0.0.0', port=8888, backlog=1024, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.backlog = backlog
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stopped: Optional[asyncio.Event] = None
+        # Tâches des connexions en cours, annulées à l'arrêt
+        self.connection_tasks: Set[asyncio.Task] = set()
+    
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            print(f"Erreur lors du démarrage du serveur: {e}")
+        finally:
+            self.stop()
+    
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        raise_file_limit()
+        
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(self.backlog)
+        self.server_socket.setblocking(False)
+        
+        server = await asyncio.start_server(
+            self.handle_connection,
+            sock=self.server_socket,
+            backlog=self.backlog
+        )
+        print(f"Serveur asyncio démarré sur {self.host}:{self.port}")
+        
+        self.dispatcher.start()
+        threading.Thread(target=self.ping_clients, daemon=True).start()
+        threading.Thread(target=self.reap_transfers, daemon=True).start()
+        threading.Thread(target=self.clean_storage, daemon=True).start()
+        
+        async with server:
+            await self.stopped.wait()
+        
+        # Les connexions encore ouvertes se terminent avant la boucle
+        for task in self.connection_tasks:
+            task.cancel()
+        await asyncio.gather(*self.connection_tasks, return_exceptions=True)
+    
+    def stop(self):
+        self.running = False
+        self.janitor.stop()
+        self.dispatcher.stop()
+        for username in list(self.clients.keys()):
+            self.disconnect_client(username)
+        
+        self.db.flush()
+        
+        # La boucle ferme elle-même le socket d'écoute en sortant de serve()
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        print("Serveur arrêté")
+    
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = writer.get_extra_info("peername")
+        client_socket = StreamSocket(
+            writer,
+            self.loop,
+            self.send_queue_size,
+            self.slow_consumer_policy,
+            name=str(address)
+        )
+        username = None
+        task = asyncio.current_task()
+        self.connection_tasks.add(task)
+        
+        try:
+            messages = FrameDecoder(self.max_frame_size).messages_async(reader)
+            message = await anext(messages, None)
+            if not message or message.type != MessageType.LOGIN:
+                client_socket.close()
+                return
+            
+            # register_client touche la base: on le sort de la boucle
+            username = await self.loop.run_in_executor(
+                None, self.register_client, client_socket, address, message
+            )
+            if not username:
+                return
+            
+            async for message in messages:
+                if not self.running:
+                    break
+                self.dispatcher.submit(username, message)
+        
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            # Annulée par serve() à l'arrêt: la tâche se termine normalement,
+            # sinon asyncio signale l'annulation comme une erreur du client
+            pass
+        except Exception as e:
+            print(f"Erreur avec le client {address}: {e}")
+        finally:
+            self.connection_tasks.discard(task)
+            if not username:
+                client_socket.close()
+            elif self.running:
+                # À l'arrêt, stop() a déjà déconnecté tout le monde
+                await self.loop.run_in_executor(None, self.disconnect_client, username)
+
+def raise_file_limit():
+    # Chaque connexion consomme un descripteur: on monte la limite souple au
+    # maximum autorisé pour tenir plusieurs milliers de clients.
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = 65536 if hard == resource.RLIM_INFINITY else hard
+        if soft != resource.RLIM_INFINITY and soft < target:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ValueError, OSError) as e:
+        print(f"Impossible d'augmenter la limite de descripteurs: {e}")
+
+if __name__ == "__main__":
+    server = AsyncServer()
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        print("\nArrêt du serveur...")
+        server.stop()
@@ -0,0 +1,550 @@
+import argparse
+import contextlib
+import io
+import os
+import queue
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from models import User, Message as ChatMessage
+from database import Database
+from protocol import Protocol, Message, MessageType, JsonCodec, CompactCodec, FileTransfer, FrameDecoder
+from transfer_engine import TransferEngine, Upload, FlowControl
+from async_server import AsyncServer
+from server import Server
+from outbound import OutboundQueue
+
+def save_message_per_connection(db_path: str, message: ChatMessage):
+    # Ancien comportement de Database.save_message: une connexion et un commit
+    # en journal rollback par message
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO messages
+        (message_id, sender, recipient, content, message_type, timestamp, delivered, read, file_path)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        message.message_id,
+        message.sender,
+        message.recipient,
+        message.content,
+        message.message_type,
+        message.timestamp.isoformat(),
+        message.delivered,
+        message.read,
+        message.file_path
+    ))
+    conn.commit()
+    conn.close()
+
+def bench_database(count: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        Database(legacy_path).close()
+        conn = sqlite3.connect(legacy_path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+        
+        started = time.perf_counter()
+        for i in range(count):
+            save_message_per_connection(
+                legacy_path,
+                ChatMessage(sender="alice", recipient="bob", content=f"message {i}", message_type="text")
+            )
+        legacy = count / (time.perf_counter() - started)
+        
+        db = Database(os.path.join(tmp, "pooled.db"))
+        started = time.perf_counter()
+        for i in range(count):
+            db.save_message(
+                ChatMessage(sender="alice", recipient="bob", content=f"message {i}", message_type="text")
+            )
+        pooled = count / (time.perf_counter() - started)
+        db.close()
+        
+        db = Database(os.path.join(tmp, "write_behind.db"), write_behind=True)
+        started = time.perf_counter()
+        for i in range(count):
+            db.save_message(
+                ChatMessage(sender="alice", recipient="bob", content=f"message {i}", message_type="text")
+            )
+        db.flush()
+        write_behind = count / (time.perf_counter() - started)
+        db.close()
+    
+    print(f"save_message, connexion par appel : {legacy:10.0f} messages/s")
+    print(f"save_message, connexion WAL       : {pooled:10.0f} messages/s  (x{pooled / legacy:.1f})")
+    print(f"save_message, write-behind        : {write_behind:10.0f} messages/s  (x{write_behind / legacy:.1f})")
+
+def login(port: int, username: str, features=()) -> socket.socket:
+    client = socket.create_connection(("127.0.0.1", port))
+    client.sendall(Protocol.pack_message(Message(
+        type=MessageType.LOGIN,
+        sender=username,
+        content={"username": username, "features": list(features)}
+    )))
+    Protocol.unpack_message(client)
+    return client
+
+def wait_for(client: socket.socket, message_type: MessageType) -> Message:
+    while True:
+        message = Protocol.unpack_message(client)
+        if message is None or message.type == message_type:
+            return message
+
+def send_file(sender: socket.socket, receiver: socket.socket, file_id: str,
+              data: bytes, binary: bool) -> float:
+    chunk_size = 65536 if binary else 8192
+    total_chunks = (len(data) + chunk_size - 1) // chunk_size
+    sender.sendall(Protocol.pack_message(Message(
+        type=MessageType.FILE_TRANSFER_REQUEST,
+        sender="alice",
+        recipient="bob",
+        content={"file_id": file_id, "filename": "bench.bin", "filesize": len(data)}
+    )))
+    wait_for(receiver, MessageType.FILE_TRANSFER_REQUEST)
+    
+    started = time.perf_counter()
+    for number in range(total_chunks):
+        chunk = data[number * chunk_size:(number + 1) * chunk_size]
+        if binary:
+            sender.sendall(Protocol.pack_file_chunk(file_id, number, total_chunks, chunk))
+        else:
+            sender.sendall(Protocol.pack_message(Message(
+                type=MessageType.FILE_CHUNK,
+                sender="alice",
+                recipient="bob",
+                content={
+                    "file_id": file_id,
+                    "chunk_number": number,
+                    "data": chunk.hex(),
+                    "total_chunks": total_chunks
+                }
+            )))
+    wait_for(receiver, MessageType.FILE_TRANSFER_COMPLETE)
+    return len(data) / (time.perf_counter() - started) / 1e6
+
+def run_file_transfers(tmp: str, data: bytes):
+    server = AsyncServer(host="127.0.0.1", port=0, database=Database(os.path.join(tmp, "bench.db")))
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    while not server.server_socket.getsockname()[1]:
+        time.sleep(0.01)
+    port = server.server_socket.getsockname()[1]
+    time.sleep(0.2)
+    
+    # Sans relais: on mesure l'encodage des morceaux, pas les accusés de réception
+    features = [f for f in Protocol.FEATURES if f != Protocol.FEATURE_FILE_RELAY]
+    alice = login(port, "alice", features)
+    bob = login(port, "bob", features)
+    hex_rate = send_file(alice, bob, "hex", data, binary=False)
+    binary_rate = send_file(alice, bob, "binary", data, binary=True)
+    
+    alice.close()
+    bob.close()
+    server.stop()
+    thread.join(5)
+    return hex_rate, binary_rate
+
+def bench_file_transfer(count: int):
+    # count morceaux de 8 Kio, envoyés en hex/JSON puis en trames binaires
+    data = os.urandom(count * 8192)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Le serveur écrit dans storage/ du répertoire courant
+        os.chdir(tmp)
+        try:
+            # Les journaux du serveur fausseraient la mesure
+            with contextlib.redirect_stdout(io.StringIO()):
+                hex_rate, binary_rate = run_file_transfers(tmp, data)
+        finally:
+            os.chdir(cwd)
+    
+    print(f"fichier de {len(data) / 1e6:.1f} Mo")
+    print(f"FILE_CHUNK hex/JSON    : {hex_rate:8.1f} Mo/s")
+    print(f"FILE_CHUNK binaire     : {binary_rate:8.1f} Mo/s  (x{binary_rate / hex_rate:.1f})")
+
+class ThrottledLink:
+    # Proxy TCP local qui simule un lien: débit limité (octets/s, None: sans
+    # limite) et latence ajoutée dans chaque sens
+    def __init__(self, target_port: int, bandwidth: Optional[float], latency: float):
+        self.target_port = target_port
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.sockets = []
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+    
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            server = socket.create_connection(("127.0.0.1", self.target_port))
+            self.sockets += [client, server]
+            for source, destination in ((client, server), (server, client)):
+                frames = queue.Queue()
+                threading.Thread(target=self.read, args=(source, frames), daemon=True).start()
+                threading.Thread(target=self.write, args=(destination, frames), daemon=True).start()
+    
+    def read(self, source: socket.socket, frames: queue.Queue):
+        free_at = 0.0
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                frames.put(None)
+                return
+            departure = time.perf_counter()
+            if self.bandwidth:
+                departure = max(departure, free_at) + len(data) / self.bandwidth
+                free_at = departure
+            frames.put((departure + self.latency, data))
+    
+    def write(self, destination: socket.socket, frames: queue.Queue):
+        while True:
+            item = frames.get()
+            try:
+                if item is None:
+                    destination.shutdown(socket.SHUT_WR)
+                    return
+                due, data = item
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                destination.sendall(data)
+            except OSError:
+                return
+    
+    def close(self):
+        self.listener.close()
+        for sock in self.sockets:
+            sock.close()
+
+def engine_transfer(port: int, link: ThrottledLink, file_id: str, path: str, size: int,
+                    flow: Optional[FlowControl]):
+    # alice envoie par le lien simulé avec le moteur du client, bob reçoit en
+    # direct et acquitte; des messages de discussion partent pendant l'envoi
+    alice = login(link.port, "alice", Protocol.FEATURES)
+    bob = login(port, "bob", Protocol.FEATURES)
+    engine = TransferEngine(alice)
+    done = threading.Event()
+    latencies = []
+    
+    def sender():
+        try:
+            for message in FrameDecoder().messages(alice):
+                if message.type == MessageType.FILE_TRANSFER_RESUME:
+                    transfer = FileTransfer(file_id, "alice", "bob", "bench.bin", size, path)
+                    engine.add_upload(Upload(
+                        transfer, message.content["missing"], 8192, True, 16, Protocol.FEATURES, flow
+                    ))
+                elif message.type == MessageType.FILE_CHUNK_ACK:
+                    engine.ack(message.content["file_id"], message.content["chunk_number"])
+        except OSError:
+            # Connexion coupée à la fin de la mesure
+            pass
+    
+    def recipient():
+        try:
+            for message in FrameDecoder().messages(bob):
+                if message.type == MessageType.FILE_TRANSFER_REQUEST:
+                    bob.sendall(Protocol.pack_message(Message(
+                        type=MessageType.FILE_TRANSFER_ACCEPT,
+                        sender="bob",
+                        recipient="alice",
+                        content={"file_id": file_id}
+                    ), Protocol.FEATURES))
+                elif message.type == MessageType.FILE_CHUNK:
+                    bob.sendall(Protocol.pack_message(Message(
+                        type=MessageType.FILE_CHUNK_ACK,
+                        sender="bob",
+                        recipient="alice",
+                        content={"file_id": file_id, "chunk_number": message.content["chunk_number"]}
+                    ), Protocol.FEATURES))
+                elif message.type == MessageType.PRIVATE_MESSAGE:
+                    latencies.append(time.perf_counter() - float(message.content))
+                elif message.type == MessageType.FILE_TRANSFER_COMPLETE:
+                    done.set()
+                    return
+        except OSError:
+            pass
+    
+    threads = [threading.Thread(target=sender), threading.Thread(target=recipient)]
+    for thread in threads:
+        thread.start()
+    
+    started = time.perf_counter()
+    engine.send(Protocol.pack_message(Message(
+        type=MessageType.FILE_TRANSFER_REQUEST,
+        sender="alice",
+        recipient="bob",
+        content={"file_id": file_id, "filename": "bench.bin", "filesize": size}
+    ), Protocol.FEATURES))
+    while not done.wait(0.05):
+        engine.send(Protocol.pack_message(Message(
+            type=MessageType.PRIVATE_MESSAGE,
+            sender="alice",
+            recipient="bob",
+            content=repr(time.perf_counter())
+        ), Protocol.FEATURES))
+    rate = size / (time.perf_counter() - started) / 1e6
+    
+    engine.stop()
+    for client, thread in zip((alice, bob), threads):
+        client.shutdown(socket.SHUT_RDWR)
+        thread.join()
+        client.close()
+    latency = sum(latencies) / len(latencies) if latencies else 0.0
+    return rate, latency
+
+def bench_adaptive_chunks(count: int):
+    # count × 8 Kio à travers un lien simulé: morceaux fixes de 8 Kio et
+    # fenêtre de 16 contre taille et fenêtre ajustées (FlowControl). La
+    # latence est celle des messages de discussion envoyés pendant le transfert.
+    links = [
+        ("boucle locale", None, 0.0),
+        ("1 Gbit/s, 0,5 ms", 125e6, 0.0005),
+        ("Wi-Fi 50 Mbit/s, 20 ms", 6.25e6, 0.020)
+    ]
+    data = os.urandom(count * 8192)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        path = os.path.join(tmp, "bench.bin")
+        with open(path, "wb") as f:
+            f.write(data)
+        results = []
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                server = AsyncServer(host="127.0.0.1", port=0, database=Database(os.path.join(tmp, "bench.db")))
+                thread = threading.Thread(target=server.start, daemon=True)
+                thread.start()
+                while not server.server_socket.getsockname()[1]:
+                    time.sleep(0.01)
+                port = server.server_socket.getsockname()[1]
+                time.sleep(0.2)
+                
+                for number, (name, bandwidth, latency) in enumerate(links):
+                    link = ThrottledLink(port, bandwidth, latency)
+                    rates = []
+                    for label, flow in (("fixed", None), ("adaptive", FlowControl())):
+                        rates.append(engine_transfer(port, link, f"{label}{number}", path, len(data), flow))
+                        # alice doit être déconnectée avant de se reconnecter
+                        while server.clients:
+                            time.sleep(0.01)
+                    link.close()
+                    results.append((name, *rates))
+                
+                server.stop()
+                thread.join(5)
+        finally:
+            os.chdir(cwd)
+    
+    print(f"fichier de {len(data) / 1e6:.1f} Mo, débit (latence moyenne d'un message pendant l'envoi)")
+    for name, (fixed_rate, fixed_latency), (rate, latency) in results:
+        print(f"{name:24} fixe 8 Kio: {fixed_rate:7.1f} Mo/s ({fixed_latency * 1e3:6.1f} ms)   "
+              f"adaptatif: {rate:7.1f} Mo/s ({latency * 1e3:6.1f} ms)  (x{rate / fixed_rate:.1f})")
+
+def sample_messages() -> list:
+    # Un message représentatif par type, tel que le serveur ou le client l'envoie
+    now = datetime.now().isoformat()
+    message_id = str(uuid.uuid4())
+    user = {"username": "alice", "status": "online", "last_seen": now}
+    stored = {
+        "message_id": message_id, "sender": "alice", "recipient": "bob",
+        "content": "Salut, on se retrouve à midi ?", "message_type": "text",
+        "timestamp": now, "delivered": True, "read": False, "file_path": None
+    }
+    group = {
+        "group_id": str(uuid.uuid4()), "name": "Équipe", "created_by": "alice",
+        "members": ["alice", "bob", "carol", "dave"], "created_at": now
+    }
+    file_info = {"file_id": uuid.uuid4().hex, "filename": "rapport.pdf", "filesize": 1048576}
+    contents = {
+        MessageType.LOGIN: {"username": "alice", "features": list(Protocol.FEATURES)},
+        MessageType.LOGIN_RESPONSE: {"success": True, "username": "alice", "users": [user] * 20, "features": list(Protocol.FEATURES)},
+        MessageType.LOGOUT: None,
+        MessageType.USER_LIST: {"users": [user] * 20},
+        MessageType.USER_STATUS: {"username": "bob", "status": "online"},
+        MessageType.PRIVATE_MESSAGE: stored["content"],
+        MessageType.GROUP_MESSAGE: stored["content"],
+        MessageType.MESSAGE_RESPONSE: {"message_id": message_id},
+        MessageType.CREATE_GROUP: {"name": "Équipe", "members": group["members"]},
+        MessageType.GROUP_CREATED: {"group_id": group["group_id"], "name": "Équipe", "members": group["members"]},
+        MessageType.GROUP_LIST: {"groups": [group] * 5},
+        MessageType.ADD_TO_GROUP: {"members": ["erin"]},
+        MessageType.REMOVE_FROM_GROUP: {"members": ["erin"]},
+        MessageType.FILE_TRANSFER_REQUEST: file_info,
+        MessageType.FILE_TRANSFER_ACCEPT: {"file_id": file_info["file_id"]},
+        MessageType.FILE_TRANSFER_REJECT: {"file_id": file_info["file_id"]},
+        MessageType.FILE_CHUNK: {"file_id": file_info["file_id"], "chunk_number": 12, "data": os.urandom(8192).hex(), "total_chunks": 128},
+        MessageType.FILE_TRANSFER_COMPLETE: {"file_id": file_info["file_id"], "filename": "rapport.pdf", "filepath": "storage/rapport.pdf"},
+        MessageType.HISTORY_REQUEST: {"target": "bob", "limit": 100, "before": None},
+        MessageType.HISTORY_RESPONSE: {"target": "bob", "messages": [stored] * 100, "before": None, "after": None, "next_cursor": message_id},
+        MessageType.TYPING_NOTIFICATION: {"is_typing": True},
+        MessageType.MESSAGE_DELIVERED: {"message_id": message_id},
+        MessageType.MESSAGE_READ: {"message_id": message_id},
+        MessageType.ERROR: {"error": "Destinataire inconnu"},
+        MessageType.PING: None,
+        MessageType.PONG: None,
+        MessageType.WORKER_ROUTE: {"kind": "presence", "username": "alice", "status": "online"}
+    }
+    return [
+        Message(type=message_type, sender="alice", recipient="bob", content=content,
+                timestamp=now, message_id=message_id)
+        for message_type, content in contents.items()
+    ]
+
+def bench_codecs(count: int):
+    # Coût d'encodage/décodage (µs) et taille (octets) de chaque codec par type
+    print(f"{'type':24} {'json enc':>9} {'json dec':>9} {'json o':>8}   {'cmp enc':>9} {'cmp dec':>9} {'cmp o':>8}")
+    iterations = max(1, count // 10)
+    totals = {JsonCodec.name: 0, CompactCodec.name: 0}
+    for message in sample_messages():
+        row = []
+        for codec in (JsonCodec, CompactCodec):
+            started = time.perf_counter()
+            for _ in range(iterations):
+                data = codec.encode(message)
+            encode = (time.perf_counter() - started) / iterations * 1e6
+            
+            started = time.perf_counter()
+            for _ in range(iterations):
+                Protocol.decode_frame(data)
+            decode = (time.perf_counter() - started) / iterations * 1e6
+            
+            totals[codec.name] += len(data)
+            row.append(f"{encode:9.1f} {decode:9.1f} {len(data):8d}")
+        print(f"{message.type.value:24} {'   '.join(row)}")
+    print(f"total: json {totals[JsonCodec.name]} o, compact {totals[CompactCodec.name]} o "
+          f"({totals[CompactCodec.name] / totals[JsonCodec.name]:.0%})")
+
+def bench_compression(count: int):
+    # Réponses de synchronisation réalistes (contenus tous différents) et un
+    # message de discussion court, sans puis avec compression
+    now = datetime.now()
+    users = [
+        {"username": f"poste-{i:04d}", "status": "online", "last_seen": now.isoformat()}
+        for i in range(500)
+    ]
+    history = [
+        {
+            "message_id": str(uuid.uuid4()), "sender": "alice", "recipient": "bob",
+            "content": f"Message {i}: le point sur le dossier {i * 7 % 97}, à relire avant jeudi",
+            "message_type": "text", "timestamp": now.isoformat(),
+            "delivered": True, "read": i % 3 == 0, "file_path": None
+        }
+        for i in range(100)
+    ]
+    groups = [
+        {
+            "group_id": str(uuid.uuid4()), "name": f"Projet {i}", "created_by": "alice",
+            "members": [f"poste-{j:04d}" for j in range(i * 10, i * 10 + 40)],
+            "created_at": now.isoformat()
+        }
+        for i in range(20)
+    ]
+    messages = [
+        Message(type=MessageType.LOGIN_RESPONSE, sender="server",
+                content={"success": True, "username": "alice", "users": users}),
+        Message(type=MessageType.HISTORY_RESPONSE, sender="server",
+                content={"target": "bob", "messages": history, "next_cursor": history[0]["message_id"]}),
+        Message(type=MessageType.GROUP_LIST, sender="server", content={"groups": groups}),
+        Message(type=MessageType.PRIVATE_MESSAGE, sender="alice", recipient="bob",
+                content="On se retrouve à midi ?", message_id=str(uuid.uuid4()))
+    ]
+    
+    iterations = max(1, count // 20)
+    compressions = [
+        feature for feature in (Protocol.FEATURE_ZLIB, Protocol.FEATURE_ZSTD)
+        if feature in Protocol.FEATURES
+    ]
+    for message in messages:
+        plain = Protocol.pack_message(message)
+        results = []
+        for feature in compressions:
+            started = time.perf_counter()
+            for _ in range(iterations):
+                frame = Protocol.pack_message(message, (feature,))
+            elapsed = (time.perf_counter() - started) / iterations * 1e6
+            results.append(f"{feature} {len(frame):7d} o (x{len(plain) / len(frame):4.1f}, {elapsed:6.0f} µs)")
+        print(f"{message.type.value:18} brut {len(plain):7d} o   {'   '.join(results)}")
+
+class NullSocket(OutboundQueue):
+    # File d'envoi qui jette les trames: on ne mesure que l'encodage et la file
+    def push(self, data):
+        if data is not None:
+            self.sent()
+    
+    def abort(self):
+        pass
+
+def bench_fanout(count: int):
+    # Message de groupe envoyé à 1k, 5k et 20k membres: un encodage par
+    # membre (ancien send_to_many) contre un encodage partagé
+    iterations = max(1, count // 200)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            server = Server(database=Database(os.path.join(tmp, "bench.db")))
+            for size in (1000, 5000, 20000):
+                members = [f"user{i}" for i in range(size)]
+                for username in members:
+                    server.clients[username] = User(username=username, connection_id=username, status="online")
+                    server.client_sockets[username] = NullSocket(max_size=iterations + 1)
+                message = Message(
+                    type=MessageType.GROUP_MESSAGE,
+                    sender="user0",
+                    recipient="group_bench",
+                    content="Réunion à 14h dans la grande salle, n'oubliez pas vos ordinateurs.",
+                    timestamp=datetime.now().isoformat(),
+                    message_id=str(uuid.uuid4())
+                )
+                
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    for username in members:
+                        server.send_to(username, message)
+                per_member = (time.perf_counter() - started) / iterations
+                
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    server.send_to_many(members, message)
+                shared = (time.perf_counter() - started) / iterations
+                
+                print(f"{size:6d} membres: encodage par membre {per_member * 1e3:8.1f} ms, "
+                      f"encodage partagé {shared * 1e3:7.1f} ms  (x{per_member / shared:.1f})")
+            server.db.close()
+        finally:
+            os.chdir(cwd)
+
+BENCHMARKS = {
+    "db": bench_database,
+    "file": bench_file_transfer,
+    "chunks": bench_adaptive_chunks,
+    "codec": bench_codecs,
+    "fanout": bench_fanout,
+    "compression": bench_compression
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks LAN Messenger")
+    parser.add_argument("names", nargs="*", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("-n", "--count", type=int, default=2000)
+    args = parser.parse_args()
+    
+    for name in args.names:
+        print(f"== {name}")
+        BENCHMARKS[name](args.count)
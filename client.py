@@ -1,30 +1,65 @@
 import socket
 import threading
+import bisect
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from datetime import datetime
 import os
 import hashlib
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, BinaryIO
 import queue
 import subprocess
+import shutil
+import time
+import uuid
 
-from protocol import Protocol, Message, MessageType, FileTransfer
+from protocol import Protocol, Message, MessageType, FileTransfer, FrameDecoder
+from transfer_engine import TransferEngine, Upload, StreamUpload, FlowControl
+from archive import DirectoryArchive, ArchiveExtractor, archive_size
 
 class ChatClient:
+    # Morceaux de fichier envoyés sans attendre leur accusé de réception
+    FILE_WINDOW = 16
+    # Bornes de l'ajustement de la taille des morceaux (octets) et de la
+    # fenêtre (morceaux) d'après le débit et le RTT mesurés
+    FILE_CHUNK_BOUNDS = (8192, 1024 * 1024)
+    FILE_WINDOW_BOUNDS = (4, 32)
+    # Rafraîchissement de la barre de progression des transferts
+    PROGRESS_INTERVAL_MS = 100
+    # Dossiers compressés en cours d'envoi (si le destinataire le peut)
+    COMPRESS_DIRECTORIES = True
+    
     def __init__(self, host='localhost', port=8888):
         self.host = host
         self.port = port
         self.socket = None
         self.username = None
         self.connected = False
+        # Fonctionnalités du protocole acceptées par le serveur
+        self.server_features = set()
         
         self.message_queue = queue.Queue()
         self.users: Dict[str, dict] = {}
         self.groups: Dict[str, dict] = {}
         self.conversations: Dict[str, List[dict]] = {}
+        # Curseur de la page d'historique plus ancienne (None: tout est chargé)
+        self.history_cursors: Dict[str, Optional[str]] = {}
+        self.history_loading = set()
+        # Messages d'historique à afficher quand Tk sera libre: cible -> (page
+        # plus ancienne, messages reçus)
+        self.pending_history: Dict[str, tuple] = {}
+        # Bulles de la conversation affichée, dans l'ordre des horodatages
+        self.message_keys: List[str] = []
+        self.message_frames: List[tk.Widget] = []
         
         self.file_transfers: Dict[str, FileTransfer] = {}
+        # Fichiers en cours de réception, ouverts à l'acceptation
+        self.receiving_files: Dict[str, BinaryIO] = {}
+        # Réveille les envois de fichiers en attente de FILE_TRANSFER_RESUME;
+        # garde aussi file_transfers, modifié par plusieurs threads
+        self.transfer_acks = threading.Condition()
+        # Seul écrivain du socket, créé à la connexion
+        self.engine: Optional[TransferEngine] = None
         self.current_conversation = None
         self.unread_messages = set()
         self.typing_timeout = None
@@ -129,20 +164,28 @@ class ChatClient:
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((server, port))
+            self.engine = TransferEngine(
+                self.socket,
+                on_complete=self.on_upload_complete,
+                on_failed=self.on_upload_failed
+            )
             
             login_msg = Message(
                 type=MessageType.LOGIN,
                 sender=username,
-                content={"username": username}
+                content={"username": username, "features": list(Protocol.FEATURES)}
             )
-            self.socket.send(Protocol.pack_message(login_msg))
+            self.send_frame(Protocol.pack_message(login_msg))
             
-            response = Protocol.unpack_message(self.socket)
+            # Le même décodeur sert ensuite au thread de réception
+            self.incoming = FrameDecoder().messages(self.socket)
+            response = next(self.incoming, None)
             
             if response and response.type == MessageType.LOGIN_RESPONSE:
                 if response.content.get("success"):
                     self.username = username
                     self.connected = True
+                    self.server_features = set(response.content.get("features", []))
                     
                     # Mettre à jour la liste des utilisateurs
                     users_list = response.content.get("users", [])
@@ -158,6 +201,7 @@ class ChatClient:
                     self.receive_thread.start()
                     
                     self.root.after(100, self.process_message_queue)
+                    self.root.after(self.PROGRESS_INTERVAL_MS, self.refresh_progress)
                     
                 else:
                     error = response.content.get("error", "Erreur inconnue")
@@ -268,8 +312,8 @@ class ChatClient:
         self.messages_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
         
         self.messages_canvas = tk.Canvas(self.messages_frame, bg='white', highlightthickness=0)
-        messages_scrollbar = ttk.Scrollbar(self.messages_frame, orient=tk.VERTICAL, command=self.messages_canvas.yview)
-        self.messages_canvas.configure(yscrollcommand=messages_scrollbar.set)
+        self.messages_scrollbar = ttk.Scrollbar(self.messages_frame, orient=tk.VERTICAL, command=self.messages_canvas.yview)
+        self.messages_canvas.configure(yscrollcommand=self.on_messages_scroll)
         
         self.messages_inner = ttk.Frame(self.messages_canvas)
         self.messages_window = self.messages_canvas.create_window((0, 0), window=self.messages_inner, anchor='nw')
@@ -277,7 +321,7 @@ class ChatClient:
         self.messages_inner.bind('<Configure>', self.on_messages_configure)
         self.messages_canvas.bind('<Configure>', self.on_messages_canvas_configure)
         
-        messages_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.messages_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.messages_canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
         input_frame = ttk.Frame(parent)
@@ -307,6 +351,14 @@ class ChatClient:
         )
         self.file_btn.pack(pady=2)
         
+        self.folder_btn = ttk.Button(
+            button_frame,
+            text="Dossier",
+            command=self.send_directory,
+            state='disabled'
+        )
+        self.folder_btn.pack(pady=2)
+        
         self.status_frame = ttk.Frame(parent)
         self.status_frame.pack(fill=tk.X, padx=10, pady=2)
         
@@ -331,6 +383,16 @@ class ChatClient:
     def on_messages_canvas_configure(self, event):
         self.messages_canvas.itemconfig(self.messages_window, width=event.width)
     
+    def on_messages_scroll(self, first, last):
+        self.messages_scrollbar.set(first, last)
+        
+        # Arrivé en haut de la conversation: on charge la page précédente
+        target = self.current_conversation
+        if float(first) <= 0.0 and target and target not in self.history_loading:
+            cursor = self.history_cursors.get(target)
+            if cursor:
+                self.request_history(target, before=cursor)
+    
     def filter_users(self, event=None):
         search_term = self.search_entry.get().lower()
         
@@ -408,6 +470,7 @@ class ChatClient:
         
         self.send_btn.config(state='normal')
         self.file_btn.config(state='normal')
+        self.folder_btn.config(state='normal')
         
         if username in self.unread_messages:
             self.unread_messages.remove(username)
@@ -431,22 +494,38 @@ class ChatClient:
                 self.contact_label.config(text=f"Groupe: {group_name}")
                 self.send_btn.config(state='normal')
                 self.file_btn.config(state='normal')
+                self.folder_btn.config(state='normal')
                 self.load_conversation(group_id)
                 self.request_history(group_id)
     
-    def load_conversation(self, target: str):
+    def load_conversation(self, target: str, scroll_to: float = 1.0):
+        # Redessin complet, au changement de conversation seulement
         for widget in self.messages_inner.winfo_children():
             widget.destroy()
+        self.message_keys = []
+        self.message_frames = []
+        # Les lots pas encore affichés font partie de la conversation
+        self.pending_history.pop(target, None)
         
         if target in self.conversations:
             for msg in self.conversations[target]:
                 self.display_message(msg)
         
-        self.messages_canvas.yview_moveto(1.0)
+        self.messages_inner.update_idletasks()
+        self.messages_canvas.yview_moveto(scroll_to)
     
     def display_message(self, msg: dict):
+        # Ajoutée en bas, ou à sa place si elle est plus ancienne que la
+        # dernière bulle (lot d'historique)
+        key = msg.get('timestamp', '')
+        position = bisect.bisect_right(self.message_keys, key)
         msg_frame = ttk.Frame(self.messages_inner)
-        msg_frame.pack(fill=tk.X, padx=10, pady=2)
+        if position < len(self.message_frames):
+            msg_frame.pack(fill=tk.X, padx=10, pady=2, before=self.message_frames[position])
+        else:
+            msg_frame.pack(fill=tk.X, padx=10, pady=2)
+        self.message_keys.insert(position, key)
+        self.message_frames.insert(position, msg_frame)
         
         is_sender = msg['sender'] == self.username
         alignment = 'e' if is_sender else 'w'
@@ -504,7 +583,11 @@ class ChatClient:
                 cursor='hand2'
             )
             file_link.pack()
-            file_link.bind('<Button-1>', lambda e, p=msg.get('file_path'): self.open_file(p))
+            # Le contenu est "Fichier: <nom>"; le chemin stocké est une empreinte
+            file_link.bind(
+                '<Button-1>',
+                lambda e, m=msg: self.open_file(m.get('file_path'), m['content'].split(": ", 1)[-1])
+            )
     
     def send_message(self):
         if not self.current_conversation:
@@ -526,7 +609,7 @@ class ChatClient:
         )
         
         try:
-            self.socket.send(Protocol.pack_message(message))
+            self.send_frame(Protocol.pack_message(message, self.server_features))
             self.message_entry.delete('1.0', tk.END)
             
             chat_msg = {
@@ -566,7 +649,7 @@ class ChatClient:
                 sender=self.username,
                 recipient=self.current_conversation
             )
-            self.socket.send(Protocol.pack_message(notification))
+            self.send_frame(Protocol.pack_message(notification, self.server_features))
         except:
             pass
         
@@ -592,75 +675,209 @@ class ChatClient:
         ):
             return
         
-        file_id = hashlib.md5(f"{self.username}{filename}{datetime.now()}".encode()).hexdigest()
+        # Même fichier, même destinataire: même file_id, ce qui permet au
+        # serveur de reprendre un envoi interrompu
+        file_id = hashlib.md5(
+            f"{self.username}:{self.current_conversation}:{filepath}:{filesize}:{os.path.getmtime(filepath)}".encode()
+        ).hexdigest()
         
-        transfer_msg = Message(
-            type=MessageType.FILE_TRANSFER_REQUEST,
-            sender=self.username,
-            recipient=self.current_conversation,
-            content={
-                "file_id": file_id,
-                "filename": filename,
-                "filesize": filesize,
-                "is_directory": False
-            }
-        )
+        with self.transfer_acks:
+            self.file_transfers[file_id] = FileTransfer(
+                file_id=file_id,
+                sender=self.username,
+                recipient=self.current_conversation,
+                filename=filename,
+                filesize=filesize,
+                filepath=filepath
+            )
+        
+        self.status_label.config(text=f"Envoi de {filename}...")
+        self.file_progress.pack(side=tk.RIGHT, padx=5)
+        
+        # La demande part du thread d'envoi, une fois l'empreinte calculée
+        threading.Thread(
+            target=self.send_file_thread,
+            args=(file_id, filepath, filename, filesize),
+            daemon=True
+        ).start()
+    
+    def send_directory(self):
+        if not self.current_conversation:
+            return
+        
+        dirpath = filedialog.askdirectory(title="Dossier à envoyer")
+        if not dirpath:
+            return
+        if Protocol.FEATURE_DIRECTORY not in self.server_features:
+            messagebox.showerror("Erreur", "Le serveur ne prend pas en charge l'envoi de dossiers")
+            return
+        
+        dirname = os.path.basename(os.path.normpath(dirpath))
+        if not messagebox.askyesno("Confirmation", f"Envoyer le dossier '{dirname}' ?"):
+            return
+        
+        # Un flux d'archive ne se reprend pas: nouvel identifiant à chaque envoi
+        file_id = uuid.uuid4().hex
+        with self.transfer_acks:
+            self.file_transfers[file_id] = FileTransfer(
+                file_id=file_id,
+                sender=self.username,
+                recipient=self.current_conversation,
+                filename=dirname,
+                filesize=0,
+                filepath=dirpath,
+                is_directory=True
+            )
+        
+        self.status_label.config(text=f"Envoi de {dirname}...")
+        self.file_progress.pack(side=tk.RIGHT, padx=5)
         
+        threading.Thread(
+            target=self.send_directory_thread,
+            args=(file_id,),
+            daemon=True
+        ).start()
+    
+    def send_directory_thread(self, file_id: str):
+        transfer = self.file_transfers[file_id]
         try:
-            self.socket.send(Protocol.pack_message(transfer_msg))
-            self.status_label.config(text=f"Envoi de {filename}...")
-            self.file_progress.pack(side=tk.RIGHT, padx=5)
+            # Taille de l'archive non compressée, pour la progression seulement
+            transfer.filesize = archive_size(transfer.filepath)
+            compression = None
+            if self.COMPRESS_DIRECTORIES:
+                compression = Protocol.compression_for(self.server_features)
+            
+            transfer_msg = Message(
+                type=MessageType.FILE_TRANSFER_REQUEST,
+                sender=self.username,
+                recipient=transfer.recipient,
+                content={
+                    "file_id": file_id,
+                    "filename": transfer.filename,
+                    "filesize": transfer.filesize,
+                    "is_directory": True,
+                    "compression": compression
+                }
+            )
+            self.send_frame(Protocol.pack_message(transfer_msg, self.server_features))
             
-            threading.Thread(
-                target=self.send_file_thread,
-                args=(file_id, filepath, filename, filesize),
-                daemon=True
-            ).start()
+            # Seulement pour savoir si le serveur a refusé la demande
+            if self.wait_for_missing(transfer) is None:
+                return
             
+            binary = Protocol.FEATURE_BINARY_CHUNKS in self.server_features
+            chunk_size = 65536 if binary else 8192
+            flow = FlowControl(
+                chunk_size, self.FILE_WINDOW,
+                *self.FILE_CHUNK_BOUNDS, *self.FILE_WINDOW_BOUNDS
+            )
+            stream = DirectoryArchive(transfer.filepath, compression)
+            self.engine.add_upload(StreamUpload(
+                transfer, stream, chunk_size, binary, self.FILE_WINDOW, self.server_features, flow
+            ))
+        
         except Exception as e:
-            messagebox.showerror("Erreur", f"Impossible d'envoyer le fichier: {e}")
+            self.on_upload_failed(transfer, e)
+    
+    def send_frame(self, frame: bytes):
+        # Passe avant les morceaux de fichier en cours d'envoi
+        self.engine.send(frame)
     
     def send_file_thread(self, file_id: str, filepath: str, filename: str, filesize: int):
+        # Prépare l'envoi (empreinte, demande, plages attendues) puis le confie
+        # au moteur de transfert
+        transfer = self.file_transfers[file_id]
         try:
-            chunk_size = 8192
-            total_chunks = (filesize + chunk_size - 1) // chunk_size
-            chunk_number = 0
+            # Le serveur n'a pas besoin du contenu s'il a déjà un fichier de
+            # même empreinte
+            transfer_msg = Message(
+                type=MessageType.FILE_TRANSFER_REQUEST,
+                sender=self.username,
+                recipient=transfer.recipient,
+                content={
+                    "file_id": file_id,
+                    "filename": filename,
+                    "filesize": filesize,
+                    "is_directory": False,
+                    "sha256": file_digest(filepath)
+                }
+            )
+            self.send_frame(Protocol.pack_message(transfer_msg, self.server_features))
             
-            with open(filepath, 'rb') as f:
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    
-                    chunk_msg = Message(
-                        type=MessageType.FILE_CHUNK,
-                        sender=self.username,
-                        recipient=self.current_conversation,
-                        content={
-                            "file_id": file_id,
-                            "chunk_number": chunk_number,
-                            "data": chunk.hex(),
-                            "total_chunks": total_chunks
-                        }
-                    )
-                    self.socket.send(Protocol.pack_message(chunk_msg))
-                    
-                    chunk_number += 1
-                    progress = (chunk_number / total_chunks) * 100
-                    self.root.after(0, lambda p=progress: self.file_progress.config(value=p))
-                    
-            self.root.after(0, self.file_transfer_complete)
+            # En binaire on peut envoyer de plus gros morceaux: pas de hex
+            # qui double la taille ni de JSON à décoder. Les deux tailles sont
+            # des multiples des blocs suivis par le serveur (PartialFile).
+            binary = Protocol.FEATURE_BINARY_CHUNKS in self.server_features
+            chunk_size = 65536 if binary else 8192
+            missing = self.wait_for_missing(transfer)
+            if missing is None:
+                return
+            
+            # Avec le relais, le serveur renvoie un accusé de réception par
+            # morceau: l'envoi s'arrête quand la fenêtre est pleine, et les
+            # accusés servent à ajuster taille des morceaux et fenêtre
+            window = self.FILE_WINDOW if Protocol.FEATURE_FILE_RELAY in self.server_features else None
+            flow = FlowControl(
+                chunk_size, self.FILE_WINDOW,
+                *self.FILE_CHUNK_BOUNDS, *self.FILE_WINDOW_BOUNDS
+            )
+            self.engine.add_upload(
+                Upload(transfer, missing, chunk_size, binary, window, self.server_features, flow)
+            )
             
         except Exception as e:
-            self.root.after(0, lambda: self.status_label.config(text=f"Erreur: {e}"))
+            self.on_upload_failed(transfer, e)
+    
+    def on_upload_complete(self, transfer: FileTransfer):
+        # Appelé depuis le moteur de transfert
+        with self.transfer_acks:
+            self.file_transfers.pop(transfer.file_id, None)
+        self.root.after(0, self.file_transfer_complete)
+    
+    def on_upload_failed(self, transfer: FileTransfer, error: Exception):
+        with self.transfer_acks:
+            self.file_transfers.pop(transfer.file_id, None)
+        self.root.after(0, lambda: self.status_label.config(text=f"Erreur: {error}"))
+    
+    def refresh_progress(self):
+        # Une mise à jour par intervalle, quel que soit le nombre de morceaux
+        done = total = 0
+        with self.transfer_acks:
+            transfers = list(self.file_transfers.values())
+        for transfer in transfers:
+            total += transfer.filesize
+            done += transfer.bytes_sent if transfer.sender == self.username else transfer.bytes_received
+        if total:
+            self.file_progress.config(value=done * 100 / total)
+        if self.running:
+            self.root.after(self.PROGRESS_INTERVAL_MS, self.refresh_progress)
+    
+    def wait_for_missing(self, transfer: FileTransfer) -> Optional[List[List[int]]]:
+        # Plages que le serveur attend encore (tout le fichier sans reprise);
+        # None si le transfert a été refusé entre-temps
+        if Protocol.FEATURE_FILE_RESUME not in self.server_features:
+            return [[0, transfer.filesize]]
+        with self.transfer_acks:
+            deadline = time.monotonic() + 30
+            while transfer.missing is None:
+                if transfer.file_id not in self.file_transfers or not self.connected:
+                    return None
+                if time.monotonic() > deadline:
+                    return [[0, transfer.filesize]]
+                self.transfer_acks.wait(1)
+            return transfer.missing
     
     def file_transfer_complete(self):
         self.file_progress.pack_forget()
         self.status_label.config(text="Fichier envoyé")
         self.root.after(3000, lambda: self.status_label.config(text=""))
     
-    def open_file(self, filepath: str):
-        if filepath and os.path.exists(filepath):
+    def open_file(self, filepath: str, filename: Optional[str] = None):
+        if filepath and not os.path.exists(filepath) and filepath.startswith("storage/"):
+            # Fichier resté sur le serveur
+            if self.connected:
+                self.download_file(filepath, filename or os.path.basename(filepath))
+        elif filepath and os.path.exists(filepath):
             try:
                 if os.name == 'nt':
                     os.startfile(filepath)
@@ -671,6 +888,40 @@ class ChatClient:
         else:
             messagebox.showinfo("Info", "Le fichier n'existe pas")
     
+    def download_file(self, file_path: str, filename: str):
+        save_path = filedialog.asksaveasfilename(
+            initialfile=filename,
+            title="Enregistrer le fichier"
+        )
+        if not save_path:
+            return
+        
+        download_id = hashlib.md5(f"{file_path}:{time.time()}".encode()).hexdigest()
+        try:
+            self.receiving_files[download_id] = open(save_path, 'wb')
+        except OSError as e:
+            messagebox.showerror("Erreur", f"Impossible d'écrire le fichier: {e}")
+            return
+        # Expéditeur "server": les morceaux ne sont pas acquittés
+        with self.transfer_acks:
+            self.file_transfers[download_id] = FileTransfer(
+                file_id=download_id,
+                sender="server",
+                recipient=self.username,
+                filename=filename,
+                filesize=0,
+                filepath=save_path
+            )
+        
+        download_msg = Message(
+            type=MessageType.FILE_DOWNLOAD_REQUEST,
+            sender=self.username,
+            content={"file_id": download_id, "file_path": file_path}
+        )
+        self.send_frame(Protocol.pack_message(download_msg, self.server_features))
+        self.status_label.config(text=f"Téléchargement de {filename}...")
+        self.file_progress.pack(side=tk.RIGHT, padx=5)
+    
     def show_create_group_dialog(self):
         dialog = tk.Toplevel(self.root)
         dialog.title("Créer un groupe")
@@ -729,7 +980,7 @@ class ChatClient:
             )
             
             try:
-                self.socket.send(Protocol.pack_message(create_msg))
+                self.send_frame(Protocol.pack_message(create_msg, self.server_features))
                 dialog.destroy()
             except Exception as e:
                 messagebox.showerror("Erreur", f"Impossible de créer le groupe: {e}")
@@ -737,32 +988,40 @@ class ChatClient:
         ttk.Button(button_frame, text="Annuler", command=dialog.destroy).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="Créer", command=create_group).pack(side=tk.RIGHT, padx=5)
     
-    def request_history(self, target: str):
+    def request_history(self, target: str, before: Optional[str] = None):
         history_msg = Message(
             type=MessageType.HISTORY_REQUEST,
             sender=self.username,
             content={
                 "target": target,
-                "limit": 100
+                "limit": 100,
+                "before": before
             }
         )
         
         try:
-            self.socket.send(Protocol.pack_message(history_msg))
+            self.history_loading.add(target)
+            self.send_frame(Protocol.pack_message(history_msg, self.server_features))
         except Exception:
-            pass
+            self.history_loading.discard(target)
     
     def receive_messages(self):
-        while self.running and self.connected:
-            try:
-                message = Protocol.unpack_message(self.socket)
-                if message:
-                    self.message_queue.put(message)
-                else:
+        try:
+            for message in self.incoming:
+                if not (self.running and self.connected):
                     break
-            except Exception as e:
-                print(f"Erreur de réception: {e}")
-                break
+                # Les morceaux et leurs accusés de réception ne passent pas par
+                # la boucle Tk: le débit des transferts n'en dépend pas
+                if message.type == MessageType.FILE_CHUNK:
+                    self.handle_file_chunk(message)
+                elif message.type == MessageType.FILE_CHUNK_ACK:
+                    self.handle_chunk_ack(message)
+                elif message.type == MessageType.FILE_TRANSFER_RESUME:
+                    self.handle_file_resume(message)
+                else:
+                    self.message_queue.put(message)
+        except Exception as e:
+            print(f"Erreur de réception: {e}")
         
         self.connected = False
         self.root.after(0, self.handle_disconnection)
@@ -785,9 +1044,12 @@ class ChatClient:
             MessageType.USER_STATUS: self.handle_user_status,
             MessageType.GROUP_LIST: self.handle_group_list,
             MessageType.GROUP_CREATED: self.handle_group_created,
+            MessageType.REMOVE_FROM_GROUP: self.handle_removed_from_group,
             MessageType.HISTORY_RESPONSE: self.handle_history_response,
             MessageType.FILE_TRANSFER_REQUEST: self.handle_file_request,
+            MessageType.FILE_TRANSFER_REJECT: self.handle_file_reject,
             MessageType.FILE_TRANSFER_COMPLETE: self.handle_file_complete,
+            MessageType.FILE_DOWNLOAD_RESPONSE: self.handle_download_response,
             MessageType.MESSAGE_DELIVERED: self.handle_message_delivered,
             MessageType.TYPING_NOTIFICATION: self.handle_typing_notification,
             MessageType.PING: self.handle_ping
@@ -868,11 +1130,20 @@ class ChatClient:
     def handle_group_list(self, message: Message):
         groups = message.content.get('groups', [])
         
+        # Mise à jour partielle: le serveur n'envoie que les groupes modifiés
         for group in groups:
             self.groups[group['group_id']] = group
         
+        self.refresh_groups_list()
+    
+    def handle_removed_from_group(self, message: Message):
+        if self.username in message.content.get('members', []):
+            self.groups.pop(message.recipient, None)
+            self.refresh_groups_list()
+    
+    def refresh_groups_list(self):
         self.groups_listbox.delete(0, tk.END)
-        for group in groups:
+        for group in self.groups.values():
             self.groups_listbox.insert(tk.END, group['name'])
     
     def handle_group_created(self, message: Message):
@@ -882,35 +1153,79 @@ class ChatClient:
         messagebox.showinfo("Succès", f"Groupe '{group_info['name']}' créé")
     
     def handle_history_response(self, message: Message):
+        # L'historique arrive par lots; la dernière trame (done) porte le curseur
         target = message.content['target']
         messages = message.content['messages']
+        older_page = message.content.get('before') is not None
+        
+        if message.content.get('done', True):
+            self.history_loading.discard(target)
+            self.history_cursors[target] = message.content.get('next_cursor')
+        
+        if not messages:
+            return
         
         if target not in self.conversations:
             self.conversations[target] = []
         
-        for msg in messages:
-            if msg not in self.conversations[target]:
-                self.conversations[target].append(msg)
+        conversation = self.conversations[target]
+        known_ids = {msg.get('message_id') for msg in conversation}
+        added = [msg for msg in messages if msg['message_id'] not in known_ids]
+        conversation.extend(added)
+        conversation.sort(key=lambda x: x['timestamp'])
         
-        self.conversations[target].sort(key=lambda x: x['timestamp'])
+        if self.current_conversation == target and added:
+            self.schedule_history(target, older_page, added)
+    
+    def schedule_history(self, target: str, older_page: bool, added: List[dict]):
+        # Les lots reçus d'affilée sont affichés en une fois
+        if target in self.pending_history:
+            self.pending_history[target][1].extend(added)
+            return
+        self.pending_history[target] = (older_page, list(added))
+        self.root.after_idle(self.show_history, target)
+    
+    def show_history(self, target: str):
+        older_page, added = self.pending_history.pop(target, (False, []))
+        if not added or self.current_conversation != target:
+            # Déjà affichés par load_conversation, ou le seront
+            return
+        
+        # Seules les bulles des nouveaux messages sont créées: en haut pour
+        # une page plus ancienne, en bas (ou à leur place) sinon
+        for msg in added:
+            self.display_message(msg)
+        self.messages_inner.update_idletasks()
         
-        if self.current_conversation == target:
-            self.load_conversation(target)
+        # Page plus ancienne: on garde à l'écran les messages déjà lus
+        shown = len(self.message_frames)
+        self.messages_canvas.yview_moveto(len(added) / shown if older_page and shown else 1.0)
     
     def handle_file_request(self, message: Message):
         file_info = message.content
         sender = message.sender
+        is_directory = bool(file_info.get("is_directory"))
+        kind = "le dossier " if is_directory else ""
         
         response = messagebox.askyesno(
             "Transfert de fichier",
-            f"{sender} veut vous envoyer '{file_info['filename']}' ({file_info['filesize']/1024:.1f} KB).\nAccepter ?"
+            f"{sender} veut vous envoyer {kind}'{file_info['filename']}' ({file_info['filesize']/1024:.1f} KB).\nAccepter ?"
         )
         
         if response:
-            save_path = filedialog.asksaveasfilename(
-                initialfile=file_info['filename'],
-                title="Enregistrer le fichier"
-            )
+            if is_directory:
+                # Le dossier est recréé tel quel dans le dossier choisi
+                name = os.path.basename(os.path.normpath(file_info['filename']))
+                parent = filedialog.askdirectory(title="Enregistrer le dossier dans")
+                save_path = os.path.join(parent, name) if parent and name not in ("", ".", "..") else ""
+                if save_path and os.path.exists(save_path):
+                    messagebox.showerror("Erreur", f"{save_path} existe déjà")
+                    save_path = ""
+            else:
+                save_path = filedialog.asksaveasfilename(
+                    initialfile=file_info['filename'],
+                    title="Enregistrer le fichier"
+                )
             
             if save_path:
                 transfer = FileTransfer(
@@ -919,9 +1234,20 @@ class ChatClient:
                     recipient=self.username,
                     filename=file_info['filename'],
                     filesize=file_info['filesize'],
-                    filepath=save_path
+                    filepath=save_path,
+                    is_directory=is_directory
                 )
-                self.file_transfers[file_info['file_id']] = transfer
+                try:
+                    if is_directory:
+                        receiver = ArchiveExtractor(parent, name)
+                    else:
+                        receiver = open(save_path, 'wb')
+                    self.receiving_files[transfer.file_id] = receiver
+                except OSError as e:
+                    messagebox.showerror("Erreur", f"Impossible d'écrire le fichier: {e}")
+                    return
+                with self.transfer_acks:
+                    self.file_transfers[file_info['file_id']] = transfer
                 
                 accept_msg = Message(
                     type=MessageType.FILE_TRANSFER_ACCEPT,
@@ -929,7 +1255,7 @@ class ChatClient:
                     recipient=sender,
                     content={"file_id": file_info['file_id']}
                 )
-                self.socket.send(Protocol.pack_message(accept_msg))
+                self.send_frame(Protocol.pack_message(accept_msg, self.server_features))
                 
                 self.status_label.config(text=f"Réception de {file_info['filename']}...")
                 self.file_progress.pack(side=tk.RIGHT, padx=5)
@@ -940,19 +1266,138 @@ class ChatClient:
                 recipient=sender,
                 content={"file_id": file_info['file_id']}
             )
-            self.socket.send(Protocol.pack_message(reject_msg))
+            self.send_frame(Protocol.pack_message(reject_msg, self.server_features))
+    
+    def handle_file_chunk(self, message: Message):
+        # Appelé depuis le thread de réception
+        chunk_data = message.content
+        file_id = chunk_data["file_id"]
+        transfer = self.file_transfers.get(file_id)
+        f = self.receiving_files.get(file_id)
+        if transfer is None or f is None:
+            return
+        
+        data = Protocol.chunk_bytes(chunk_data)
+        try:
+            # Un dossier arrive dans l'ordre, sa position n'a pas de sens
+            if "offset" in chunk_data and not transfer.is_directory:
+                f.seek(chunk_data["offset"])
+            written = f.write(data)
+        except (OSError, ValueError) as e:
+            # Fichier fermé par une annulation pendant l'écriture, ou
+            # extraction impossible: l'expéditeur est prévenu
+            if transfer.is_directory and self.receiving_files.get(file_id) is f:
+                reject_msg = Message(
+                    type=MessageType.FILE_TRANSFER_REJECT,
+                    sender=self.username,
+                    recipient=transfer.sender,
+                    content={"file_id": file_id, "error": str(e)}
+                )
+                self.send_frame(Protocol.pack_message(reject_msg, self.server_features))
+                self.message_queue.put(reject_msg)
+            return
+        
+        transfer.total_chunks = chunk_data["total_chunks"]
+        transfer.chunks_received += 1
+        # Octets d'archive décompressés pour un dossier
+        transfer.bytes_received += written
+        
+        if transfer.sender != "server":
+            ack_msg = Message(
+                type=MessageType.FILE_CHUNK_ACK,
+                sender=self.username,
+                recipient=transfer.sender,
+                content={"file_id": file_id, "chunk_number": chunk_data["chunk_number"]}
+            )
+            self.send_frame(Protocol.pack_message(ack_msg, self.server_features))
+    
+    def handle_chunk_ack(self, message: Message):
+        # Appelé depuis le thread de réception
+        self.engine.ack(message.content["file_id"], message.content["chunk_number"])
+    
+    def handle_file_resume(self, message: Message):
+        # Appelé depuis le thread de réception
+        with self.transfer_acks:
+            transfer = self.file_transfers.get(message.content["file_id"])
+            if transfer is not None:
+                transfer.missing = message.content["missing"]
+                self.transfer_acks.notify_all()
+    
+    def handle_download_response(self, message: Message):
+        if "error" in message.content:
+            self.handle_file_reject(message)
+            return
+        
+        transfer = self.file_transfers.get(message.content["file_id"])
+        if transfer is not None:
+            transfer.filesize = message.content["filesize"]
+    
+    def handle_file_reject(self, message: Message):
+        file_id = message.content.get("file_id")
+        with self.transfer_acks:
+            transfer = self.file_transfers.pop(file_id, None)
+            self.transfer_acks.notify_all()
+        if transfer is None:
+            return
+        self.engine.cancel(file_id)
+        
+        f = self.receiving_files.pop(file_id, None)
+        if f is not None and transfer.is_directory:
+            f.abort()
+            shutil.rmtree(transfer.filepath, ignore_errors=True)
+        elif f is not None:
+            f.close()
+            try:
+                os.remove(transfer.filepath)
+            except OSError:
+                pass
+        
+        self.file_progress.pack_forget()
+        error = message.content.get("error", "Transfert refusé")
+        self.status_label.config(text=f"{transfer.filename}: {error}")
+        self.root.after(3000, lambda: self.status_label.config(text=""))
     
     def handle_file_complete(self, message: Message):
         file_info = message.content
         self.file_progress.pack_forget()
         self.status_label.config(text="Fichier reçu")
         
+        # Relais direct: le fichier est déjà écrit là où on l'a enregistré
+        filepath = file_info['filepath']
+        f = self.receiving_files.pop(file_info['file_id'], None)
+        if f is not None:
+            with self.transfer_acks:
+                transfer = self.file_transfers.pop(file_info['file_id'])
+            try:
+                f.close()
+            except OSError as e:
+                # Extraction d'un dossier interrompue
+                self.status_label.config(text=str(e))
+            if transfer.sender == "server":
+                # Téléchargement d'un fichier déjà présent dans la conversation
+                self.root.after(3000, lambda: self.status_label.config(text=""))
+                self.open_file(transfer.filepath)
+                return
+            
+            # Le serveur a stocké le fichier au lieu de le relayer (expéditeur
+            # sans relais, destinataire sur un autre worker): rien n'est
+            # arrivé ici, le fichier se télécharge depuis filepath
+            if file_info.get('relay', filepath is None):
+                filepath = transfer.filepath
+                if not transfer.is_directory and transfer.bytes_received < transfer.filesize:
+                    self.status_label.config(text=f"{file_info['filename']} incomplet")
+            elif not transfer.is_directory:
+                try:
+                    os.remove(transfer.filepath)
+                except OSError:
+                    pass
+        
         chat_msg = {
             'sender': message.sender,
             'recipient': self.username,
             'content': f"Fichier: {file_info['filename']}",
             'message_type': 'file',
-            'file_path': file_info['filepath'],
+            'file_path': filepath,
             'timestamp': datetime.now().isoformat()
         }
         
@@ -981,7 +1426,7 @@ class ChatClient:
             sender=self.username
         )
         try:
-            self.socket.send(Protocol.pack_message(pong))
+            self.send_frame(Protocol.pack_message(pong, self.server_features))
         except:
             pass
     
@@ -993,7 +1438,7 @@ class ChatClient:
             content={"message_id": message_id}
         )
         try:
-            self.socket.send(Protocol.pack_message(read_msg))
+            self.send_frame(Protocol.pack_message(read_msg, self.server_features))
         except:
             pass
     
@@ -1008,12 +1453,22 @@ class ChatClient:
     
     def cleanup(self):
         self.running = False
+        if self.engine:
+            self.engine.stop()
         if self.socket:
             try:
                 self.socket.close()
             except:
                 pass
 
+def file_digest(filepath: str) -> str:
+    # Lecture par blocs: la taille du fichier n'a pas d'importance
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
 if __name__ == "__main__":
     client = ChatClient()
     try:
@@ -1,21 +1,160 @@
 import sqlite3
 import json
+import queue
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Set, Tuple, Iterator
 import threading
-from models import User, Message, Group, Conversation, OfflineMessage
+from models import User, Message, Group, Conversation, OfflineMessage, conversation_key
 
 class Database:
-    def __init__(self, db_path="messenger.db"):
+    # Une connexion d'écriture persistante (les écritures SQLite sont de toute
+    # façon sérialisées) et un pool de connexions de lecture: en mode WAL les
+    # lectures d'historique ne bloquent plus derrière les écritures.
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA busy_timeout=5000"
+    )
+    
+    INSERT_MESSAGE = '''
+        INSERT INTO messages 
+        (message_id, sender, recipient, content, message_type, timestamp, delivered, read, file_path,
+         conversation_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    
+    # Version du schéma, stockée dans PRAGMA user_version (voir migrate)
+    SCHEMA_VERSION = 4
+    
+    def __init__(self, db_path="messenger.db", readers=4, write_behind=False,
+                 flush_interval_ms=100, flush_rows=256):
         self.db_path = db_path
         self.lock = threading.Lock()
+        self.writer = self.connect()
         self.init_database()
+        
+        self.readers = queue.Queue()
+        for _ in range(readers):
+            self.readers.put(self.connect())
+        
+        # Mode write-behind: save_message ne fait que journaliser en mémoire, un
+        # thread écrit le journal par lots toutes les flush_interval_ms ou dès
+        # flush_rows messages. flush_interval_ms est donc la fenêtre pendant
+        # laquelle un crash (pas un arrêt propre) peut perdre des messages.
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_rows = flush_rows
+        self.journal: List[Message] = []
+        self.journal_cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.flushing = write_behind
+        if write_behind:
+            threading.Thread(target=self.flush_loop, daemon=True).start()
     
-    def init_database(self):
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    @contextmanager
+    def write(self):
         with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            cursor = self.writer.cursor()
+            try:
+                yield cursor
+                self.writer.commit()
+            except Exception:
+                self.writer.rollback()
+                raise
+            finally:
+                cursor.close()
+    
+    @contextmanager
+    def read(self):
+        conn = self.readers.get()
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            self.readers.put(conn)
+    
+    def close(self):
+        with self.journal_cond:
+            self.flushing = False
+            self.journal_cond.notify()
+        self.flush()
+        with self.lock:
+            self.writer.close()
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+    
+    def flush_loop(self):
+        while self.flushing:
+            with self.journal_cond:
+                if len(self.journal) < self.flush_rows:
+                    self.journal_cond.wait(self.flush_interval)
+            self.flush()
+    
+    def flush(self):
+        # flush_lock garde l'ordre des lots quand plusieurs threads vident
+        with self.flush_lock:
+            with self.journal_cond:
+                batch, self.journal = self.journal, []
+            if not batch:
+                return
             
+            rows = [self.message_row(message) for message in batch]
+            try:
+                with self.write() as cursor:
+                    cursor.executemany(self.INSERT_MESSAGE, rows)
+            except sqlite3.Error as e:
+                # Un message fautif ne doit pas faire perdre tout le lot
+                print(f"Erreur lors de l'écriture du journal ({e}), reprise message par message")
+                for row in rows:
+                    try:
+                        with self.write() as cursor:
+                            cursor.execute(self.INSERT_MESSAGE, row)
+                    except sqlite3.Error as e:
+                        print(f"Message {row[0]} non enregistré: {e}")
+    
+    @staticmethod
+    def message_row(message: Message) -> tuple:
+        return (
+            message.message_id,
+            message.sender,
+            message.recipient,
+            message.content,
+            message.message_type,
+            message.timestamp.isoformat(),
+            message.delivered,
+            message.read,
+            message.file_path,
+            message.conversation_key or conversation_key(message.sender, message.recipient)
+        )
+    
+    @staticmethod
+    def row_to_message(row) -> Message:
+        return Message(
+            sender=row[1],
+            recipient=row[2],
+            content=row[3],
+            message_type=row[4],
+            message_id=row[0],
+            timestamp=datetime.fromisoformat(row[5]),
+            delivered=bool(row[6]),
+            read=bool(row[7]),
+            file_path=row[8],
+            conversation_key=row[9]
+        )
+    
+    def init_database(self):
+        with self.write() as cursor:
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     username TEXT PRIMARY KEY,
@@ -36,6 +175,7 @@ class Database:
                     delivered BOOLEAN DEFAULT 0,
                     read BOOLEAN DEFAULT 0,
                     file_path TEXT,
+                    conversation_key TEXT,
                     FOREIGN KEY (sender) REFERENCES users(username),
                     FOREIGN KEY (recipient) REFERENCES users(username)
                 )
@@ -52,6 +192,20 @@ class Database:
                 )
             ''')
             
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS group_members (
+                    group_id TEXT,
+                    username TEXT,
+                    PRIMARY KEY (group_id, username),
+                    FOREIGN KEY (group_id) REFERENCES groups(group_id),
+                    FOREIGN KEY (username) REFERENCES users(username)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_group_members_user
+                ON group_members (username, group_id)
+            ''')
+            
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS conversations (
                     conversation_id TEXT PRIMARY KEY,
@@ -75,114 +229,216 @@ class Database:
                 )
             ''')
             
-            conn.commit()
-            conn.close()
+            self.migrate(cursor)
+    
+    def migrate(self, cursor):
+        # Met à niveau les fichiers messenger.db existants, une étape par version
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        
+        if version < 1:
+            # Clé de conversation indexée pour l'historique
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(messages)")}
+            if "conversation_key" not in columns:
+                cursor.execute("ALTER TABLE messages ADD COLUMN conversation_key TEXT")
+            
+            cursor.execute('''
+                UPDATE messages SET conversation_key = recipient
+                WHERE conversation_key IS NULL
+                AND recipient IN (SELECT group_id FROM groups)
+            ''')
+            # Même clé que models.conversation_key: paire triée séparée par \x1f
+            cursor.execute('''
+                UPDATE messages SET conversation_key = CASE
+                    WHEN sender = recipient THEN sender
+                    WHEN sender < recipient THEN sender || char(31) || recipient
+                    ELSE recipient || char(31) || sender
+                END
+                WHERE conversation_key IS NULL
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_conversation
+                ON messages (conversation_key, timestamp)
+            ''')
+        
+        if version < 2:
+            # Les membres passent de la colonne JSON groups.members à group_members
+            cursor.execute("SELECT group_id, members FROM groups WHERE members IS NOT NULL")
+            rows = [
+                (group_id, member)
+                for group_id, members in cursor.fetchall()
+                for member in json.loads(members)
+            ]
+            cursor.executemany(
+                "INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)",
+                rows
+            )
+            cursor.execute("UPDATE groups SET members = NULL")
+        
+        if version < 3:
+            # Contrôle d'accès des téléchargements par chemin de fichier
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_file_path
+                ON messages (file_path) WHERE file_path IS NOT NULL
+            ''')
+        
+        if version < 4:
+            # Fichiers de storage/ (storage.ContentStore): un par empreinte, avec
+            # leur dernier usage (enregistrement, envoi dédupliqué,
+            # téléchargement) pour l'entretien. Leurs références sont les
+            # messages qui les désignent.
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    created_at TIMESTAMP,
+                    sha256 TEXT,
+                    last_used TIMESTAMP
+                )
+            ''')
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_files_sha256
+                ON files (sha256) WHERE sha256 IS NOT NULL
+            ''')
+        
+        if version < self.SCHEMA_VERSION:
+            cursor.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
     
     def add_user(self, username: str) -> bool:
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            try:
+        try:
+            with self.write() as cursor:
                 cursor.execute(
                     "INSERT INTO users (username, status, last_seen) VALUES (?, ?, ?)",
                     (username, "offline", datetime.now().isoformat())
                 )
-                conn.commit()
-                return True
-            except sqlite3.IntegrityError:
-                return False
-            finally:
-                conn.close()
+            return True
+        except sqlite3.IntegrityError:
+            return False
     
     def update_user_status(self, username: str, status: str):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+        with self.write() as cursor:
             cursor.execute(
                 "UPDATE users SET status = ?, last_seen = ? WHERE username = ?",
                 (status, datetime.now().isoformat(), username)
             )
-            conn.commit()
-            conn.close()
     
     def get_all_users(self) -> List[Dict]:
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+        with self.read() as cursor:
             cursor.execute("SELECT username, status, last_seen FROM users ORDER BY username")
-            users = [
+            return [
                 {"username": row[0], "status": row[1], "last_seen": row[2]}
                 for row in cursor.fetchall()
             ]
-            conn.close()
-            return users
     
     def save_message(self, message: Message):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO messages 
-                (message_id, sender, recipient, content, message_type, timestamp, delivered, read, file_path)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                message.message_id,
-                message.sender,
-                message.recipient,
-                message.content,
-                message.message_type,
-                message.timestamp.isoformat(),
-                message.delivered,
-                message.read,
-                message.file_path
-            ))
-            conn.commit()
-            conn.close()
+        if self.write_behind:
+            with self.journal_cond:
+                self.journal.append(message)
+                if len(self.journal) >= self.flush_rows:
+                    self.journal_cond.notify()
+            return
+        
+        with self.write() as cursor:
+            cursor.execute(self.INSERT_MESSAGE, self.message_row(message))
     
     def get_conversation_history(self, user1: str, user2: str, limit: int = 100) -> List[Message]:
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM messages 
-                WHERE (sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?)
-                ORDER BY timestamp DESC
-                LIMIT ?
-            ''', (user1, user2, user2, user1, limit))
-            
-            messages = []
-            for row in cursor.fetchall():
-                msg = Message(
-                    sender=row[1],
-                    recipient=row[2],
-                    content=row[3],
-                    message_type=row[4],
-                    message_id=row[0],
-                    timestamp=datetime.fromisoformat(row[5]),
-                    delivered=bool(row[6]),
-                    read=bool(row[7]),
-                    file_path=row[8]
-                )
-                messages.append(msg)
+        messages, _ = self.get_history_page(user1, user2, limit)
+        return messages
+    
+    def get_history_page(self, user1: str, user2: str, limit: int = 100,
+                         before: Optional[str] = None,
+                         after: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        # Pagination par curseur (keyset): chaque page est une recherche dans
+        # l'index (conversation_key, timestamp) à partir du curseur, sans OFFSET.
+        # Le curseur est un message_id, un timestamp ou un couple [timestamp,
+        # rowid]; le rowid départage les messages de même timestamp. Renvoie les messages dans l'ordre
+        # chronologique et le curseur de la page suivante (None s'il n'y en a
+        # plus): plus ancienne pour before, plus récente pour after.
+        messages = []
+        next_cursor = None
+        for batch, next_cursor in self.iter_history(user1, user2, limit, before, after, max(limit, 1)):
+            messages.extend(batch)
+        
+        if after is None:
+            messages.reverse()
+        return messages, next_cursor
+    
+    def iter_history(self, user1: str, user2: str, limit: int = 100,
+                     before: Optional[str] = None, after: Optional[str] = None,
+                     batch_size: int = 25) -> Iterator[Tuple[List[Message], Optional[str]]]:
+        # Même page que get_history_page, lue au fil du curseur SQLite par lots
+        # de batch_size, du plus récent au plus ancien (du plus ancien au plus
+        # récent pour after). Le curseur de la page suivante n'est renseigné
+        # que dans le dernier couple produit.
+        self.flush()
+        key = conversation_key(user1, user2)
+        
+        with self.read() as cursor:
+            if after is not None:
+                position = self.resolve_cursor(cursor, after, before=False)
+                cursor.execute('''
+                    SELECT * FROM messages
+                    WHERE conversation_key = ? AND (timestamp, rowid) > (?, ?)
+                    ORDER BY timestamp, rowid
+                    LIMIT ?
+                ''', (key, *position, limit + 1))
+            elif before is not None:
+                position = self.resolve_cursor(cursor, before, before=True)
+                cursor.execute('''
+                    SELECT * FROM messages
+                    WHERE conversation_key = ? AND (timestamp, rowid) < (?, ?)
+                    ORDER BY timestamp DESC, rowid DESC
+                    LIMIT ?
+                ''', (key, *position, limit + 1))
+            else:
+                cursor.execute('''
+                    SELECT * FROM messages
+                    WHERE conversation_key = ?
+                    ORDER BY timestamp DESC, rowid DESC
+                    LIMIT ?
+                ''', (key, limit + 1))
             
-            conn.close()
-            return messages[::-1]
+            batch = []
+            count = 0
+            last_id = None
+            for row in cursor:
+                if count == limit:
+                    # Ligne en trop: la page suivante n'est pas vide
+                    yield batch, last_id
+                    return
+                
+                message = self.row_to_message(row)
+                batch.append(message)
+                count += 1
+                last_id = message.message_id
+                if len(batch) == batch_size:
+                    yield batch, None
+                    batch = []
+            
+            yield batch, None
+    
+    @staticmethod
+    def resolve_cursor(cursor, value, before: bool) -> tuple:
+        if isinstance(value, (list, tuple)):
+            # Couple [timestamp, rowid]: position exacte dans l'index
+            return tuple(value)
+        cursor.execute("SELECT timestamp, rowid FROM messages WHERE message_id = ?", (value,))
+        row = cursor.fetchone()
+        if row:
+            return row
+        # Timestamp ISO: on prend tous les messages strictement avant/après
+        return (value, -1) if before else (value, 2 ** 63 - 1)
     
     def add_offline_message(self, username: str, message: Message):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+        with self.write() as cursor:
             cursor.execute(
                 "INSERT INTO offline_messages (username, message_id) VALUES (?, ?)",
                 (username, message.message_id)
             )
-            conn.commit()
-            conn.close()
     
     def get_offline_messages(self, username: str) -> List[Message]:
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+        # Lecture et purge dans la même transaction d'écriture
+        self.flush()
+        with self.write() as cursor:
             cursor.execute('''
                 SELECT m.* FROM messages m
                 JOIN offline_messages om ON m.message_id = om.message_id
@@ -190,65 +446,181 @@ class Database:
                 ORDER BY m.timestamp
             ''', (username,))
             
-            messages = []
-            for row in cursor.fetchall():
-                msg = Message(
-                    sender=row[1],
-                    recipient=row[2],
-                    content=row[3],
-                    message_type=row[4],
-                    message_id=row[0],
-                    timestamp=datetime.fromisoformat(row[5]),
-                    delivered=bool(row[6]),
-                    read=bool(row[7]),
-                    file_path=row[8]
-                )
-                messages.append(msg)
+            messages = [self.row_to_message(row) for row in cursor.fetchall()]
             
             cursor.execute(
                 "DELETE FROM offline_messages WHERE username = ?",
                 (username,)
             )
-            conn.commit()
-            conn.close()
             
             return messages
     
+    def add_file(self, path: str, size: int, sha256: Optional[str] = None):
+        now = datetime.now().isoformat()
+        with self.write() as cursor:
+            cursor.execute('''
+                INSERT INTO files (path, size, created_at, sha256, last_used) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET last_used = excluded.last_used
+            ''', (path, size, now, sha256, now))
+    
+    def reference_blob(self, sha256: str) -> Optional[str]:
+        # Chemin du fichier de cette empreinte, s'il est déjà stocké. Un envoi
+        # dédupliqué compte comme un usage: le fichier n'est ni orphelin ni
+        # expiré le temps que son message soit enregistré
+        with self.write() as cursor:
+            cursor.execute(
+                "UPDATE files SET last_used = ? WHERE sha256 = ?",
+                (datetime.now().isoformat(), sha256)
+            )
+            cursor.execute("SELECT path FROM files WHERE sha256 = ?", (sha256,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+    
+    def release_file(self, path: str, unused_since: float) -> bool:
+        # Oublie un fichier qu'aucun message ne désigne et qui n'a pas servi
+        # depuis unused_since (secondes). Vérification et suppression dans la
+        # même transaction d'écriture: un envoi dédupliqué ne peut pas s'y glisser
+        self.flush()
+        with self.write() as cursor:
+            cursor.execute("SELECT 1 FROM messages WHERE file_path = ? LIMIT 1", (path,))
+            if cursor.fetchone() is not None:
+                return False
+            cursor.execute("SELECT last_used FROM files WHERE path = ?", (path,))
+            row = cursor.fetchone()
+            if row is not None and row[0] and datetime.fromisoformat(row[0]).timestamp() >= unused_since:
+                return False
+            cursor.execute("DELETE FROM files WHERE path = ?", (path,))
+            return True
+    
+    def delete_file(self, path: str):
+        with self.write() as cursor:
+            cursor.execute("DELETE FROM files WHERE path = ?", (path,))
+    
+    def record_download(self, path: str, size: int):
+        now = datetime.now().isoformat()
+        with self.write() as cursor:
+            cursor.execute('''
+                INSERT INTO files (path, size, created_at, last_used) VALUES (?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET last_used = excluded.last_used
+            ''', (path, size, now, now))
+    
+    def file_last_used(self) -> Dict[str, float]:
+        # Chemin -> dernier usage, en secondes
+        with self.read() as cursor:
+            cursor.execute("SELECT path, COALESCE(last_used, created_at) FROM files")
+            return {
+                path: datetime.fromisoformat(used).timestamp()
+                for path, used in cursor.fetchall() if used
+            }
+    
+    def referenced_files(self) -> Set[str]:
+        # Fichiers désignés par au moins un message
+        self.flush()
+        with self.read() as cursor:
+            cursor.execute("SELECT DISTINCT file_path FROM messages WHERE file_path IS NOT NULL")
+            return {row[0] for row in cursor.fetchall()}
+    
+    def can_access_file(self, username: str, path: str) -> bool:
+        # Un fichier se télécharge depuis une conversation où il a été envoyé
+        self.flush()
+        with self.read() as cursor:
+            cursor.execute('''
+                SELECT 1 FROM messages
+                WHERE file_path = ?
+                AND (sender = ? OR recipient = ? OR conversation_key IN (
+                    SELECT group_id FROM group_members WHERE username = ?
+                ))
+                LIMIT 1
+            ''', (path, username, username, username))
+            return cursor.fetchone() is not None
+    
     def create_group(self, group: Group):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+        with self.write() as cursor:
+            # groups.members n'est plus renseignée: les membres sont dans group_members
             cursor.execute('''
-                INSERT INTO groups (group_id, name, created_by, created_at, members)
-                VALUES (?, ?, ?, ?, ?)
+                INSERT INTO groups (group_id, name, created_by, created_at)
+                VALUES (?, ?, ?, ?)
             ''', (
                 group.group_id,
                 group.name,
                 group.created_by,
-                group.created_at.isoformat(),
-                json.dumps(group.members)
+                group.created_at.isoformat()
             ))
-            conn.commit()
-            conn.close()
+            cursor.executemany(
+                "INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)",
+                [(group.group_id, member) for member in group.members]
+            )
+    
+    def add_group_member(self, group_id: str, username: str) -> bool:
+        with self.write() as cursor:
+            cursor.execute(
+                "INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)",
+                (group_id, username)
+            )
+            return cursor.rowcount > 0
+    
+    def remove_group_member(self, group_id: str, username: str) -> bool:
+        with self.write() as cursor:
+            cursor.execute(
+                "DELETE FROM group_members WHERE group_id = ? AND username = ?",
+                (group_id, username)
+            )
+            return cursor.rowcount > 0
+    
+    def get_group_members(self, group_id: str) -> List[str]:
+        with self.read() as cursor:
+            cursor.execute(
+                "SELECT username FROM group_members WHERE group_id = ? ORDER BY username",
+                (group_id,)
+            )
+            return [row[0] for row in cursor.fetchall()]
+    
+    def get_group(self, group_id: str) -> Optional[Group]:
+        with self.read() as cursor:
+            cursor.execute(
+                "SELECT name, created_by, created_at FROM groups WHERE group_id = ?",
+                (group_id,)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            
+            cursor.execute(
+                "SELECT username FROM group_members WHERE group_id = ? ORDER BY username",
+                (group_id,)
+            )
+            return Group(
+                name=row[0],
+                created_by=row[1],
+                group_id=group_id,
+                created_at=datetime.fromisoformat(row[2]),
+                members=[member for member, in cursor.fetchall()]
+            )
     
     def get_user_groups(self, username: str) -> List[Group]:
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM groups")
-            
-            groups = []
-            for row in cursor.fetchall():
-                members = json.loads(row[4])
-                if username in members:
-                    group = Group(
-                        name=row[1],
-                        created_by=row[2],
-                        group_id=row[0],
-                        created_at=datetime.fromisoformat(row[3]),
-                        members=members
+        with self.read() as cursor:
+            # Deux recherches par index: les groupes de l'utilisateur
+            # (idx_group_members_user) puis leurs membres (clé primaire)
+            cursor.execute('''
+                SELECT g.group_id, g.name, g.created_by, g.created_at, others.username
+                FROM group_members AS mine
+                JOIN groups AS g ON g.group_id = mine.group_id
+                JOIN group_members AS others ON others.group_id = mine.group_id
+                WHERE mine.username = ?
+                ORDER BY g.created_at, g.group_id, others.username
+            ''', (username,))
+            
+            groups: Dict[str, Group] = {}
+            for group_id, name, created_by, created_at, member in cursor.fetchall():
+                group = groups.get(group_id)
+                if group is None:
+                    group = groups[group_id] = Group(
+                        name=name,
+                        created_by=created_by,
+                        group_id=group_id,
+                        created_at=datetime.fromisoformat(created_at),
+                        members=[]
                     )
-                    groups.append(group)
+                group.members.append(member)
             
-            conn.close()
-            return groups
\ No newline at end of file
+            return list(groups.values())
\ No newline at end of file
@@ -0,0 +1,105 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+from protocol import Message, MessageType
+from models import conversation_key
+
+@dataclass
+class WorkerStats:
+    processed: int = 0
+    busy_time: float = 0.0
+    window_start: float = field(default_factory=time.perf_counter)
+    window_busy: float = 0.0
+
+def dispatch_key(sender: str, message: Message) -> str:
+    # Les messages qui partagent une clé sont traités dans l'ordre d'arrivée
+    if message.type in (MessageType.PRIVATE_MESSAGE, MessageType.TYPING_NOTIFICATION):
+        return conversation_key(sender, message.recipient or sender)
+    if message.type in (MessageType.GROUP_MESSAGE, MessageType.ADD_TO_GROUP,
+                        MessageType.REMOVE_FROM_GROUP):
+        return message.recipient or sender
+    if message.type in (MessageType.FILE_TRANSFER_REQUEST, MessageType.FILE_TRANSFER_ACCEPT,
+                        MessageType.FILE_TRANSFER_REJECT, MessageType.FILE_CHUNK,
+                        MessageType.FILE_CHUNK_ACK):
+        # Demande et morceaux d'un même fichier restent ensemble
+        if isinstance(message.content, dict) and "file_id" in message.content:
+            return message.content["file_id"]
+    return sender
+
+class Dispatcher:
+    # Remplace la file unique de Server: chaque worker a sa propre file et un
+    # message va toujours au worker choisi par le hachage de sa clé de
+    # conversation. Une conversation reste ordonnée, les autres avancent en
+    # parallèle.
+    def __init__(self, handler: Callable[[str, Message], None], num_workers=8,
+                 key_func: Callable[[str, Message], str] = dispatch_key):
+        self.handler = handler
+        self.key_func = key_func
+        self.queues: List[queue.Queue] = [queue.Queue() for _ in range(num_workers)]
+        self.stats: List[WorkerStats] = [WorkerStats() for _ in range(num_workers)]
+        self.stats_lock = threading.Lock()
+        self.threads: List[threading.Thread] = []
+    
+    def start(self):
+        for index in range(len(self.queues)):
+            thread = threading.Thread(target=self.worker, args=(index,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+    
+    def stop(self, timeout=5.0):
+        # Les messages déjà en file sont traités avant l'arrêt
+        for q in self.queues:
+            q.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(max(0.0, deadline - time.monotonic()))
+        self.threads = []
+    
+    def submit(self, sender: str, message: Message):
+        index = hash(self.key_func(sender, message)) % len(self.queues)
+        self.queues[index].put((sender, message))
+    
+    def worker(self, index: int):
+        q = self.queues[index]
+        stats = self.stats[index]
+        
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            
+            started = time.perf_counter()
+            try:
+                self.handler(*item)
+            except Exception as e:
+                print(f"Erreur dans le traitement de la file: {e}")
+            finally:
+                elapsed = time.perf_counter() - started
+                with self.stats_lock:
+                    stats.processed += 1
+                    stats.busy_time += elapsed
+                    stats.window_busy += elapsed
+    
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+    
+    def get_stats(self) -> List[Dict]:
+        # L'utilisation est mesurée depuis l'appel précédent
+        now = time.perf_counter()
+        result = []
+        with self.stats_lock:
+            for index, stats in enumerate(self.stats):
+                window = now - stats.window_start
+                result.append({
+                    "worker": index,
+                    "queue_depth": self.queues[index].qsize(),
+                    "processed": stats.processed,
+                    "utilization": stats.window_busy / window if window > 0 else 0.0
+                })
+                stats.window_start = now
+                stats.window_busy = 0.0
+        return result
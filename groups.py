@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from models import Group
+from database import Database
+
+class GroupRegistry:
+    # Cache des groupes adossé à la base: un groupe est chargé à sa première
+    # utilisation et seuls les max_groups plus récemment utilisés restent en
+    # mémoire. Le démarrage ne lit donc aucun groupe. Les identifiants qui ne
+    # sont pas des groupes (pseudos des messages privés) sont aussi gardés,
+    # avec None, pour ne pas interroger la base à chaque fois.
+    # Dernières invalidations retenues pour refuser un groupe lu avant elles
+    MAX_INVALIDATIONS = 1024
+    
+    def __init__(self, db: Database, max_groups=10000):
+        self.db = db
+        self.max_groups = max_groups
+        self.groups: "OrderedDict[str, Optional[Group]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Incrémenté à chaque invalidation; group_id -> génération de sa
+        # dernière invalidation
+        self.generation = 0
+        self.invalidated: "OrderedDict[str, int]" = OrderedDict()
+        # Génération la plus récente sortie de invalidated
+        self.forgotten = 0
+    
+    def get(self, group_id: str) -> Optional[Group]:
+        with self.lock:
+            if group_id in self.groups:
+                self.groups.move_to_end(group_id)
+                self.hits += 1
+                return self.groups[group_id]
+            self.misses += 1
+            generation = self.generation
+        
+        # Lecture hors du verrou: les autres groupes restent accessibles
+        group = self.db.get_group(group_id)
+        self.store(group_id, group, generation)
+        return group
+    
+    def put(self, group: Group, generation: Optional[int] = None):
+        # generation: valeur de self.generation avant la lecture en base du
+        # groupe; None pour un groupe qui vient d'être créé
+        self.store(group.group_id, group, generation)
+    
+    def store(self, group_id: str, group: Optional[Group], generation: Optional[int]):
+        with self.lock:
+            # Invalidé pendant la lecture: le groupe lu est peut-être périmé
+            if generation is not None and (self.invalidated.get(group_id, 0) > generation
+                                           or self.forgotten > generation):
+                return
+            self.groups[group_id] = group
+            self.groups.move_to_end(group_id)
+            while len(self.groups) > self.max_groups:
+                self.groups.popitem(last=False)
+    
+    def invalidate(self, group_id: str):
+        # Appelé après toute modification des membres: relu en base au prochain get()
+        with self.lock:
+            self.groups.pop(group_id, None)
+            self.generation += 1
+            self.invalidated[group_id] = self.generation
+            self.invalidated.move_to_end(group_id)
+            while len(self.invalidated) > self.MAX_INVALIDATIONS:
+                _, self.forgotten = self.invalidated.popitem(last=False)
+    
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "cached": sum(1 for group in self.groups.values() if group is not None),
+                "missing": sum(1 for group in self.groups.values() if group is None),
+                "hits": self.hits,
+                "misses": self.misses
+            }
\ No newline at end of file
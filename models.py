@@ -10,6 +10,8 @@ class User:
     status: str = "offline"
     last_seen: datetime = field(default_factory=datetime.now)
     address: Optional[tuple] = None
+    # Fonctionnalités du protocole négociées au LOGIN
+    features: List[str] = field(default_factory=list)
     # Le socket sera ajouté dynamiquement après la création
     
     def to_dict(self):
@@ -30,6 +32,9 @@ class Message:
     delivered: bool = False
     read: bool = False
     file_path: Optional[str] = None
+    # Renseignée pour les messages de groupe (id du groupe); sinon calculée
+    # à partir de la paire expéditeur/destinataire
+    conversation_key: Optional[str] = None
     
     def to_dict(self):
         return {
@@ -78,4 +83,11 @@ class Conversation:
 class OfflineMessage:
     username: str
     message: Message
-    stored_at: datetime = field(default_factory=datetime.now)
\ No newline at end of file
+    stored_at: datetime = field(default_factory=datetime.now)
+
+def conversation_key(user1: str, user2: str) -> str:
+    # Clé canonique d'une conversation: la paire triée pour un message privé,
+    # l'id du groupe (passé deux fois) pour un groupe
+    if user1 == user2:
+        return user1
+    return "\x1f".join(sorted((user1, user2)))
\ No newline at end of file
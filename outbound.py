@@ -0,0 +1,188 @@
+import queue
+import socket
+import threading
+from abc import ABC, abstractmethod
+from enum import Enum
+
+from protocol import Protocol, MessageType
+
+# Trames qu'on peut perdre sans dommage quand un client ne suit pas
+DROPPABLE_TYPES = {
+    MessageType.TYPING_NOTIFICATION,
+    MessageType.USER_STATUS,
+    MessageType.PING
+}
+
+class SlowConsumerPolicy(Enum):
+    # DROP: on jette d'abord les trames jetables, puis on déconnecte
+    DROP = "drop"
+    # DISCONNECT: on déconnecte dès que la file déborde
+    DISCONNECT = "disconnect"
+
+class OutboundQueue(ABC):
+    # File d'envoi bornée d'une connexion. send() ne bloque jamais: c'est
+    # l'écrivain propre à la connexion qui écrit réellement sur le socket, si
+    # bien qu'un client lent ne ralentit que lui-même.
+    def __init__(self, max_size=1024, policy=SlowConsumerPolicy.DROP, name=""):
+        self.max_size = max_size
+        self.policy = policy
+        self.name = name
+        self.pending = 0
+        self.dropped = 0
+        self.closed = False
+        self.lock = threading.Lock()
+    
+    def send(self, data: bytes, droppable=False) -> bool:
+        with self.lock:
+            if self.closed:
+                return False
+            
+            if (droppable and self.policy == SlowConsumerPolicy.DROP
+                    and self.pending >= self.max_size // 2):
+                self.dropped += 1
+                return False
+            
+            overflow = self.pending >= self.max_size
+            if not overflow:
+                self.pending += 1
+        
+        if overflow:
+            print(f"Client {self.name} trop lent ({self.pending} trames en attente), déconnexion")
+            self.abort()
+            return False
+        
+        self.push(data)
+        return True
+    
+    def sent(self):
+        with self.lock:
+            self.pending -= 1
+    
+    def close(self):
+        # Fermeture propre: l'écrivain envoie ce qui reste puis ferme
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.push(None)
+    
+    @abstractmethod
+    def push(self, data):
+        pass
+    
+    @abstractmethod
+    def abort(self):
+        pass
+
+class FileRegion:
+    # Plage d'un fichier stocké à envoyer en trames FILE_CHUNK binaires. Les
+    # données vont du fichier au socket par sendfile, sans passer par Python.
+    # L'écrivain envoie un morceau puis remet la plage en fin de file: les
+    # messages de discussion passent entre deux morceaux.
+    CHUNK_SIZE = 256 * 1024
+    
+    def __init__(self, file_id: str, path: str, offset: int, length: int, trailer=b''):
+        self.file_id = file_id
+        self.file = open(path, 'rb')
+        self.offset = offset
+        self.end = offset + length
+        self.chunk_number = 0
+        self.total_chunks = (length + self.CHUNK_SIZE - 1) // self.CHUNK_SIZE
+        # Trame envoyée après le dernier morceau (FILE_TRANSFER_COMPLETE)
+        self.trailer = trailer
+    
+    @property
+    def done(self) -> bool:
+        return self.offset >= self.end
+    
+    def next_chunk(self) -> tuple:
+        # (en-tête de la trame, position dans le fichier, nombre d'octets)
+        offset = self.offset
+        count = min(self.CHUNK_SIZE, self.end - offset)
+        header = Protocol.file_chunk_header(
+            self.file_id, self.chunk_number, self.total_chunks, count, offset
+        )
+        self.offset += count
+        self.chunk_number += 1
+        return header, offset, count
+    
+    def send_next(self, client_socket: socket.socket) -> bool:
+        # True s'il reste des morceaux à envoyer
+        try:
+            if not self.done:
+                header, offset, count = self.next_chunk()
+                client_socket.sendall(header)
+                if client_socket.sendfile(self.file, offset, count) != count:
+                    # La trame est déjà annoncée: la connexion est perdue
+                    raise OSError(f"Fichier tronqué pendant l'envoi de {self.file_id}")
+            if not self.done:
+                return True
+            client_socket.sendall(self.trailer)
+        finally:
+            if self.done:
+                self.close()
+        return False
+    
+    def close(self):
+        self.file.close()
+
+class SocketWriter(OutboundQueue):
+    # Version pour le serveur à threads: un thread écrivain par connexion
+    def __init__(self, client_socket: socket.socket, max_size=1024,
+                 policy=SlowConsumerPolicy.DROP, name=""):
+        super().__init__(max_size, policy, name)
+        self.client_socket = client_socket
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+    
+    def push(self, data):
+        self.queue.put(data)
+    
+    def writer(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            requeue = False
+            try:
+                if isinstance(data, FileRegion):
+                    requeue = data.send_next(self.client_socket)
+                else:
+                    self.client_socket.sendall(data)
+            except OSError:
+                if isinstance(data, FileRegion):
+                    data.close()
+                self.abort()
+                break
+            finally:
+                if requeue:
+                    self.queue.put(data)
+                else:
+                    self.sent()
+        
+        # Ce qui reste en file ne partira plus: les fichiers des plages sont fermés
+        while True:
+            try:
+                data = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(data, FileRegion):
+                data.close()
+        
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.client_socket.close()
+    
+    def abort(self):
+        # shutdown() débloque aussi bien un sendall() en cours que le recv()
+        # du thread de lecture, qui se charge alors de la déconnexion
+        with self.lock:
+            self.closed = True
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.queue.put(None)
@@ -0,0 +1,172 @@
+import struct
+
+# Sérialisation au format MessagePack pour le codec compact du protocole.
+# On utilise le module msgpack s'il est installé; sinon cette implémentation
+# du sous-ensemble utile (nil, booléens, entiers, flottants, str, bin,
+# listes, dictionnaires) produit exactement les mêmes octets.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def pack_into(obj, out: list):
+    if obj is None:
+        out.append(b'\xc0')
+    elif obj is True:
+        out.append(b'\xc3')
+    elif obj is False:
+        out.append(b'\xc2')
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(bytes((obj,)))
+        elif -32 <= obj < 0:
+            out.append(bytes((obj & 0xff,)))
+        elif obj >= 0:
+            if obj <= 0xff:
+                out.append(struct.pack('!BB', 0xcc, obj))
+            elif obj <= 0xffff:
+                out.append(struct.pack('!BH', 0xcd, obj))
+            elif obj <= 0xffffffff:
+                out.append(struct.pack('!BI', 0xce, obj))
+            else:
+                out.append(struct.pack('!BQ', 0xcf, obj))
+        else:
+            if obj >= -0x80:
+                out.append(struct.pack('!Bb', 0xd0, obj))
+            elif obj >= -0x8000:
+                out.append(struct.pack('!Bh', 0xd1, obj))
+            elif obj >= -0x80000000:
+                out.append(struct.pack('!Bi', 0xd2, obj))
+            else:
+                out.append(struct.pack('!Bq', 0xd3, obj))
+    elif isinstance(obj, float):
+        out.append(struct.pack('!Bd', 0xcb, obj))
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        length = len(data)
+        if length < 32:
+            out.append(bytes((0xa0 | length,)))
+        elif length <= 0xff:
+            out.append(struct.pack('!BB', 0xd9, length))
+        elif length <= 0xffff:
+            out.append(struct.pack('!BH', 0xda, length))
+        else:
+            out.append(struct.pack('!BI', 0xdb, length))
+        out.append(data)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        length = len(obj)
+        if length <= 0xff:
+            out.append(struct.pack('!BB', 0xc4, length))
+        elif length <= 0xffff:
+            out.append(struct.pack('!BH', 0xc5, length))
+        else:
+            out.append(struct.pack('!BI', 0xc6, length))
+        out.append(bytes(obj))
+    elif isinstance(obj, (list, tuple)):
+        length = len(obj)
+        if length < 16:
+            out.append(bytes((0x90 | length,)))
+        elif length <= 0xffff:
+            out.append(struct.pack('!BH', 0xdc, length))
+        else:
+            out.append(struct.pack('!BI', 0xdd, length))
+        for item in obj:
+            pack_into(item, out)
+    elif isinstance(obj, dict):
+        length = len(obj)
+        if length < 16:
+            out.append(bytes((0x80 | length,)))
+        elif length <= 0xffff:
+            out.append(struct.pack('!BH', 0xde, length))
+        else:
+            out.append(struct.pack('!BI', 0xdf, length))
+        for key, value in obj.items():
+            pack_into(key, out)
+            pack_into(value, out)
+    else:
+        raise TypeError(f"Type non sérialisable: {type(obj).__name__}")
+
+# Préfixe -> (format struct de la longueur ou de la valeur, taille)
+SIZED = {
+    0xcc: ('!B', 1), 0xcd: ('!H', 2), 0xce: ('!I', 4), 0xcf: ('!Q', 8),
+    0xd0: ('!b', 1), 0xd1: ('!h', 2), 0xd2: ('!i', 4), 0xd3: ('!q', 8),
+    0xca: ('!f', 4), 0xcb: ('!d', 8),
+    0xd9: ('!B', 1), 0xda: ('!H', 2), 0xdb: ('!I', 4),
+    0xc4: ('!B', 1), 0xc5: ('!H', 2), 0xc6: ('!I', 4),
+    0xdc: ('!H', 2), 0xdd: ('!I', 4),
+    0xde: ('!H', 2), 0xdf: ('!I', 4)
+}
+STRINGS = {0xd9, 0xda, 0xdb}
+BINARIES = {0xc4, 0xc5, 0xc6}
+ARRAYS = {0xdc, 0xdd}
+MAPS = {0xde, 0xdf}
+
+def unpack_from(data, offset: int):
+    # Renvoie (valeur, position suivante)
+    prefix = data[offset]
+    offset += 1
+    
+    if prefix < 0x80:
+        return prefix, offset
+    if prefix >= 0xe0:
+        return prefix - 0x100, offset
+    if 0xa0 <= prefix <= 0xbf:
+        end = offset + (prefix & 0x1f)
+        return str(data[offset:end], 'utf-8'), end
+    if 0x90 <= prefix <= 0x9f:
+        return unpack_array(data, offset, prefix & 0x0f)
+    if 0x80 <= prefix <= 0x8f:
+        return unpack_map(data, offset, prefix & 0x0f)
+    if prefix == 0xc0:
+        return None, offset
+    if prefix == 0xc2:
+        return False, offset
+    if prefix == 0xc3:
+        return True, offset
+    
+    if prefix not in SIZED:
+        raise ValueError(f"Préfixe MessagePack non supporté: {prefix:#x}")
+    fmt, size = SIZED[prefix]
+    value = struct.unpack_from(fmt, data, offset)[0]
+    offset += size
+    
+    if prefix in STRINGS:
+        end = offset + value
+        return str(data[offset:end], 'utf-8'), end
+    if prefix in BINARIES:
+        end = offset + value
+        return bytes(data[offset:end]), end
+    if prefix in ARRAYS:
+        return unpack_array(data, offset, value)
+    if prefix in MAPS:
+        return unpack_map(data, offset, value)
+    return value, offset
+
+def unpack_array(data, offset: int, length: int):
+    items = []
+    for _ in range(length):
+        item, offset = unpack_from(data, offset)
+        items.append(item)
+    return items, offset
+
+def unpack_map(data, offset: int, length: int):
+    result = {}
+    for _ in range(length):
+        key, offset = unpack_from(data, offset)
+        result[key], offset = unpack_from(data, offset)
+    return result, offset
+
+def packb(obj) -> bytes:
+    if msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=True)
+    out = []
+    pack_into(obj, out)
+    return b''.join(out)
+
+def unpackb(data):
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    value, offset = unpack_from(data, 0)
+    if offset != len(data):
+        raise ValueError("Données MessagePack en trop")
+    return value
\ No newline at end of file
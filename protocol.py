@@ -1,9 +1,19 @@
+import asyncio
 import json
 import struct
 import os
+import zlib
 from enum import Enum
-from dataclasses import dataclass, asdict
-from typing import Optional, Any, Dict, List
+from dataclasses import dataclass, asdict, field
+from typing import Optional, Any, Dict, List, Iterator, AsyncIterator
+
+import packing
+from packing import packb, unpackb
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
 
 class MessageType(Enum):
     LOGIN = "login"
@@ -18,11 +28,16 @@ class MessageType(Enum):
     GROUP_CREATED = "group_created"
     GROUP_LIST = "group_list"
     ADD_TO_GROUP = "add_to_group"
+    REMOVE_FROM_GROUP = "remove_from_group"
     FILE_TRANSFER_REQUEST = "file_transfer_request"
     FILE_TRANSFER_ACCEPT = "file_transfer_accept"
     FILE_TRANSFER_REJECT = "file_transfer_reject"
     FILE_CHUNK = "file_chunk"
     FILE_TRANSFER_COMPLETE = "file_transfer_complete"
+    FILE_CHUNK_ACK = "file_chunk_ack"
+    FILE_TRANSFER_RESUME = "file_transfer_resume"
+    FILE_DOWNLOAD_REQUEST = "file_download_request"
+    FILE_DOWNLOAD_RESPONSE = "file_download_response"
     HISTORY_REQUEST = "history_request"
     HISTORY_RESPONSE = "history_response"
     TYPING_NOTIFICATION = "typing_notification"
@@ -31,6 +46,8 @@ class MessageType(Enum):
     ERROR = "error"
     PING = "ping"
     PONG = "pong"
+    # Interne: routage entre processus du serveur multi-processus
+    WORKER_ROUTE = "worker_route"
 
 @dataclass
 class Message:
@@ -41,8 +58,8 @@ class Message:
     timestamp: Optional[str] = None
     message_id: Optional[str] = None
     
-    def to_json(self) -> bytes:
-        data = {
+    def to_dict(self) -> Dict[str, Any]:
+        return {
             "type": self.type.value,
             "sender": self.sender,
             "recipient": self.recipient,
@@ -50,48 +67,406 @@ class Message:
             "timestamp": self.timestamp,
             "message_id": self.message_id
         }
-        json_str = json.dumps(data, ensure_ascii=False)
+    
+    def to_json(self) -> bytes:
+        json_str = json.dumps(self.to_dict(), ensure_ascii=False)
         return json_str.encode('utf-8')
     
     @classmethod
-    def from_json(cls, data: bytes):
-        json_str = data.decode('utf-8')
-        data_dict = json.loads(json_str)
+    def from_dict(cls, data_dict: Dict[str, Any]):
+        data_dict = dict(data_dict)
         data_dict["type"] = MessageType(data_dict["type"])
         return cls(**data_dict)
+    
+    @classmethod
+    def from_json(cls, data: bytes):
+        json_str = data.decode('utf-8')
+        return cls.from_dict(json.loads(json_str))
+
+class JsonCodec:
+    name = "json"
+    
+    @staticmethod
+    def encode(message: Message) -> bytes:
+        return message.to_json()
+    
+    @staticmethod
+    def decode(data) -> Message:
+        return Message.from_json(bytes(data))
+
+class CompactCodec:
+    # Octet de type, étiquette entière du MessageType puis les champs en
+    # MessagePack, par position: ni noms de clés ni valeurs d'enum en texte
+    name = "compact"
+    FRAME_KIND = 0x02
+    
+    # Étiquettes figées: ne jamais renuméroter, seulement en ajouter
+    TYPE_TAGS = {
+        MessageType.LOGIN: 1,
+        MessageType.LOGIN_RESPONSE: 2,
+        MessageType.LOGOUT: 3,
+        MessageType.USER_LIST: 4,
+        MessageType.USER_STATUS: 5,
+        MessageType.PRIVATE_MESSAGE: 6,
+        MessageType.GROUP_MESSAGE: 7,
+        MessageType.MESSAGE_RESPONSE: 8,
+        MessageType.CREATE_GROUP: 9,
+        MessageType.GROUP_CREATED: 10,
+        MessageType.GROUP_LIST: 11,
+        MessageType.ADD_TO_GROUP: 12,
+        MessageType.FILE_TRANSFER_REQUEST: 13,
+        MessageType.FILE_TRANSFER_ACCEPT: 14,
+        MessageType.FILE_TRANSFER_REJECT: 15,
+        MessageType.FILE_CHUNK: 16,
+        MessageType.FILE_TRANSFER_COMPLETE: 17,
+        MessageType.HISTORY_REQUEST: 18,
+        MessageType.HISTORY_RESPONSE: 19,
+        MessageType.TYPING_NOTIFICATION: 20,
+        MessageType.MESSAGE_DELIVERED: 21,
+        MessageType.MESSAGE_READ: 22,
+        MessageType.ERROR: 23,
+        MessageType.PING: 24,
+        MessageType.PONG: 25,
+        MessageType.WORKER_ROUTE: 26,
+        MessageType.REMOVE_FROM_GROUP: 27,
+        MessageType.FILE_CHUNK_ACK: 28,
+        MessageType.FILE_TRANSFER_RESUME: 29,
+        MessageType.FILE_DOWNLOAD_REQUEST: 30,
+        MessageType.FILE_DOWNLOAD_RESPONSE: 31
+    }
+    TYPES = {tag: message_type for message_type, tag in TYPE_TAGS.items()}
+    
+    @staticmethod
+    def encode(message: Message) -> bytes:
+        header = bytes((CompactCodec.FRAME_KIND, CompactCodec.TYPE_TAGS[message.type]))
+        return header + packb([
+            message.sender,
+            message.recipient,
+            message.content,
+            message.timestamp,
+            message.message_id
+        ])
+    
+    @staticmethod
+    def decode(data) -> Message:
+        sender, recipient, content, timestamp, message_id = unpackb(data[2:])
+        return Message(
+            type=CompactCodec.TYPES[data[1]],
+            sender=sender,
+            recipient=recipient,
+            content=content,
+            timestamp=timestamp,
+            message_id=message_id
+        )
 
 class Protocol:
     HEADER_SIZE = 4
+    # Au-delà, la trame est refusée et la connexion fermée
+    MAX_FRAME_SIZE = 16 * 1024 * 1024
+    
+    # Fonctionnalités proposées par le client dans LOGIN; le serveur répond
+    # avec celles qu'il accepte et chacun s'en tient à l'encodage JSON sinon
+    FEATURE_BINARY_CHUNKS = "binary_chunks"
+    FEATURE_COMPACT = CompactCodec.name
+    FEATURE_ZLIB = "zlib"
+    FEATURE_ZSTD = "zstd"
+    # Morceaux relayés en direct au destinataire et acquittés (FILE_CHUNK_ACK)
+    FEATURE_FILE_RELAY = "file_relay"
+    # Le serveur répond à FILE_TRANSFER_REQUEST par les plages encore
+    # attendues (FILE_TRANSFER_RESUME): un envoi interrompu reprend là où il
+    # s'était arrêté
+    FEATURE_FILE_RESUME = "file_resume"
+    # Dossiers envoyés comme une archive tar produite et extraite au fil de
+    # l'eau (archive.py), en relais direct seulement
+    FEATURE_DIRECTORY = "directory"
+    # Sans le module msgpack, le codec compact en pur Python est plus lent
+    # que json sur les gros messages: on sait le lire mais on ne le propose pas
+    FEATURES = tuple(
+        feature for feature, available in (
+            (FEATURE_BINARY_CHUNKS, True),
+            (FEATURE_FILE_RELAY, True),
+            (FEATURE_FILE_RESUME, True),
+            (FEATURE_DIRECTORY, True),
+            (FEATURE_COMPACT, packing.msgpack is not None),
+            (FEATURE_ZSTD, zstd is not None),
+            (FEATURE_ZLIB, True)
+        )
+        if available
+    )
+    
+    # Une trame JSON commence toujours par '{'; les trames binaires
+    # commencent par un octet de type (0x02: CompactCodec)
+    FRAME_FILE_CHUNK = 0x01
+    # type, drapeaux, longueur du file_id, numéro du morceau, nombre de morceaux
+    CHUNK_HEADER = struct.Struct('!BBBII')
+    # Drapeau: la position du morceau dans le fichier suit l'en-tête
+    CHUNK_FLAG_OFFSET = 0x01
+    CHUNK_OFFSET = struct.Struct('!Q')
+    
+    # Trame compressée: type, octet d'algorithme puis la trame d'origine
+    # (JSON ou compacte) compressée
+    FRAME_COMPRESSED = 0x03
+    COMPRESSION_ALGORITHMS = {FEATURE_ZLIB: 1, FEATURE_ZSTD: 2}
+    # Les petites trames de discussion ne gagnent rien à être compressées
+    COMPRESSION_THRESHOLD = 1024
+    ZLIB_LEVEL = 6
+    ZSTD_LEVEL = 3
+    
+    @staticmethod
+    def codec_for(features=()):
+        if Protocol.FEATURE_COMPACT in features:
+            return CompactCodec
+        return JsonCodec
+    
+    @staticmethod
+    def compression_for(features=()) -> Optional[str]:
+        if Protocol.FEATURE_ZSTD in features and zstd is not None:
+            return Protocol.FEATURE_ZSTD
+        if Protocol.FEATURE_ZLIB in features:
+            return Protocol.FEATURE_ZLIB
+        return None
+    
+    @staticmethod
+    def encoding_for(features=()) -> tuple:
+        # Deux destinataires avec le même encodage reçoivent les mêmes octets
+        return Protocol.codec_for(features), Protocol.compression_for(features)
     
     @staticmethod
-    def pack_message(message: Message) -> bytes:
-        message_data = message.to_json()
+    def compress(data: bytes, algorithm: str) -> bytes:
+        if algorithm == Protocol.FEATURE_ZSTD:
+            compressed = zstd.ZstdCompressor(level=Protocol.ZSTD_LEVEL).compress(data)
+        else:
+            compressed = zlib.compress(data, Protocol.ZLIB_LEVEL)
+        header = bytes((Protocol.FRAME_COMPRESSED, Protocol.COMPRESSION_ALGORITHMS[algorithm]))
+        return header + compressed
+    
+    @staticmethod
+    def decompress(data, max_size=MAX_FRAME_SIZE) -> bytes:
+        algorithm = data[1]
+        if algorithm == Protocol.COMPRESSION_ALGORITHMS[Protocol.FEATURE_ZSTD]:
+            if zstd is None:
+                raise ValueError("Trame zstd reçue sans le module zstandard")
+            return zstd.ZstdDecompressor().decompress(data[2:], max_output_size=max_size)
+        if algorithm != Protocol.COMPRESSION_ALGORITHMS[Protocol.FEATURE_ZLIB]:
+            raise ValueError(f"Algorithme de compression inconnu: {algorithm}")
+        
+        # Taille décompressée bornée comme celle d'une trame normale
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data[2:], max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Trame décompressée trop grande")
+        return result
+    
+    @staticmethod
+    def pack_message(message: Message, features=()) -> bytes:
+        # features: celles négociées avec le destinataire (JSON par défaut)
+        codec, compression = Protocol.encoding_for(features)
+        message_data = codec.encode(message)
+        if compression and len(message_data) >= Protocol.COMPRESSION_THRESHOLD:
+            compressed = Protocol.compress(message_data, compression)
+            if len(compressed) < len(message_data):
+                message_data = compressed
         message_length = len(message_data)
         header = struct.pack('!I', message_length)
         return header + message_data
     
     @staticmethod
-    def unpack_message(socket) -> Optional[Message]:
+    def pack_file_chunk(file_id: str, chunk_number: int, total_chunks: int, data: bytes,
+                        offset: Optional[int] = None) -> bytes:
+        # Les données du fichier partent telles quelles, sans hex ni JSON
+        return Protocol.file_chunk_header(file_id, chunk_number, total_chunks, len(data), offset) + data
+    
+    @staticmethod
+    def file_chunk_header(file_id: str, chunk_number: int, total_chunks: int, data_length: int,
+                          offset: Optional[int] = None) -> bytes:
+        # Tout ce qui précède les données d'une trame FILE_CHUNK binaire: les
+        # données peuvent ainsi suivre directement depuis le fichier (sendfile)
+        file_id_bytes = file_id.encode('utf-8')
+        flags = 0
+        position = b''
+        if offset is not None:
+            flags = Protocol.CHUNK_FLAG_OFFSET
+            position = Protocol.CHUNK_OFFSET.pack(offset)
+        header = Protocol.CHUNK_HEADER.pack(
+            Protocol.FRAME_FILE_CHUNK, flags, len(file_id_bytes), chunk_number, total_chunks
+        )
+        length = len(header) + len(position) + len(file_id_bytes) + data_length
+        return b''.join((struct.pack('!I', length), header, position, file_id_bytes))
+    
+    @staticmethod
+    def decode_frame(data, max_frame_size=MAX_FRAME_SIZE) -> Message:
+        # Les trames se décrivent elles-mêmes: pas besoin de connaître les
+        # fonctionnalités négociées pour les lire. max_frame_size borne aussi
+        # la taille d'une trame une fois décompressée.
+        kind = data[0]
+        if kind == Protocol.FRAME_COMPRESSED:
+            data = Protocol.decompress(data, max_frame_size)
+            # Une seule couche de compression
+            if not data or data[0] == Protocol.FRAME_COMPRESSED:
+                raise ValueError("Trame compressée invalide")
+            kind = data[0]
+        if kind == CompactCodec.FRAME_KIND:
+            return CompactCodec.decode(data)
+        if kind != Protocol.FRAME_FILE_CHUNK:
+            return JsonCodec.decode(data)
+        
+        _, flags, id_length, chunk_number, total_chunks = Protocol.CHUNK_HEADER.unpack_from(data)
+        start = Protocol.CHUNK_HEADER.size
+        content = {"chunk_number": chunk_number, "total_chunks": total_chunks}
+        if flags & Protocol.CHUNK_FLAG_OFFSET:
+            content["offset"] = Protocol.CHUNK_OFFSET.unpack_from(data, start)[0]
+            start += Protocol.CHUNK_OFFSET.size
+        content["file_id"] = bytes(data[start:start + id_length]).decode('utf-8')
+        content["data"] = bytes(data[start + id_length:])
+        # L'expéditeur est celui de la connexion, comme pour toute trame reçue
+        return Message(type=MessageType.FILE_CHUNK, sender="", content=content)
+    
+    @staticmethod
+    def chunk_bytes(content: dict) -> bytes:
+        # Morceau reçu en trame binaire (bytes) ou en JSON (hex)
+        data = content["data"]
+        return data if isinstance(data, bytes) else bytes.fromhex(data)
+    
+    @staticmethod
+    def recv_exactly(socket, size: int) -> Optional[bytearray]:
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            count = socket.recv_into(view[received:])
+            if not count:
+                return None
+            received += count
+        return data
+    
+    @staticmethod
+    def unpack_message(socket, max_frame_size=MAX_FRAME_SIZE) -> Optional[Message]:
+        # Lit une seule trame sans rien consommer au-delà (poignée de main);
+        # pour un flux continu, utiliser FrameDecoder
         try:
-            header = socket.recv(Protocol.HEADER_SIZE)
-            if not header:
+            header = Protocol.recv_exactly(socket, Protocol.HEADER_SIZE)
+            if header is None:
                 return None
             
             message_length = struct.unpack('!I', header)[0]
+            if message_length > max_frame_size:
+                raise ValueError(f"Trame trop grande ({message_length} octets)")
             
-            message_data = b''
-            remaining = message_length
-            while remaining > 0:
-                chunk = socket.recv(min(remaining, 4096))
-                if not chunk:
-                    return None
-                message_data += chunk
-                remaining -= len(chunk)
+            message_data = Protocol.recv_exactly(socket, message_length)
+            if message_data is None:
+                return None
             
-            return Message.from_json(message_data)
+            return Protocol.decode_frame(message_data, max_frame_size)
         except Exception as e:
             print(f"Erreur unpack_message: {e}")
             return None
+    
+    @staticmethod
+    async def unpack_message_async(reader, max_frame_size=MAX_FRAME_SIZE) -> Optional[Message]:
+        # Équivalent de unpack_message pour un asyncio.StreamReader
+        try:
+            header = await reader.readexactly(Protocol.HEADER_SIZE)
+            message_length = struct.unpack('!I', header)[0]
+            if message_length > max_frame_size:
+                raise ValueError(f"Trame trop grande ({message_length} octets)")
+            message_data = await reader.readexactly(message_length)
+            return Protocol.decode_frame(message_data, max_frame_size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        except Exception as e:
+            print(f"Erreur unpack_message_async: {e}")
+            return None
+
+class FrameDecoder:
+    # Lecture d'un flux de trames: recv_into dans un tampon réutilisé, autant
+    # de trames que possible par appel système, et des memoryview sur le
+    # tampon au lieu de copies. Une memoryview rendue n'est valable que
+    # jusqu'à la lecture suivante. Le tampon grandit pour une grosse trame et
+    # reprend sa taille initiale une fois vidé.
+    def __init__(self, max_frame_size=Protocol.MAX_FRAME_SIZE, buffer_size=65536):
+        self.max_frame_size = max_frame_size
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # Données reçues et pas encore rendues: buffer[start:end]
+        self.start = 0
+        self.end = 0
+    
+    def frames(self) -> Iterator[memoryview]:
+        # Trames complètes déjà dans le tampon
+        header_size = Protocol.HEADER_SIZE
+        while self.end - self.start >= header_size:
+            length = struct.unpack_from('!I', self.buffer, self.start)[0]
+            if length > self.max_frame_size:
+                raise ValueError(f"Trame trop grande ({length} octets)")
+            frame_end = self.start + header_size + length
+            if frame_end > self.end:
+                self.reserve(header_size + length)
+                return
+            frame = self.view[self.start + header_size:frame_end]
+            self.start = frame_end
+            yield frame
+    
+    def reserve(self, size: int):
+        # Garantit la place pour une trame de size octets à partir de start
+        pending = self.end - self.start
+        if size > len(self.buffer):
+            # Nouveau tampon plutôt que resize: des memoryview peuvent encore
+            # pointer sur l'ancien
+            buffer = bytearray(max(size, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start + size > len(self.buffer):
+            self.view[:pending] = self.view[self.start:self.end]
+        else:
+            return
+        self.start = 0
+        self.end = pending
+    
+    def drained(self):
+        # Tout a été rendu: on repart du début, avec le tampon initial s'il
+        # a grandi (une connexion inactive ne garde pas 16 Mo)
+        self.start = self.end = 0
+        if len(self.buffer) > self.buffer_size:
+            self.buffer = bytearray(self.buffer_size)
+            self.view = memoryview(self.buffer)
+    
+    def recv(self, socket) -> int:
+        if self.start == self.end:
+            self.drained()
+        elif self.end == len(self.buffer):
+            self.reserve(self.end - self.start + 1)
+        count = socket.recv_into(self.view[self.end:])
+        self.end += count
+        return count
+    
+    def feed(self, data: bytes):
+        # Pour les flux sans recv_into (asyncio.StreamReader): copie data
+        # à la suite des données en attente
+        if self.start == self.end:
+            self.drained()
+        self.reserve(self.end - self.start + len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+    
+    def messages(self, socket) -> Iterator[Message]:
+        # Messages décodés jusqu'à la fermeture de la connexion
+        while True:
+            for frame in self.frames():
+                yield Protocol.decode_frame(frame, self.max_frame_size)
+            if not self.recv(socket):
+                return
+    
+    async def messages_async(self, reader) -> AsyncIterator[Message]:
+        # Équivalent de messages() pour un asyncio.StreamReader
+        while True:
+            for frame in self.frames():
+                yield Protocol.decode_frame(frame, self.max_frame_size)
+            data = await reader.read(max(len(self.buffer) - self.end, self.buffer_size))
+            if not data:
+                return
+            self.feed(data)
 
 @dataclass
 class FileTransfer:
@@ -104,4 +479,16 @@ class FileTransfer:
     chunk_size: int = 8192
     is_directory: bool = False
     total_chunks: int = 0
-    chunks_received: int = 0
\ No newline at end of file
+    chunks_received: int = 0
+    chunks_acked: int = 0
+    bytes_received: int = 0
+    bytes_sent: int = 0
+    # Relais direct (destinataire connecté) plutôt que stockage sur le serveur
+    relay: bool = False
+    accepted: bool = False
+    # Morceaux reçus avant que le destinataire n'accepte
+    pending: List[dict] = field(default_factory=list)
+    # storage.PartialFile du fichier stocké sur le serveur
+    partial: Any = None
+    # Plages [début, fin) à envoyer, reçues dans FILE_TRANSFER_RESUME
+    missing: Optional[List[List[int]]] = None
\ No newline at end of file
@@ -5,33 +5,63 @@ import json
 import os
 import hashlib
 import queue
+import re
 import time
 from typing import Dict, Optional
 
-from protocol import Protocol, Message, MessageType, FileTransfer
+from protocol import Protocol, Message, MessageType, FileTransfer, FrameDecoder
 from models import User, Message as ChatMessage, Group
 from database import Database
+from outbound import SocketWriter, SlowConsumerPolicy, DROPPABLE_TYPES, FileRegion
+from dispatcher import Dispatcher
+from groups import GroupRegistry
+from storage import PartialFile, ContentStore, StorageJanitor
+from transfers import TransferManager, TransferState
 
 class Server:
-    def __init__(self, host='0.0.0.0', port=8888):
+    MAX_HISTORY_PAGE = 500
+    # Messages par trame HISTORY_RESPONSE
+    HISTORY_BATCH_SIZE = 25
+    # Morceaux gardés en mémoire en attendant que le destinataire accepte;
+    # l'expéditeur en envoie au plus sa fenêtre sans accusé de réception
+    MAX_PENDING_CHUNKS = 64
+    # Recherche des transferts inactifs (secondes)
+    TRANSFER_REAP_INTERVAL = 30
+    # Le file_id entre dans le nom du fichier stocké: ni séparateur, ni
+    # point, ni "_" (qui le sépare du nom)
+    FILE_ID_PATTERN = re.compile(r"[0-9A-Za-z-]{1,64}")
+    
+    def __init__(self, host='0.0.0.0', port=8888, send_queue_size=1024,
+                 slow_consumer_policy=SlowConsumerPolicy.DROP, dispatch_workers=8,
+                 database: Optional[Database] = None, group_cache_size=10000,
+                 max_frame_size=Protocol.MAX_FRAME_SIZE,
+                 transfers: Optional[TransferManager] = None,
+                 janitor: Optional[StorageJanitor] = None):
         self.host = host
         self.port = port
+        self.send_queue_size = send_queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.max_frame_size = max_frame_size
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         
         self.clients: Dict[str, User] = {}
-        self.client_sockets: Dict[str, socket.socket] = {}
+        # File d'envoi de chaque client (SocketWriter ou équivalent asyncio)
+        self.client_sockets: Dict[str, SocketWriter] = {}
         self.connections: Dict[socket.socket, str] = {}
-        self.groups: Dict[str, Group] = {}
         
         self.clients_lock = threading.Lock()
-        self.groups_lock = threading.Lock()
         
-        self.db = Database()
-        self.file_transfers: Dict[str, FileTransfer] = {}
-        self.file_transfer_lock = threading.Lock()
+        # Passer par exemple Database(write_behind=True) pour écrire par lots
+        self.db = database or Database()
+        self.groups = GroupRegistry(self.db, group_cache_size)
+        self.store = ContentStore(self.db)
+        # Quotas et délai d'inactivité des transferts: TransferManager(...)
+        self.transfers = transfers if transfers is not None else TransferManager()
+        # Budgets de place et d'âge de storage/: StorageJanitor(...)
+        self.janitor = janitor or StorageJanitor()
         
-        self.message_queue = queue.Queue()
+        self.dispatcher = Dispatcher(self.handle_message, dispatch_workers)
         self.running = True
         
         # Créer le dossier de stockage des fichiers
@@ -43,8 +73,10 @@ class Server:
             self.server_socket.listen(5)
             print(f"Serveur démarré sur {self.host}:{self.port}")
             
-            threading.Thread(target=self.process_message_queue, daemon=True).start()
+            self.dispatcher.start()
             threading.Thread(target=self.ping_clients, daemon=True).start()
+            threading.Thread(target=self.reap_transfers, daemon=True).start()
+            threading.Thread(target=self.clean_storage, daemon=True).start()
             
             while self.running:
                 try:
@@ -67,39 +99,65 @@ class Server:
     
     def stop(self):
         self.running = False
+        self.janitor.stop()
+        self.dispatcher.stop()
         for username in list(self.clients.keys()):
             self.disconnect_client(username)
         
+        # Rien du journal write-behind ne doit être perdu à l'arrêt
+        self.db.flush()
+        
         if self.server_socket:
             self.server_socket.close()
         print("Serveur arrêté")
     
     def handle_client(self, client_socket: socket.socket, address: tuple):
+        username = None
         try:
-            message = Protocol.unpack_message(client_socket)
+            messages = FrameDecoder(self.max_frame_size).messages(client_socket)
+            message = next(messages, None)
             if not message or message.type != MessageType.LOGIN:
                 client_socket.close()
                 return
             
-            username = message.content.get("username")
+            outbound = SocketWriter(
+                client_socket,
+                self.send_queue_size,
+                self.slow_consumer_policy,
+                name=str(address)
+            )
+            username = self.register_client(outbound, address, message)
+            if not username:
+                return
             
-            with self.clients_lock:
-                if username in self.clients:
-                    response = Message(
-                        type=MessageType.LOGIN_RESPONSE,
-                        sender="server",
-                        content={"success": False, "error": "Pseudo déjà utilisé"}
-                    )
-                    client_socket.send(Protocol.pack_message(response))
-                    client_socket.close()
-                    return
-                
+            try:
+                for message in messages:
+                    if not self.running:
+                        break
+                    self.dispatcher.submit(username, message)
+            except Exception as e:
+                print(f"Erreur lors de la réception du message de {username}: {e}")
+        
+        except Exception as e:
+            print(f"Erreur avec le client {address}: {e}")
+        finally:
+            self.disconnect_client(username)
+    
+    def register_client(self, client_socket, address: tuple, message: Message) -> Optional[str]:
+        # Partagé avec AsyncServer: client_socket n'a besoin que de send() et close()
+        username = message.content.get("username")
+        features = [f for f in message.content.get("features", []) if f in Protocol.FEATURES]
+        
+        with self.clients_lock:
+            taken = self.is_online(username)
+            if not taken:
                 user = User(
                     username=username,
                     connection_id=str(address),
                     status="online",
                     last_seen=datetime.now(),
-                    address=address
+                    address=address,
+                    features=features
                 )
                 user.socket = client_socket
                 
@@ -109,50 +167,43 @@ class Server:
                 
                 self.db.add_user(username)
                 self.db.update_user_status(username, "online")
-            
-            print(f"Utilisateur {username} connecté depuis {address}")
-            
+        
+        if taken:
             response = Message(
                 type=MessageType.LOGIN_RESPONSE,
                 sender="server",
-                content={
-                    "success": True,
-                    "username": username,
-                    "users": self.get_users_list()
-                }
+                content={"success": False, "error": "Pseudo déjà utilisé"}
             )
             client_socket.send(Protocol.pack_message(response))
-            
-            self.send_offline_messages(username)
-            self.send_groups_list(username)
-            self.broadcast_user_status(username, "online")
-            
-            while self.running:
-                try:
-                    message = Protocol.unpack_message(client_socket)
-                    if not message:
-                        break
-                    
-                    self.message_queue.put((username, message))
-                    
-                except Exception as e:
-                    print(f"Erreur lors de la réception du message de {username}: {e}")
-                    break
-                    
-        except Exception as e:
-            print(f"Erreur avec le client {address}: {e}")
-        finally:
-            self.disconnect_client(username)
+            client_socket.close()
+            return None
+        
+        print(f"Utilisateur {username} connecté depuis {address}")
+        
+        response = Message(
+            type=MessageType.LOGIN_RESPONSE,
+            sender="server",
+            content={
+                "success": True,
+                "username": username,
+                "users": self.get_users_list(),
+                "features": features
+            }
+        )
+        client_socket.send(Protocol.pack_message(response, features))
+        
+        self.send_offline_messages(username)
+        self.send_groups_list(username)
+        self.broadcast_user_status(username, "online")
+        return username
     
-    def process_message_queue(self):
-        while self.running:
-            try:
-                username, message = self.message_queue.get(timeout=1)
-                self.handle_message(username, message)
-            except queue.Empty:
-                continue
-            except Exception as e:
-                print(f"Erreur dans le traitement de la file: {e}")
+    def get_stats(self) -> dict:
+        return {
+            "clients": len(self.clients),
+            "queue_depth": self.dispatcher.queue_depth(),
+            "workers": self.dispatcher.get_stats(),
+            "groups": self.groups.get_stats()
+        }
     
     def handle_message(self, sender: str, message: Message):
         print(f"Message reçu de {sender}: {message.type}")
@@ -161,8 +212,14 @@ class Server:
             MessageType.PRIVATE_MESSAGE: self.handle_private_message,
             MessageType.GROUP_MESSAGE: self.handle_group_message,
             MessageType.CREATE_GROUP: self.handle_create_group,
+            MessageType.ADD_TO_GROUP: self.handle_add_to_group,
+            MessageType.REMOVE_FROM_GROUP: self.handle_remove_from_group,
             MessageType.FILE_TRANSFER_REQUEST: self.handle_file_transfer_request,
+            MessageType.FILE_TRANSFER_ACCEPT: self.handle_file_transfer_accept,
+            MessageType.FILE_TRANSFER_REJECT: self.handle_file_transfer_reject,
             MessageType.FILE_CHUNK: self.handle_file_chunk,
+            MessageType.FILE_CHUNK_ACK: self.handle_file_chunk_ack,
+            MessageType.FILE_DOWNLOAD_REQUEST: self.handle_file_download_request,
             MessageType.HISTORY_REQUEST: self.handle_history_request,
             MessageType.TYPING_NOTIFICATION: self.handle_typing_notification,
             MessageType.MESSAGE_READ: self.handle_message_read,
@@ -186,66 +243,63 @@ class Server:
         
         self.db.save_message(chat_message)
         
-        with self.clients_lock:
-            if recipient in self.clients:
-                response = Message(
-                    type=MessageType.PRIVATE_MESSAGE,
-                    sender=sender,
-                    recipient=recipient,
-                    content=content,
-                    timestamp=chat_message.timestamp.isoformat(),
-                    message_id=chat_message.message_id
+        if self.is_online(recipient):
+            response = Message(
+                type=MessageType.PRIVATE_MESSAGE,
+                sender=sender,
+                recipient=recipient,
+                content=content,
+                timestamp=chat_message.timestamp.isoformat(),
+                message_id=chat_message.message_id
+            )
+            try:
+                self.send_to(recipient, response)
+                
+                ack = Message(
+                    type=MessageType.MESSAGE_DELIVERED,
+                    sender="server",
+                    recipient=sender,
+                    content={"message_id": chat_message.message_id}
                 )
-                try:
-                    self.client_sockets[recipient].send(Protocol.pack_message(response))
-                    
-                    ack = Message(
-                        type=MessageType.MESSAGE_DELIVERED,
-                        sender="server",
-                        recipient=sender,
-                        content={"message_id": chat_message.message_id}
-                    )
-                    self.client_sockets[sender].send(Protocol.pack_message(ack))
-                    
-                except Exception as e:
-                    print(f"Erreur lors de l'envoi à {recipient}: {e}")
-            else:
-                self.db.add_offline_message(recipient, chat_message)
-                print(f"Message pour {recipient} stocké (hors ligne)")
+                self.send_to(sender, ack)
+            
+            except Exception as e:
+                print(f"Erreur lors de l'envoi à {recipient}: {e}")
+        else:
+            self.db.add_offline_message(recipient, chat_message)
+            print(f"Message pour {recipient} stocké (hors ligne)")
     
     def handle_group_message(self, sender: str, message: Message):
         group_id = message.recipient
         content = message.content
         
-        with self.groups_lock:
-            if group_id not in self.groups:
-                return
-            
-            group = self.groups[group_id]
-            
-            chat_message = ChatMessage(
-                sender=sender,
-                recipient=group_id,
-                content=content,
-                message_type="text"
-            )
-            
-            self.db.save_message(chat_message)
-            
-            for member in group.members:
-                if member != sender and member in self.clients:
-                    response = Message(
-                        type=MessageType.GROUP_MESSAGE,
-                        sender=sender,
-                        recipient=group_id,
-                        content=content,
-                        timestamp=chat_message.timestamp.isoformat(),
-                        message_id=chat_message.message_id
-                    )
-                    try:
-                        self.client_sockets[member].send(Protocol.pack_message(response))
-                    except Exception:
-                        pass
+        group = self.groups.get(group_id)
+        # Un ancien membre (ou un inconnu) ne peut plus écrire dans le groupe
+        if group is None or sender not in group.members:
+            return
+        
+        chat_message = ChatMessage(
+            sender=sender,
+            recipient=group_id,
+            content=content,
+            message_type="text",
+            conversation_key=group_id
+        )
+        
+        self.db.save_message(chat_message)
+        
+        response = Message(
+            type=MessageType.GROUP_MESSAGE,
+            sender=sender,
+            recipient=group_id,
+            content=content,
+            timestamp=chat_message.timestamp.isoformat(),
+            message_id=chat_message.message_id
+        )
+        self.send_to_many(
+            [member for member in group.members if member != sender],
+            response
+        )
     
     def handle_create_group(self, sender: str, message: Message):
         group_data = message.content
@@ -261,10 +315,8 @@ class Server:
             members=members
         )
         
-        with self.groups_lock:
-            self.groups[group.group_id] = group
-        
         self.db.create_group(group)
+        self.register_group(group)
         
         response = Message(
             type=MessageType.GROUP_CREATED,
@@ -276,134 +328,628 @@ class Server:
                 "members": members
             }
         )
-        self.client_sockets[sender].send(Protocol.pack_message(response))
+        self.send_to(sender, response)
         
-        for member in members:
-            if member != sender and member in self.clients:
-                notification = Message(
-                    type=MessageType.GROUP_LIST,
-                    sender="server",
-                    recipient=member,
-                    content={"groups": [group.to_dict()]}
-                )
-                self.client_sockets[member].send(Protocol.pack_message(notification))
+        notification = Message(
+            type=MessageType.GROUP_LIST,
+            sender="server",
+            content={"groups": [group.to_dict()]}
+        )
+        self.send_to_many([member for member in members if member != sender], notification)
+    
+    def handle_add_to_group(self, sender: str, message: Message):
+        group_id = message.recipient
+        
+        group = self.groups.get(group_id)
+        # Seul un membre du groupe peut y ajouter quelqu'un
+        if group is None or sender not in group.members:
+            return
+        
+        added = [
+            username for username in message.content.get("members", [])
+            if username not in group.members and self.db.add_group_member(group_id, username)
+        ]
+        if not added:
+            return
+        
+        self.invalidate_group(group_id)
+        group = self.groups.get(group_id)
+        if group is None:
+            return
+        
+        notification = Message(
+            type=MessageType.GROUP_LIST,
+            sender="server",
+            content={"groups": [group.to_dict()]}
+        )
+        self.send_to_many(group.members, notification)
+    
+    def handle_remove_from_group(self, sender: str, message: Message):
+        group_id = message.recipient
+        
+        group = self.groups.get(group_id)
+        if group is None or sender not in group.members:
+            return
+        
+        # Un membre peut quitter le groupe, le créateur peut retirer n'importe qui
+        removed = [
+            username for username in message.content.get("members", [])
+            if (username == sender or sender == group.created_by)
+            and self.db.remove_group_member(group_id, username)
+        ]
+        if not removed:
+            return
+        
+        self.invalidate_group(group_id)
+        group = self.groups.get(group_id)
+        if group is None:
+            return
+        
+        notification = Message(
+            type=MessageType.REMOVE_FROM_GROUP,
+            sender="server",
+            recipient=group_id,
+            content={"members": removed}
+        )
+        self.send_to_many(removed, notification)
+        
+        update = Message(
+            type=MessageType.GROUP_LIST,
+            sender="server",
+            content={"groups": [group.to_dict()]}
+        )
+        self.send_to_many(group.members, update)
+    
+    def group_conversation_key(self, target: str) -> Optional[str]:
+        # Clé de conversation si target désigne un groupe, sinon None. Seul le
+        # registre en décide: un pseudo peut aussi commencer par "group_".
+        if self.groups.get(target) is not None:
+            return target
+        return None
+    
+    def register_group(self, group: Group, generation: Optional[int] = None):
+        self.groups.put(group, generation)
+    
+    def invalidate_group(self, group_id: str):
+        self.groups.invalidate(group_id)
     
     def handle_file_transfer_request(self, sender: str, message: Message):
         file_info = message.content
         recipient = message.recipient
+        file_id = file_info.get("file_id")
+        if not isinstance(file_id, str) or not self.FILE_ID_PATTERN.fullmatch(file_id):
+            self.reject_request(sender, file_id, "Identifiant de transfert invalide")
+            return
+        if not isinstance(file_info.get("filename"), str):
+            self.reject_request(sender, file_id, "Nom de fichier invalide")
+            return
+        filepath = f"storage/{file_id}_{os.path.basename(file_info['filename'])}"
+        # Les quotas reposent sur la taille annoncée
+        filesize = file_info.get("filesize")
+        if not isinstance(filesize, int) or filesize < 0:
+            self.reject_request(sender, file_id, "Taille de fichier invalide")
+            return
+        
+        # Une nouvelle demande pour un file_id connu est une reprise
+        file_transfer = self.transfers.get(file_id)
+        if file_transfer is not None and file_transfer.sender != sender:
+            return
+        resumed = file_transfer is not None
+        
+        if file_transfer is None:
+            file_transfer = FileTransfer(
+                file_id=file_id,
+                sender=sender,
+                recipient=recipient,
+                filename=file_info["filename"],
+                filesize=filesize,
+                filepath=filepath,
+                is_directory=file_info.get("is_directory", False),
+                # Relais direct seulement si les deux clients savent acquitter
+                # les morceaux et si le destinataire est connecté à ce serveur.
+                # Un fichier déjà en partie stocké continue d'être stocké.
+                relay=(
+                    recipient in self.client_sockets
+                    and self.supports(sender, Protocol.FEATURE_FILE_RELAY)
+                    and self.supports(recipient, Protocol.FEATURE_FILE_RELAY)
+                    and not os.path.exists(filepath + ".blocks")
+                )
+            )
+            
+            # Un dossier est un flux sans taille connue d'avance: il ne peut
+            # pas attendre sur le serveur, ni être repris
+            if file_transfer.is_directory:
+                error = self.directory_error(file_transfer, file_info)
+                if error:
+                    self.reject_request(sender, file_id, error)
+                    return
+            
+            # Contenu déjà stocké (même empreinte) et que l'expéditeur peut
+            # déjà télécharger: l'envoi se termine sans transférer un octet.
+            # Sinon l'empreinte seule donnerait accès au fichier: il est
+            # envoyé normalement, et dédupliqué une fois reçu et haché.
+            digest = file_info.get("sha256")
+            if not file_transfer.relay and isinstance(digest, str) and len(digest) == 64:
+                stored = self.store.reference(digest)
+                if stored is not None and self.db.can_access_file(sender, stored):
+                    self.send_resume(file_transfer, [])
+                    for leftover in (filepath, filepath + ".blocks"):
+                        if os.path.exists(leftover):
+                            os.remove(leftover)
+                    self.announce_transfer(file_transfer, file_info)
+                    self.complete_transfer(file_transfer, stored)
+                    return
+            
+            error = self.transfers.add(
+                file_transfer,
+                TransferState.PENDING if file_transfer.relay else TransferState.SPOOLING
+            )
+            if error:
+                self.reject_request(sender, file_id, error)
+                return
+            
+            if not file_transfer.relay:
+                root = os.path.realpath("storage")
+                if os.path.commonpath([root, os.path.realpath(filepath)]) != root:
+                    self.transfers.remove(file_id)
+                    self.reject_request(sender, file_id, "Nom de fichier invalide")
+                    return
+                try:
+                    file_transfer.partial = PartialFile(filepath, file_transfer.filesize)
+                except OSError as e:
+                    print(f"Impossible de créer {filepath}: {e}")
+                    self.transfers.remove(file_id)
+                    self.reject_request(sender, file_id, "Stockage impossible")
+                    return
+                resumed = file_transfer.partial.resumed
+        
+        if file_transfer.partial is not None:
+            self.send_resume(file_transfer, file_transfer.partial.missing())
+        else:
+            self.send_resume(file_transfer, [[0, file_transfer.filesize]])
+        
+        if not resumed:
+            self.announce_transfer(file_transfer, file_info)
         
-        file_transfer = FileTransfer(
-            file_id=file_info["file_id"],
+        if file_transfer.partial is not None and file_transfer.partial.complete:
+            # Fichier vide, ou entièrement reçu juste avant une coupure
+            self.finish_spool(file_transfer)
+    
+    def directory_error(self, transfer: FileTransfer, file_info: dict) -> Optional[str]:
+        if not transfer.relay:
+            return "Un dossier ne s'envoie qu'à un destinataire connecté"
+        if not self.supports(transfer.recipient, Protocol.FEATURE_DIRECTORY):
+            return "Le destinataire ne sait pas recevoir de dossier"
+        compression = file_info.get("compression")
+        if compression and not self.supports(transfer.recipient, compression):
+            return "Compression non prise en charge par le destinataire"
+        return None
+    
+    def reject_request(self, sender: str, file_id: str, error: str):
+        reject_msg = Message(
+            type=MessageType.FILE_TRANSFER_REJECT,
+            sender="server",
+            recipient=sender,
+            content={"file_id": file_id, "error": error}
+        )
+        self.send_to(sender, reject_msg)
+    
+    def send_resume(self, transfer: FileTransfer, missing: list):
+        if self.supports(transfer.sender, Protocol.FEATURE_FILE_RESUME):
+            resume_msg = Message(
+                type=MessageType.FILE_TRANSFER_RESUME,
+                sender="server",
+                recipient=transfer.sender,
+                content={"file_id": transfer.file_id, "missing": missing}
+            )
+            self.send_to(transfer.sender, resume_msg)
+    
+    def announce_transfer(self, file_transfer: FileTransfer, file_info: dict):
+        # Un destinataire absent est prévenu à la fin du transfert, par le
+        # message enregistré dans complete_transfer
+        recipient = file_transfer.recipient
+        if self.is_online(recipient):
+            request = Message(
+                type=MessageType.FILE_TRANSFER_REQUEST,
+                sender=file_transfer.sender,
+                recipient=recipient,
+                content=file_info
+            )
+            self.send_to(recipient, request)
+    
+    def get_transfer(self, message: Message) -> Optional[FileTransfer]:
+        file_id = message.content.get("file_id") if isinstance(message.content, dict) else None
+        return self.transfers.get(file_id)
+    
+    def handle_file_transfer_accept(self, sender: str, message: Message):
+        transfer = self.get_transfer(message)
+        if transfer is None or transfer.recipient != sender:
+            return
+        
+        accept_msg = Message(
+            type=MessageType.FILE_TRANSFER_ACCEPT,
             sender=sender,
-            recipient=recipient,
-            filename=file_info["filename"],
-            filesize=file_info["filesize"],
-            filepath=f"storage/{file_info['file_id']}_{file_info['filename']}",
-            is_directory=file_info.get("is_directory", False)
+            recipient=transfer.sender,
+            content={"file_id": transfer.file_id}
         )
+        self.send_to(transfer.sender, accept_msg)
         
-        with self.file_transfer_lock:
-            self.file_transfers[file_info["file_id"]] = file_transfer
+        if transfer.relay:
+            transfer.accepted = True
+            self.transfers.set_state(transfer, TransferState.RELAYING)
+            pending, transfer.pending = transfer.pending, []
+            self.transfers.release(transfer)
+            for chunk_data in pending:
+                self.relay_chunk(transfer, chunk_data)
+    
+    def handle_file_transfer_reject(self, sender: str, message: Message):
+        transfer = self.get_transfer(message)
+        if transfer is None or transfer.recipient != sender:
+            return
         
-        with self.clients_lock:
-            if recipient in self.clients:
-                request = Message(
-                    type=MessageType.FILE_TRANSFER_REQUEST,
-                    sender=sender,
-                    recipient=recipient,
-                    content=file_info
-                )
-                self.client_sockets[recipient].send(Protocol.pack_message(request))
-            else:
-                chat_message = ChatMessage(
-                    sender=sender,
-                    recipient=recipient,
-                    content=f"Fichier: {file_info['filename']}",
-                    message_type="file",
-                    file_path=file_transfer.filepath
+        # Le destinataire peut aussi abandonner en cours de route (extraction
+        # d'un dossier impossible)
+        error = message.content.get("error")
+        self.cancel_transfer(transfer, sender, error if isinstance(error, str) else "Transfert refusé")
+    
+    def cancel_transfer(self, transfer: FileTransfer, cancelled_by: str, error: str):
+        if self.transfers.remove(transfer.file_id) is None:
+            return
+        
+        for username in (transfer.sender, transfer.recipient):
+            if username != cancelled_by:
+                reject_msg = Message(
+                    type=MessageType.FILE_TRANSFER_REJECT,
+                    sender=cancelled_by,
+                    recipient=username,
+                    content={"file_id": transfer.file_id, "error": error}
                 )
-                self.db.add_offline_message(recipient, chat_message)
+                self.send_to(username, reject_msg)
+        
+        if transfer.partial is not None:
+            transfer.partial.discard()
     
     def handle_file_chunk(self, sender: str, message: Message):
+        # Les messages d'un même transfert passent par le même worker du
+        # dispatcher (clé file_id). Seuls suspend_transfer et cancel_transfer
+        # peuvent venir d'un autre thread: PartialFile refuse alors d'écrire
+        transfer = self.get_transfer(message)
+        if transfer is None or transfer.sender != sender:
+            return
+        
         chunk_data = message.content
-        file_id = chunk_data["file_id"]
-        chunk = bytes.fromhex(chunk_data["data"])
-        chunk_number = chunk_data["chunk_number"]
-        total_chunks = chunk_data.get("total_chunks", 0)
+        chunk_number = chunk_data.get("chunk_number")
+        if not isinstance(chunk_number, int) or isinstance(chunk_number, bool) or chunk_number < 0:
+            self.cancel_transfer(transfer, "server", "Morceau invalide")
+            return
         
-        with self.file_transfer_lock:
-            if file_id not in self.file_transfers:
-                return
-            
-            transfer = self.file_transfers[file_id]
-            transfer.total_chunks = total_chunks
-            
-            os.makedirs(os.path.dirname(transfer.filepath), exist_ok=True)
-            with open(transfer.filepath, 'ab') as f:
-                f.write(chunk)
-            
-            transfer.chunks_received += 1
-            
-            if transfer.chunks_received >= total_chunks:
-                complete_msg = Message(
-                    type=MessageType.FILE_TRANSFER_COMPLETE,
-                    sender=sender,
-                    recipient=transfer.recipient,
-                    content={
-                        "file_id": file_id,
-                        "filename": transfer.filename,
-                        "filepath": transfer.filepath
-                    }
-                )
-                
-                with self.clients_lock:
-                    if transfer.recipient in self.clients:
-                        self.client_sockets[transfer.recipient].send(
-                            Protocol.pack_message(complete_msg)
-                        )
-                
-                chat_message = ChatMessage(
-                    sender=sender,
-                    recipient=transfer.recipient,
-                    content=f"Fichier: {transfer.filename}",
-                    message_type="file",
-                    file_path=transfer.filepath
-                )
-                self.db.save_message(chat_message)
-                
-                del self.file_transfers[file_id]
+        if not transfer.relay:
+            self.spool_chunk(transfer, chunk_data)
+        elif transfer.accepted:
+            self.relay_chunk(transfer, chunk_data)
+        elif (len(transfer.pending) < self.MAX_PENDING_CHUNKS
+              and self.transfers.buffer(transfer, len(Protocol.chunk_bytes(chunk_data)))):
+            transfer.pending.append(chunk_data)
+            self.transfers.activity(transfer)
+        else:
+            self.cancel_transfer(transfer, "server", "Trop de morceaux en attente")
     
-    def handle_history_request(self, sender: str, message: Message):
-        target = message.content.get("target")
-        limit = message.content.get("limit", 100)
+    def relay_chunk(self, transfer: FileTransfer, chunk_data: dict):
+        recipient = transfer.recipient
+        client_socket = self.client_sockets.get(recipient)
+        if client_socket is None:
+            self.cancel_transfer(transfer, recipient, "Destinataire déconnecté")
+            return
+        
+        chunk = Protocol.chunk_bytes(chunk_data)
+        offset = chunk_data.get("offset")
+        # Un relais suit le fichier dans l'ordre, sans reprise: chaque morceau
+        # commence là où le précédent s'arrête, sans dépasser la taille annoncée
+        if (chunk_data["chunk_number"] != transfer.chunks_received
+                or (offset is not None and offset != transfer.bytes_received)
+                or (not transfer.is_directory and transfer.bytes_received + len(chunk) > transfer.filesize)):
+            self.cancel_transfer(transfer, "server", "Morceau invalide")
+            return
+        transfer.chunks_received += 1
+        transfer.bytes_received += len(chunk)
+        
+        # La fin d'un fichier vient de la taille de la demande. Celle d'un
+        # dossier (archive au fil de l'eau) n'est connue que de l'expéditeur,
+        # qui l'annonce par le total de son dernier morceau.
+        announced = chunk_data.get("total_chunks")
+        if transfer.is_directory:
+            last = announced == transfer.chunks_received
+        else:
+            last = transfer.bytes_received >= transfer.filesize
+        if last:
+            transfer.total_chunks = transfer.chunks_received
+            announced = transfer.total_chunks
+        elif not isinstance(announced, int) or announced <= transfer.chunks_received:
+            # Estimation de l'expéditeur, pour la progression du destinataire seulement
+            announced = transfer.chunks_received + 1
         
-        if target.startswith("group_"):
-            messages = self.db.get_conversation_history(target, target, limit)
+        if self.supports(recipient, Protocol.FEATURE_BINARY_CHUNKS):
+            client_socket.send(Protocol.pack_file_chunk(
+                transfer.file_id, chunk_data["chunk_number"], announced, chunk, offset
+            ))
         else:
-            messages = self.db.get_conversation_history(sender, target, limit)
+            content = {
+                "file_id": transfer.file_id,
+                "chunk_number": chunk_data["chunk_number"],
+                "data": chunk.hex(),
+                "total_chunks": announced
+            }
+            if offset is not None:
+                content["offset"] = offset
+            chunk_msg = Message(
+                type=MessageType.FILE_CHUNK,
+                sender=transfer.sender,
+                recipient=recipient,
+                content=content
+            )
+            self.send_to(recipient, chunk_msg)
         
+        # L'accusé de réception vient du destinataire: l'expéditeur ne va
+        # pas plus vite que lui
+        self.transfers.activity(transfer, len(chunk))
+        if last:
+            self.transfers.set_state(transfer, TransferState.DRAINING)
+            self.complete_transfer(transfer, None)
+    
+    def spool_chunk(self, transfer: FileTransfer, chunk_data: dict):
+        # Destinataire absent: le fichier attend sur le serveur. Les anciens
+        # clients n'envoient pas la position, mais leurs morceaux sont dans l'ordre
+        chunk = Protocol.chunk_bytes(chunk_data)
+        offset = chunk_data.get("offset", transfer.bytes_received)
+        try:
+            transfer.partial.write(offset, chunk)
+        except (ValueError, OSError) as e:
+            print(f"Morceau refusé pour {transfer.file_id}: {e}")
+            self.cancel_transfer(transfer, "server", "Morceau invalide")
+            return
+        
+        transfer.bytes_received += len(chunk)
+        self.transfers.activity(transfer, len(chunk))
+        if self.supports(transfer.sender, Protocol.FEATURE_FILE_RELAY):
+            self.send_chunk_ack(transfer.sender, transfer.file_id, chunk_data["chunk_number"])
+        
+        # Complet quand tous les blocs sont là, quel que soit l'ordre ou le
+        # nombre de fois où ils ont été envoyés
+        if transfer.partial.complete:
+            self.finish_spool(transfer)
+    
+    def finish_spool(self, transfer: FileTransfer):
+        if self.transfers.remove(transfer.file_id) is None:
+            return
+        
+        transfer.partial.finish()
+        try:
+            filepath = self.store.store(transfer.partial)
+        except OSError as e:
+            print(f"Impossible de ranger {transfer.filepath}: {e}")
+            filepath = transfer.filepath
+            self.db.add_file(filepath, transfer.filesize)
+        self.complete_transfer(transfer, filepath)
+    
+    def complete_transfer(self, transfer: FileTransfer, filepath: Optional[str]):
+        complete_msg = Message(
+            type=MessageType.FILE_TRANSFER_COMPLETE,
+            sender=transfer.sender,
+            recipient=transfer.recipient,
+            content={
+                "file_id": transfer.file_id,
+                "filename": transfer.filename,
+                "filepath": filepath,
+                # Les morceaux sont passés par le destinataire (sinon: fichier
+                # stocké sur le serveur, à télécharger depuis filepath)
+                "relay": transfer.relay
+            }
+        )
+        
+        delivered = self.send_to(transfer.recipient, complete_msg)
+        
+        group_key = self.group_conversation_key(transfer.recipient)
+        chat_message = ChatMessage(
+            sender=transfer.sender,
+            recipient=transfer.recipient,
+            content=f"Fichier: {transfer.filename}",
+            message_type="file",
+            file_path=filepath,
+            conversation_key=group_key
+        )
+        self.db.save_message(chat_message)
+        # Destinataire absent: le message l'attend, comme un message privé
+        if not delivered and group_key is None:
+            self.db.add_offline_message(transfer.recipient, chat_message)
+    
+    def send_chunk_ack(self, username: str, file_id: str, chunk_number: int):
+        ack_msg = Message(
+            type=MessageType.FILE_CHUNK_ACK,
+            sender="server",
+            recipient=username,
+            content={"file_id": file_id, "chunk_number": chunk_number}
+        )
+        self.send_to(username, ack_msg)
+    
+    def handle_file_chunk_ack(self, sender: str, message: Message):
+        transfer = self.get_transfer(message)
+        if transfer is None or transfer.recipient != sender or not transfer.relay:
+            return
+        
+        chunk_number = message.content.get("chunk_number", 0)
+        self.send_chunk_ack(transfer.sender, transfer.file_id, chunk_number)
+        self.transfers.activity(transfer)
+        
+        # Le transfert reste connu jusqu'au dernier accusé de réception
+        # (total_chunks n'est fixé qu'une fois le dernier morceau relayé)
+        if transfer.total_chunks and chunk_number + 1 >= transfer.total_chunks:
+            self.transfers.remove(transfer.file_id)
+    
+    def handle_file_download_request(self, sender: str, message: Message):
+        # Envoie un fichier de storage/ (ou une plage d'octets) en trames
+        # binaires; le noyau copie les données (FileRegion et sendfile)
+        content = message.content
+        download_id = content.get("file_id")
+        file_path = content.get("file_path")
+        offset = content.get("offset", 0)
+        length = content.get("length")
+        # Types vérifiés avant de toucher au système de fichiers
+        path = self.stored_file(file_path) if isinstance(file_path, str) else None
+        size = 0
+        end = 0
+        
+        if not isinstance(download_id, str) or not 0 < len(download_id.encode('utf-8')) < 256:
+            error = "Identifiant de téléchargement invalide"
+        elif (not isinstance(offset, int) or isinstance(offset, bool) or offset < 0
+              or length is not None and (not isinstance(length, int) or isinstance(length, bool) or length < 0)):
+            error = "Plage invalide"
+        elif path is None:
+            error = "Fichier introuvable"
+        elif os.path.exists(path + ".blocks"):
+            error = "Fichier en cours de réception"
+        elif not self.db.can_access_file(sender, file_path):
+            error = "Accès refusé"
+        elif not self.supports(sender, Protocol.FEATURE_BINARY_CHUNKS):
+            error = "Le téléchargement demande les trames binaires"
+        else:
+            size = os.path.getsize(path)
+            if offset > size:
+                error = "Plage invalide"
+            else:
+                end = size if length is None else min(size, offset + length)
+                error = None
+        
+        response_content = {"file_id": download_id, "file_path": file_path}
+        if error:
+            response_content["error"] = error
+        else:
+            response_content.update({"filesize": size, "offset": offset, "length": end - offset})
         response = Message(
-            type=MessageType.HISTORY_RESPONSE,
+            type=MessageType.FILE_DOWNLOAD_RESPONSE,
+            sender="server",
+            recipient=sender,
+            content=response_content
+        )
+        self.send_to(sender, response)
+        
+        client_socket = self.client_sockets.get(sender)
+        if error or client_socket is None:
+            return
+        
+        self.db.record_download(file_path, size)
+        complete_msg = Message(
+            type=MessageType.FILE_TRANSFER_COMPLETE,
             sender="server",
             recipient=sender,
             content={
-                "target": target,
-                "messages": [msg.to_dict() for msg in messages]
+                "file_id": download_id,
+                "filename": os.path.basename(file_path),
+                "filepath": None
             }
         )
-        self.client_sockets[sender].send(Protocol.pack_message(response))
+        trailer = Protocol.pack_message(complete_msg, self.clients[sender].features)
+        try:
+            region = FileRegion(download_id, path, offset, end - offset, trailer)
+        except OSError as e:
+            print(f"Impossible d'ouvrir {path}: {e}")
+            return
+        if not client_socket.send(region):
+            # File fermée ou pleine: la plage ne sera jamais envoyée
+            region.close()
+    
+    def stored_file(self, file_path: str) -> Optional[str]:
+        # Chemin local d'un fichier de storage/, None s'il en sort ou n'existe pas
+        root = os.path.abspath("storage")
+        path = os.path.abspath(file_path)
+        if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+            return None
+        return path
+    
+    def handle_history_request(self, sender: str, message: Message):
+        target = message.content.get("target")
+        before = message.content.get("before")
+        after = message.content.get("after")
+        try:
+            limit = int(message.content.get("limit", 100))
+        except (TypeError, ValueError):
+            limit = None
+        if (limit is None or not isinstance(target, str)
+                or not self.valid_cursor(before) or not self.valid_cursor(after)):
+            self.send_history_done(sender, target, before, after, None, "Requête d'historique invalide")
+            return
+        # Une limite négative ou nulle ne doit pas lever le plafond de la page
+        limit = max(1, min(limit, self.MAX_HISTORY_PAGE))
+        
+        group = self.groups.get(target)
+        if group is not None:
+            # L'historique d'un groupe est réservé à ses membres
+            if sender not in group.members:
+                self.send_history_done(sender, target, before, after, None, "Accès refusé")
+                return
+            batches = self.db.iter_history(target, target, limit, before, after, self.HISTORY_BATCH_SIZE)
+        else:
+            batches = self.db.iter_history(sender, target, limit, before, after, self.HISTORY_BATCH_SIZE)
+        
+        # Une trame par lot, au fil de la lecture en base, puis une trame
+        # "done" avec le curseur de la page suivante
+        next_cursor = None
+        for batch, next_cursor in batches:
+            if not batch:
+                continue
+            response = Message(
+                type=MessageType.HISTORY_RESPONSE,
+                sender="server",
+                recipient=sender,
+                content={
+                    "target": target,
+                    "messages": [msg.to_dict() for msg in batch],
+                    "before": before,
+                    "after": after,
+                    "done": False
+                }
+            )
+            if not self.send_to(sender, response):
+                return
+        
+        self.send_history_done(sender, target, before, after, next_cursor)
+    
+    @staticmethod
+    def valid_cursor(cursor) -> bool:
+        # Absent, message_id ou timestamp, ou couple [timestamp, rowid]
+        if cursor is None or isinstance(cursor, str):
+            return True
+        return (isinstance(cursor, list) and len(cursor) == 2 and isinstance(cursor[0], str)
+                and isinstance(cursor[1], int) and not isinstance(cursor[1], bool))
+    
+    def send_history_done(self, sender: str, target, before, after, next_cursor, error=None):
+        content = {
+            "target": target,
+            "messages": [],
+            "before": before,
+            "after": after,
+            "done": True,
+            "next_cursor": next_cursor
+        }
+        if error:
+            content["error"] = error
+        done = Message(
+            type=MessageType.HISTORY_RESPONSE,
+            sender="server",
+            recipient=sender,
+            content=content
+        )
+        self.send_to(sender, done)
     
     def handle_typing_notification(self, sender: str, message: Message):
         recipient = message.recipient
         
-        with self.clients_lock:
-            if recipient in self.clients:
-                notification = Message(
-                    type=MessageType.TYPING_NOTIFICATION,
-                    sender=sender,
-                    recipient=recipient
-                )
-                self.client_sockets[recipient].send(Protocol.pack_message(notification))
+        if self.is_online(recipient):
+            notification = Message(
+                type=MessageType.TYPING_NOTIFICATION,
+                sender=sender,
+                recipient=recipient
+            )
+            self.send_to(recipient, notification)
     
     def handle_message_read(self, sender: str, message: Message):
         message_id = message.content.get("message_id")
@@ -417,6 +963,42 @@ class Server:
             if sender in self.clients:
                 self.clients[sender].last_seen = datetime.now()
     
+    def is_online(self, username: str) -> bool:
+        return username in self.clients
+    
+    def supports(self, username: str, feature: str) -> bool:
+        user = self.clients.get(username)
+        return user is not None and feature in user.features
+    
+    def send_to(self, username: str, message: Message) -> bool:
+        # Point unique d'envoi vers un utilisateur; False s'il n'est pas connecté ici
+        return self.send_encoded(username, message, {})
+    
+    def send_encoded(self, username: str, message: Message, frames: dict) -> bool:
+        # frames: trames de ce message déjà encodées, par encodage. Les mêmes
+        # octets partent vers tous les destinataires qui ont négocié le même
+        client_socket = self.client_sockets.get(username)
+        user = self.clients.get(username)
+        if client_socket is None or user is None:
+            return False
+        
+        encoding = Protocol.encoding_for(user.features)
+        frame = frames.get(encoding)
+        if frame is None:
+            frame = frames[encoding] = Protocol.pack_message(message, user.features)
+        
+        client_socket.send(frame, droppable=message.type in DROPPABLE_TYPES)
+        return True
+    
+    def send_to_many(self, usernames: list, message: Message):
+        # Le message n'est encodé qu'une fois par encodage, pas par destinataire
+        frames = {}
+        for username in usernames:
+            try:
+                self.send_encoded(username, message, frames)
+            except Exception:
+                pass
+    
     def send_offline_messages(self, username: str):
         offline_messages = self.db.get_offline_messages(username)
         
@@ -429,10 +1011,14 @@ class Server:
                 timestamp=msg.timestamp.isoformat(),
                 message_id=msg.message_id
             )
-            self.client_sockets[username].send(Protocol.pack_message(message))
+            self.send_to(username, message)
     
     def send_groups_list(self, username: str):
+        generation = self.groups.generation
         groups = self.db.get_user_groups(username)
+        # Les groupes d'un utilisateur qui se connecte vont probablement servir
+        for group in groups:
+            self.register_group(group, generation)
         
         if groups:
             response = Message(
@@ -441,7 +1027,7 @@ class Server:
                 recipient=username,
                 content={"groups": [g.to_dict() for g in groups]}
             )
-            self.client_sockets[username].send(Protocol.pack_message(response))
+            self.send_to(username, response)
     
     def broadcast_user_status(self, username: str, status: str):
         status_message = Message(
@@ -455,16 +1041,15 @@ class Server:
         )
         
         with self.clients_lock:
-            for client_username, client_socket in self.client_sockets.items():
-                if client_username != username:
-                    try:
-                        client_socket.send(Protocol.pack_message(status_message))
-                    except Exception:
-                        pass
+            others = [u for u in self.client_sockets if u != username]
+        self.send_to_many(others, status_message)
     
     def get_users_list(self) -> list:
+        # Les handlers tournent sur plusieurs workers à la fois
+        with self.clients_lock:
+            clients = list(self.clients.items())
         users = []
-        for username, user in self.clients.items():
+        for username, user in clients:
             users.append({
                 "username": username,
                 "status": "online",
@@ -479,7 +1064,8 @@ class Server:
         print(f"Déconnexion de {username}")
         
         with self.clients_lock:
-            if username in self.clients:
+            connected = username in self.clients
+            if connected:
                 self.db.update_user_status(username, "offline")
                 
                 if username in self.client_sockets:
@@ -492,27 +1078,87 @@ class Server:
                 if username in self.clients:
                     del self.clients[username]
         
-        self.broadcast_user_status(username, "offline")
+        # Un relais ne peut pas continuer sans ses deux bouts. Un fichier en
+        # cours de stockage reste sur le disque pour une reprise, mais ne
+        # garde ni descripteurs ni mémoire en attendant.
+        for transfer in self.transfers.involving(username):
+            if transfer.relay:
+                self.cancel_transfer(transfer, username, "Correspondant déconnecté")
+            elif transfer.sender == username:
+                self.suspend_transfer(transfer)
+        
+        # Une deuxième déconnexion (ping, arrêt, fin de la lecture) n'annonce
+        # rien: le pseudo a pu se reconnecter ailleurs entre-temps
+        if connected:
+            self.broadcast_user_status(username, "offline")
+    
+    def suspend_transfer(self, transfer: FileTransfer, error: Optional[str] = None):
+        if self.transfers.remove(transfer.file_id) is not None:
+            transfer.partial.close()
+            if error is not None:
+                self.reject_request(transfer.sender, transfer.file_id, error)
+    
+    def reap_stalled_transfers(self):
+        for transfer in self.transfers.stalled():
+            print(f"Transfert {transfer.file_id} inactif depuis {self.transfers.stall_timeout} s")
+            if transfer.relay:
+                self.cancel_transfer(transfer, "server", "Transfert inactif")
+            else:
+                # L'expéditeur, toujours connecté, n'attend plus d'accusés:
+                # un nouvel envoi reprendra là où le fichier s'est arrêté
+                self.suspend_transfer(transfer, "Transfert suspendu, renvoyez le fichier pour reprendre")
+    
+    def reap_transfers(self):
+        while self.running:
+            time.sleep(self.TRANSFER_REAP_INTERVAL)
+            self.reap_stalled_transfers()
+            
+            stats = self.transfers.stats()
+            if stats["count"]:
+                print(f"Transferts: {stats['count']} {stats['states']}, "
+                      f"{stats['rate'] / 1e6:.1f} Mo/s, {stats['disk_bytes'] / 1e6:.1f} Mo sur disque, "
+                      f"{stats['memory'] / 1e6:.1f} Mo en mémoire")
+    
+    def clean_storage(self):
+        while self.janitor.running:
+            time.sleep(self.janitor.interval)
+            if not self.janitor.running:
+                return
+            try:
+                usage = self.janitor.sweep(self.store, self.storage_in_use)
+            except Exception as e:
+                print(f"Erreur lors de l'entretien du stockage: {e}")
+                continue
+            print(f"Stockage: {usage['files']} fichiers, {usage['bytes'] / 1e6:.1f} Mo "
+                  f"(dont {usage['partial_bytes'] / 1e6:.1f} Mo en cours de réception), "
+                  f"{usage['deleted']} supprimés, {usage['freed'] / 1e6:.1f} Mo libérés")
+    
+    def storage_in_use(self, path: str) -> bool:
+        # Fichiers de storage/ nommés {file_id}_{nom} pendant la réception
+        file_id = os.path.basename(path).split("_", 1)[0]
+        return self.transfers.get(file_id) is not None
     
     def ping_clients(self):
         while self.running:
             time.sleep(30)
             
             with self.clients_lock:
-                current_time = datetime.now()
-                for username, user in list(self.clients.items()):
-                    try:
-                        ping = Message(
-                            type=MessageType.PING,
-                            sender="server"
-                        )
-                        self.client_sockets[username].send(Protocol.pack_message(ping))
-                        
-                        if (current_time - user.last_seen).seconds > 60:
-                            self.disconnect_client(username)
-                            
-                    except Exception:
+                users = list(self.clients.items())
+            
+            current_time = datetime.now()
+            ping = Message(
+                type=MessageType.PING,
+                sender="server"
+            )
+            for username, user in users:
+                try:
+                    self.send_to(username, ping)
+                    
+                    if (current_time - user.last_seen).seconds > 60:
                         self.disconnect_client(username)
+                
+                except Exception:
+                    self.disconnect_client(username)
 
 if __name__ == "__main__":
     server = Server()
@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from protocol import Protocol, Message, MessageType
+from server import Server
+from async_server import AsyncServer
+
+class ShardedServer(AsyncServer):
+    # Un worker parmi N: tous écoutent sur le même port grâce à SO_REUSEPORT
+    # (le noyau répartit les connexions) et se relaient par sockets Unix les
+    # messages destinés aux clients connectés à un autre worker.
+    def __init__(self, worker_id: int, num_workers: int, host='0.0.0.0', port=8888,
+                 socket_dir=None, backlog=1024, **kwargs):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("SO_REUSEPORT n'est pas disponible sur ce système")
+        
+        super().__init__(host, port, backlog, **kwargs)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.socket_dir = socket_dir or default_socket_dir(port)
+        
+        # Utilisateurs connectés aux autres workers: pseudo -> numéro du worker
+        self.remote_users: Dict[str, int] = {}
+        self.remote_lock = threading.Lock()
+        self.peer_queues: Dict[int, asyncio.Queue] = {}
+        self.peer_tasks: List[asyncio.Task] = []
+        # storage/ est commun à tous les workers: un seul l'entretient
+        if worker_id != 0:
+            self.janitor.stop()
+    
+    def peer_path(self, worker_id: int) -> str:
+        return os.path.join(self.socket_dir, f"worker_{worker_id}.sock")
+    
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        
+        path = self.peer_path(self.worker_id)
+        os.makedirs(self.socket_dir, exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(path)
+        peer_server = await asyncio.start_unix_server(self.handle_peer, path=path)
+        
+        for worker_id in range(self.num_workers):
+            if worker_id != self.worker_id:
+                self.peer_queues[worker_id] = asyncio.Queue()
+                self.peer_tasks.append(self.loop.create_task(self.peer_writer(worker_id)))
+        
+        try:
+            async with peer_server:
+                await super().serve()
+        finally:
+            # Un écrivain connecté attend sa file indéfiniment
+            for task in self.peer_tasks:
+                task.cancel()
+            await asyncio.gather(*self.peer_tasks, return_exceptions=True)
+            if os.path.exists(path):
+                os.unlink(path)
+    
+    async def peer_writer(self, worker_id: int):
+        queue = self.peer_queues[worker_id]
+        
+        while self.running:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.peer_path(worker_id))
+            except OSError:
+                # Le worker n'est pas encore (ou plus) à l'écoute
+                await asyncio.sleep(0.5)
+                continue
+            
+            # Un worker qui (re)démarre apprend qui est connecté chez nous
+            writer.write(self.pack_envelope({"kind": "users", "users": list(self.clients)}))
+            try:
+                while True:
+                    data = await queue.get()
+                    writer.write(data)
+                    await writer.drain()
+            except (ConnectionError, OSError):
+                pass
+            finally:
+                writer.close()
+    
+    async def handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker_id = None
+        # Annulée à l'arrêt avec les connexions des clients
+        task = asyncio.current_task()
+        self.connection_tasks.add(task)
+        try:
+            while self.running:
+                envelope = await Protocol.unpack_message_async(reader)
+                if not envelope:
+                    break
+                
+                worker_id = envelope.content["worker"]
+                self.handle_route(worker_id, envelope.content)
+        except Exception as e:
+            print(f"Erreur sur le canal du worker {worker_id}: {e}")
+        finally:
+            self.connection_tasks.discard(task)
+            writer.close()
+            if worker_id is not None:
+                self.drop_worker_users(worker_id)
+    
+    def handle_route(self, worker_id: int, content: dict):
+        kind = content.get("kind")
+        
+        if kind == "deliver":
+            message = Message.from_dict(content["message"])
+            self.deliver_local(content["targets"], message)
+        
+        elif kind == "presence":
+            username = content["username"]
+            if content["status"] == "online":
+                if self.add_remote_user(worker_id, username):
+                    Server.broadcast_user_status(self, username, "online")
+            else:
+                # Hors ligne annoncé en retard par le worker qu'il a quitté
+                with self.remote_lock:
+                    gone = self.remote_users.get(username) == worker_id
+                    if gone:
+                        del self.remote_users[username]
+                if gone:
+                    Server.broadcast_user_status(self, username, "offline")
+        
+        elif kind == "users":
+            for username in content["users"]:
+                self.add_remote_user(worker_id, username)
+        
+        elif kind == "group":
+            # Membres modifiés par un autre worker: relus en base au besoin
+            Server.invalidate_group(self, content["group_id"])
+    
+    def add_remote_user(self, worker_id: int, username: str) -> bool:
+        # Deux workers peuvent accepter le même pseudo avant d'apprendre l'un
+        # pour l'autre: la connexion du plus petit numéro de worker est gardée
+        if username in self.client_sockets:
+            if worker_id > self.worker_id:
+                # Les autres workers ont pu retenir la connexion perdante
+                self.announce_presence(username, "online")
+                return False
+            self.drop_duplicate(username)
+        with self.remote_lock:
+            self.remote_users[username] = worker_id
+        return True
+    
+    def drop_duplicate(self, username: str):
+        print(f"{username} est déjà connecté à un autre worker, déconnexion")
+        error = Message(
+            type=MessageType.ERROR,
+            sender="server",
+            recipient=username,
+            content={"error": "Pseudo déjà utilisé"}
+        )
+        Server.send_to(self, username, error)
+        self.disconnect_client(username)
+    
+    def drop_worker_users(self, worker_id: int):
+        with self.remote_lock:
+            gone = [u for u, w in self.remote_users.items() if w == worker_id]
+            for username in gone:
+                del self.remote_users[username]
+        
+        for username in gone:
+            Server.broadcast_user_status(self, username, "offline")
+    
+    def pack_envelope(self, content: dict) -> bytes:
+        content = dict(content, worker=self.worker_id)
+        envelope = Message(
+            type=MessageType.WORKER_ROUTE,
+            sender=f"worker:{self.worker_id}",
+            content=content
+        )
+        return Protocol.pack_message(envelope)
+    
+    def route(self, worker_ids, content: dict):
+        if not self.loop:
+            return
+        data = self.pack_envelope(content)
+        for worker_id in worker_ids:
+            queue = self.peer_queues.get(worker_id)
+            if queue is not None:
+                self.loop.call_soon_threadsafe(queue.put_nowait, data)
+    
+    def deliver_local(self, usernames: List[str], message: Message):
+        Server.send_to_many(self, usernames, message)
+    
+    def is_online(self, username: str) -> bool:
+        return super().is_online(username) or username in self.remote_users
+    
+    def send_to(self, username: str, message: Message) -> bool:
+        if super().send_to(username, message):
+            return True
+        
+        worker_id = self.remote_users.get(username)
+        if worker_id is None:
+            return False
+        self.route([worker_id], {
+            "kind": "deliver",
+            "targets": [username],
+            "message": message.to_dict()
+        })
+        return True
+    
+    def send_to_many(self, usernames: list, message: Message):
+        local = []
+        remote = defaultdict(list)
+        for username in usernames:
+            if username in self.client_sockets:
+                local.append(username)
+            elif username in self.remote_users:
+                remote[self.remote_users[username]].append(username)
+        
+        self.deliver_local(local, message)
+        
+        # Un seul envoi par worker distant, quelle que soit la taille du groupe
+        for worker_id, targets in remote.items():
+            self.route([worker_id], {
+                "kind": "deliver",
+                "targets": targets,
+                "message": message.to_dict()
+            })
+    
+    def broadcast_user_status(self, username: str, status: str):
+        super().broadcast_user_status(username, status)
+        self.announce_presence(username, status)
+    
+    def announce_presence(self, username: str, status: str):
+        self.route(self.peer_queues.keys(), {
+            "kind": "presence",
+            "username": username,
+            "status": status
+        })
+    
+    def get_users_list(self) -> list:
+        users = super().get_users_list()
+        with self.remote_lock:
+            remote = list(self.remote_users)
+        for username in remote:
+            users.append({"username": username, "status": "online", "last_seen": None})
+        return users
+    
+    def invalidate_group(self, group_id: str):
+        # Les groupes créés n'ont pas besoin d'être annoncés: les autres
+        # workers les chargent depuis la base partagée à la première
+        # utilisation (un identifiant neuf n'a pas pu être mis en cache
+        # comme absent)
+        super().invalidate_group(group_id)
+        self.route(self.peer_queues.keys(), {"kind": "group", "group_id": group_id})
+    
+    def storage_in_use(self, path: str) -> bool:
+        # Les envois reçus par les autres workers ne sont pas dans
+        # self.transfers. Leur bitmap change à chaque bloc reçu et un envoi
+        # sans nouvelles est suspendu au bout de stall_timeout: un bitmap plus
+        # récent que cela peut appartenir à l'un d'eux.
+        if super().storage_in_use(path):
+            return True
+        try:
+            modified = os.path.getmtime(path + ".blocks")
+        except OSError:
+            return False
+        return modified > time.time() - self.transfers.stall_timeout - self.TRANSFER_REAP_INTERVAL
+
+def default_socket_dir(port: int) -> str:
+    return os.path.join(tempfile.gettempdir(), f"lan_chat_{port}")
+
+def run_worker(worker_id: int, num_workers: int, host: str, port: int, socket_dir: str):
+    server = ShardedServer(worker_id, num_workers, host, port, socket_dir)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+def launch(num_workers=None, host='0.0.0.0', port=8888):
+    num_workers = num_workers or os.cpu_count() or 1
+    socket_dir = default_socket_dir(port)
+    os.makedirs(socket_dir, exist_ok=True)
+    
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(
+            target=run_worker,
+            args=(worker_id, num_workers, host, port, socket_dir),
+            name=f"lan_chat-worker-{worker_id}"
+        )
+        for worker_id in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    print(f"{num_workers} workers démarrés sur {host}:{port}")
+    
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Les workers reçoivent eux aussi le SIGINT et s'arrêtent proprement
+        print("\nArrêt du serveur...")
+        for worker in workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serveur LAN Messenger multi-processus")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="nombre de workers (par défaut: nombre de coeurs)")
+    args = parser.parse_args()
+    launch(args.workers, args.host, args.port)
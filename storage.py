@@ -0,0 +1,362 @@
+import os
+import shutil
+import struct
+import time
+import hashlib
+import threading
+from typing import Callable, List, Optional
+
+from database import Database
+
+class PartialFile:
+    # Fichier en cours de réception sur le serveur. Les morceaux sont écrits
+    # à leur position dans un fichier préalloué; les blocs reçus sont notés
+    # dans un bitmap gardé à côté (chemin + ".blocks") pour pouvoir reprendre
+    # un envoi interrompu, même après un redémarrage du serveur.
+    BLOCK_SIZE = 8192
+    # Taille du fichier, taille des blocs
+    HEADER = struct.Struct('!QI')
+    
+    def __init__(self, path: str, size: int, block_size=BLOCK_SIZE):
+        self.path = path
+        self.size = size
+        self.block_size = block_size
+        self.blocks = (size + block_size - 1) // block_size
+        self.bitmap_path = path + ".blocks"
+        self.resumed = False
+        # Empreinte calculée au fil des morceaux reçus dans l'ordre
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        # write() vient du worker du transfert, close() d'un autre thread
+        # (déconnexion, transfert inactif): un morceau n'est jamais écrit
+        # dans un descripteur fermé, peut-être déjà réutilisé
+        self.lock = threading.Lock()
+        self.closed = False
+        
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        self.bitmap_fd = os.open(self.bitmap_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        
+        header = self.HEADER.pack(size, block_size)
+        stored = os.read(self.bitmap_fd, self.HEADER.size + (self.blocks + 7) // 8)
+        if (stored[:self.HEADER.size] == header
+                and len(stored) == len(header) + (self.blocks + 7) // 8
+                and os.fstat(self.fd).st_size == size):
+            self.bitmap = bytearray(stored[self.HEADER.size:])
+            self.resumed = True
+            # La date du bitmap dit aux autres processus que l'envoi a repris
+            os.utime(self.bitmap_path)
+        else:
+            self.bitmap = bytearray((self.blocks + 7) // 8)
+            os.ftruncate(self.fd, 0)
+            preallocate(self.fd, size)
+            os.ftruncate(self.bitmap_fd, 0)
+            pwrite(self.bitmap_fd, header + self.bitmap, 0)
+        
+        self.received = sum(bin(byte).count("1") for byte in self.bitmap)
+    
+    @property
+    def complete(self) -> bool:
+        return self.received >= self.blocks
+    
+    def has_block(self, block: int) -> bool:
+        return bool(self.bitmap[block >> 3] & (1 << (block & 7)))
+    
+    def write(self, offset: int, data: bytes):
+        with self.lock:
+            if self.closed:
+                raise ValueError("Fichier fermé")
+            self.write_block(offset, data)
+    
+    def write_block(self, offset: int, data: bytes):
+        end = offset + len(data)
+        if offset < 0 or end > self.size:
+            raise ValueError(f"Morceau hors du fichier: {offset}-{end} / {self.size}")
+        
+        pwrite(self.fd, data, offset)
+        if offset == self.hashed:
+            self.hasher.update(data)
+            self.hashed = end
+        
+        # Seuls les blocs entièrement couverts sont notés (le dernier bloc du
+        # fichier peut être plus court)
+        first = (offset + self.block_size - 1) // self.block_size
+        last = self.blocks if end == self.size else end // self.block_size
+        if first >= last:
+            return
+        
+        for block in range(first, last):
+            if not self.has_block(block):
+                self.bitmap[block >> 3] |= 1 << (block & 7)
+                self.received += 1
+        
+        # Les données sont écrites avant le bitmap qui les annonce
+        start, stop = first >> 3, ((last - 1) >> 3) + 1
+        pwrite(self.bitmap_fd, bytes(self.bitmap[start:stop]), self.HEADER.size + start)
+    
+    def missing(self) -> List[List[int]]:
+        # Plages [début, fin) d'octets encore attendues, fusionnées
+        ranges = []
+        block = 0
+        while block < self.blocks:
+            if self.has_block(block):
+                block += 1
+                continue
+            first = block
+            while block < self.blocks and not self.has_block(block):
+                block += 1
+            ranges.append([first * self.block_size, min(block * self.block_size, self.size)])
+        return ranges
+    
+    def digest(self) -> str:
+        # sha256 du fichier complet: seule la partie pas encore hachée (morceaux
+        # reçus dans le désordre, reprise) est relue
+        with open(self.path, 'rb') as f:
+            f.seek(self.hashed)
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                self.hasher.update(block)
+        self.hashed = self.size
+        return self.hasher.hexdigest()
+    
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for fd in (self.fd, self.bitmap_fd):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+    
+    def finish(self):
+        # Fichier complet: le bitmap ne sert plus
+        self.close()
+        try:
+            os.remove(self.bitmap_path)
+        except OSError:
+            pass
+    
+    def discard(self):
+        self.close()
+        for path in (self.path, self.bitmap_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class ContentStore:
+    # Fichiers reçus rangés par empreinte sha256 sous root/ab/abcd...: un même
+    # contenu envoyé plusieurs fois n'est stocké qu'une fois. Les références
+    # d'un fichier sont les messages qui le désignent; release() le supprime
+    # quand il n'y en a plus.
+    def __init__(self, db: Database, root="storage/blobs"):
+        self.db = db
+        self.root = root
+        # Une suppression ne doit pas retirer un fichier qu'un store() vient de ranger
+        self.lock = threading.Lock()
+    
+    def blob_path(self, digest: str) -> str:
+        return f"{self.root}/{digest[:2]}/{digest}"
+    
+    def reference(self, digest: str) -> Optional[str]:
+        # Chemin du contenu s'il est déjà stocké
+        path = self.db.reference_blob(digest)
+        if path is not None and not os.path.isfile(path):
+            # Fichier disparu du disque: la ligne ne vaut plus rien
+            self.db.delete_file(path)
+            return None
+        return path
+    
+    def store(self, partial: PartialFile) -> str:
+        # Range un fichier complet et renvoie son chemin définitif
+        digest = partial.digest()
+        with self.lock:
+            path = self.reference(digest)
+            if path is not None:
+                os.remove(partial.path)
+                return path
+            
+            path = self.blob_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(partial.path, path)
+            self.db.add_file(path, partial.size, digest)
+            return path
+    
+    def release(self, path: str, unused_since: float) -> bool:
+        # Supprime le fichier si aucun message ne le désigne plus et qu'il n'a
+        # pas servi depuis unused_since
+        with self.lock:
+            if not self.db.release_file(path, unused_since):
+                return False
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return True
+    
+    def evict(self, path: str):
+        # Suppression forcée, quels que soient les messages qui désignent le
+        # fichier (rétention, place): ils mènent ensuite à "Fichier introuvable"
+        with self.lock:
+            self.db.delete_file(path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class StorageJanitor:
+    # Entretien de storage/ en tâche de fond, par niveaux de rétention:
+    # - envois en partie reçus (bitmap .blocks) non repris depuis partial_ttl;
+    # - fichiers qu'aucun message ne désigne, au bout de orphan_grace (le
+    #   message d'un fichier tout juste rangé n'est pas encore enregistré);
+    # - fichiers ni envoyés ni téléchargés depuis max_age;
+    # - puis les moins récemment utilisés, tant que storage/ dépasse
+    #   max_bytes ou que le disque a moins de min_free octets libres (SQLite
+    #   doit toujours pouvoir écrire).
+    # Le travail est étalé: une pause de pause secondes toutes les batch
+    # opérations (fichier examiné ou supprimé).
+    def __init__(self, root="storage", max_bytes=20 << 30, max_age=90 * 24 * 3600,
+                 min_free=1 << 30, partial_ttl=24 * 3600, orphan_grace=3600,
+                 interval=600, batch=128, pause=0.05):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_free = min_free
+        self.partial_ttl = partial_ttl
+        self.orphan_grace = orphan_grace
+        # Secondes entre deux passages
+        self.interval = interval
+        self.batch = batch
+        self.pause = pause
+        self.running = True
+        self.operations = 0
+        # Bilan du dernier passage
+        self.usage = {"files": 0, "bytes": 0, "partial_bytes": 0, "deleted": 0, "freed": 0}
+    
+    def stop(self):
+        self.running = False
+    
+    def pace(self):
+        self.operations += 1
+        if self.operations % self.batch == 0:
+            time.sleep(self.pause)
+    
+    def scan(self, directory: str):
+        # Fichiers ordinaires sous directory, au rythme de pace()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        for entry in entries:
+            if not self.running:
+                return
+            self.pace()
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self.scan(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+            except OSError:
+                pass
+    
+    def sweep(self, store: ContentStore, in_use: Callable[[str], bool]) -> dict:
+        # Un passage complet. in_use(chemin): fichier d'un transfert en cours
+        now = time.time()
+        last_used = store.db.file_last_used()
+        referenced = store.db.referenced_files()
+        usage = {"files": 0, "bytes": 0, "partial_bytes": 0, "deleted": 0, "freed": 0}
+        # (dernier usage, taille, chemin) des fichiers conservés
+        kept = []
+        
+        for entry in self.scan(self.root):
+            path = entry.path
+            try:
+                stat = entry.stat(follow_symlinks=False)
+                if path.endswith(".blocks"):
+                    data_path = path[:-len(".blocks")]
+                    size = stat.st_size + (os.path.getsize(data_path) if os.path.exists(data_path) else 0)
+                    if stat.st_mtime < now - self.partial_ttl and not in_use(data_path):
+                        self.delete(store, data_path, size, "envoi abandonné", usage)
+                        self.delete(store, path, 0, None, usage)
+                    else:
+                        usage["partial_bytes"] += size
+                    continue
+                if os.path.exists(path + ".blocks"):
+                    # Compté avec son bitmap
+                    continue
+                
+                used = last_used.get(path)
+                if (stat.st_mtime < now - self.orphan_grace and path not in referenced
+                        and not in_use(path)):
+                    # release() vérifie à nouveau: un message a pu arriver depuis
+                    if store.release(path, now - self.orphan_grace):
+                        self.deleted(path, stat.st_size, "orphelin", usage)
+                        continue
+                if max(used or 0, stat.st_mtime) < now - self.max_age:
+                    self.delete(store, path, stat.st_size, "expiré", usage)
+                    continue
+                kept.append((used or stat.st_mtime, stat.st_size, path))
+            except FileNotFoundError:
+                # Supprimé depuis le début du passage (donnée d'un envoi abandonné)
+                continue
+            except OSError as e:
+                print(f"Entretien de {path} impossible: {e}")
+        
+        # Budget de place: les moins récemment utilisés d'abord
+        total = sum(size for _, size, _ in kept) + usage["partial_bytes"]
+        try:
+            free = shutil.disk_usage(self.root).free
+        except OSError:
+            free = self.min_free
+        kept.sort()
+        usage["files"] = len(kept)
+        for _, size, path in kept:
+            if not self.running or (total <= self.max_bytes and free >= self.min_free):
+                break
+            if in_use(path):
+                continue
+            self.delete(store, path, size, "place", usage)
+            usage["files"] -= 1
+            total -= size
+            free += size
+        usage["bytes"] = total
+        self.usage = usage
+        return usage
+    
+    def delete(self, store: ContentStore, path: str, size: int, reason: Optional[str], usage: dict):
+        store.evict(path)
+        self.deleted(path, size, reason, usage)
+    
+    def deleted(self, path: str, size: int, reason: Optional[str], usage: dict):
+        if reason:
+            print(f"Suppression de {path} ({reason})")
+        usage["deleted"] += 1
+        usage["freed"] += size
+        self.pace()
+
+def preallocate(fd: int, size: int):
+    # Réserve la place d'un coup plutôt qu'au fil des écritures
+    if size <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # Système de fichiers sans fallocate
+            pass
+    os.ftruncate(fd, size)
+
+def pwrite(fd: int, data: bytes, offset: int):
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
\ No newline at end of file
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+# Modules du dépôt à plat, à la racine
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+from models import User
+from protocol import Protocol
+from server import Server
+
+class Collector:
+    # Remplace la file d'envoi d'un client: garde les messages envoyés
+    def __init__(self):
+        self.messages = []
+        self.regions = []
+    
+    def send(self, frame, droppable=False):
+        if isinstance(frame, bytes):
+            self.messages.append(Protocol.decode_frame(frame[Protocol.HEADER_SIZE:]))
+        else:
+            # FileRegion d'un téléchargement: seule la plage compte
+            self.regions.append((frame.offset, frame.end))
+            frame.close()
+        return True
+    
+    def abort(self):
+        pass
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(str(tmp_path / "test.db"))
+    yield database
+    database.close()
+
+@pytest.fixture
+def server(tmp_path, monkeypatch, db):
+    # storage/ est relatif au dossier courant
+    monkeypatch.chdir(tmp_path)
+    srv = Server(host="127.0.0.1", port=0, database=db)
+    yield srv
+    srv.server_socket.close()
+
+def connect(server: Server, username: str, features=Protocol.FEATURES) -> Collector:
+    # Client connecté sans socket: ce qui lui est envoyé reste dans le Collector
+    server.db.add_user(username)
+    collector = Collector()
+    server.clients[username] = User(username=username, connection_id=username, features=list(features))
+    server.client_sockets[username] = collector
+    return collector
\ No newline at end of file
@@ -0,0 +1,140 @@
+import json
+import sqlite3
+from datetime import datetime, timedelta
+
+from database import Database
+from models import Message, conversation_key
+
+def add_messages(db, count, sender="alice", recipient="bob", start=datetime(2024, 1, 1)):
+    messages = []
+    for i in range(count):
+        message = Message(
+            sender=sender,
+            recipient=recipient,
+            content=f"m{i}",
+            message_type="text",
+            # Deux messages par seconde: le rowid départage les ex aequo
+            timestamp=start + timedelta(seconds=i // 2)
+        )
+        db.save_message(message)
+        messages.append(message)
+    return messages
+
+def contents(messages):
+    return [message.content for message in messages]
+
+def test_history_pages_walk_back_with_cursor(db):
+    add_messages(db, 7)
+    
+    page, cursor = db.get_history_page("alice", "bob", limit=3)
+    assert contents(page) == ["m4", "m5", "m6"]
+    assert cursor == page[0].message_id
+    
+    page, cursor = db.get_history_page("bob", "alice", limit=3, before=cursor)
+    assert contents(page) == ["m1", "m2", "m3"]
+    
+    page, cursor = db.get_history_page("alice", "bob", limit=3, before=cursor)
+    assert contents(page) == ["m0"]
+    assert cursor is None
+
+def test_history_after_cursor(db):
+    messages = add_messages(db, 5)
+    
+    page, cursor = db.get_history_page("alice", "bob", limit=2, after=messages[0].message_id)
+    assert contents(page) == ["m1", "m2"]
+    assert cursor == messages[2].message_id
+    
+    page, cursor = db.get_history_page("alice", "bob", limit=2, after=cursor)
+    assert contents(page) == ["m3", "m4"]
+    assert cursor is None
+
+def test_history_timestamp_cursor(db):
+    add_messages(db, 6)
+    page, _ = db.get_history_page("alice", "bob", limit=10, before="2024-01-01T00:00:02")
+    assert contents(page) == ["m0", "m1", "m2", "m3"]
+    page, _ = db.get_history_page("alice", "bob", limit=10, after="2024-01-01T00:00:01")
+    assert contents(page) == ["m4", "m5"]
+
+def test_history_pair_cursor(db):
+    add_messages(db, 4)
+    with db.read() as cursor:
+        timestamp, rowid = cursor.execute("SELECT timestamp, rowid FROM messages WHERE content = 'm3'").fetchone()
+    page, _ = db.get_history_page("alice", "bob", limit=10, before=[timestamp, rowid])
+    assert contents(page) == ["m0", "m1", "m2"]
+    page, _ = db.get_history_page("alice", "bob", limit=10, after=(timestamp, rowid - 1))
+    assert contents(page) == ["m3"]
+
+def test_history_is_per_conversation(db):
+    add_messages(db, 3)
+    add_messages(db, 2, recipient="carol")
+    assert contents(db.get_conversation_history("bob", "alice")) == ["m0", "m1", "m2"]
+    assert contents(db.get_conversation_history("alice", "carol")) == ["m0", "m1"]
+
+def test_iter_history_batches(db):
+    add_messages(db, 10)
+    batches = list(db.iter_history("alice", "bob", limit=7, batch_size=3))
+    assert [len(batch) for batch, _ in batches] == [3, 3, 1]
+    assert [cursor for _, cursor in batches[:-1]] == [None, None]
+    assert batches[-1][1] == batches[-1][0][-1].message_id
+
+def test_write_behind_history_is_flushed(tmp_path):
+    db = Database(str(tmp_path / "wb.db"), write_behind=True, flush_interval_ms=60000)
+    try:
+        add_messages(db, 3)
+        assert contents(db.get_conversation_history("alice", "bob")) == ["m0", "m1", "m2"]
+    finally:
+        db.close()
+
+def test_migrates_baseline_database(tmp_path):
+    # Schéma d'origine: pas de conversation_key, membres en JSON, pas de files
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE users (username TEXT PRIMARY KEY, status TEXT DEFAULT 'offline',
+                            last_seen TIMESTAMP, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE messages (message_id TEXT PRIMARY KEY, sender TEXT, recipient TEXT,
+                               content TEXT, message_type TEXT, timestamp TIMESTAMP,
+                               delivered BOOLEAN DEFAULT 0, read BOOLEAN DEFAULT 0, file_path TEXT);
+        CREATE TABLE groups (group_id TEXT PRIMARY KEY, name TEXT, created_by TEXT,
+                             created_at TIMESTAMP, members TEXT);
+    ''')
+    conn.execute("INSERT INTO groups VALUES ('g1', 'Groupe', 'alice', '2024-01-01T00:00:00', ?)",
+                 (json.dumps(["alice", "bob"]),))
+    rows = [
+        ("1", "bob", "alice", "privé", "text", "2024-01-01T00:00:00", 0, 0, None),
+        ("2", "alice", "g1", "groupe", "text", "2024-01-01T00:00:01", 0, 0, None),
+        ("3", "alice", "alice", "note", "text", "2024-01-01T00:00:02", 0, 0, None)
+    ]
+    conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    
+    db = Database(path)
+    try:
+        with db.read() as cursor:
+            assert cursor.execute("PRAGMA user_version").fetchone()[0] == Database.SCHEMA_VERSION
+            keys = dict(cursor.execute("SELECT message_id, conversation_key FROM messages"))
+            indexes = {row[1] for row in cursor.execute("PRAGMA index_list(messages)")}
+            file_columns = {row[1] for row in cursor.execute("PRAGMA table_info(files)")}
+            file_indexes = {row[1] for row in cursor.execute("PRAGMA index_list(files)")}
+        assert keys == {"1": conversation_key("alice", "bob"), "2": "g1", "3": "alice"}
+        assert {"idx_messages_conversation", "idx_messages_file_path"} <= indexes
+        assert file_columns == {"path", "size", "created_at", "sha256", "last_used"}
+        assert "idx_files_sha256" in file_indexes
+        
+        group = db.get_group("g1")
+        assert sorted(group.members) == ["alice", "bob"]
+        assert contents(db.get_conversation_history("alice", "bob")) == ["privé"]
+        assert contents(db.get_conversation_history("g1", "g1")) == ["groupe"]
+    finally:
+        db.close()
+
+def test_migration_is_idempotent(tmp_path):
+    path = str(tmp_path / "again.db")
+    Database(path).close()
+    db = Database(path)
+    try:
+        with db.read() as cursor:
+            assert cursor.execute("PRAGMA user_version").fetchone()[0] == Database.SCHEMA_VERSION
+    finally:
+        db.close()
\ No newline at end of file
@@ -0,0 +1,39 @@
+import asyncio
+import socket
+
+from async_server import StreamSocket
+from outbound import SocketWriter, FileRegion
+
+def regions(tmp_path, count):
+    path = tmp_path / "f"
+    path.write_bytes(b"x" * 1000)
+    return [FileRegion(f"d{i}", str(path), 0, 1000) for i in range(count)]
+
+def test_socket_writer_closes_regions_on_error(tmp_path):
+    left, right = socket.socketpair()
+    right.close()
+    left.shutdown(socket.SHUT_WR)
+    writer = SocketWriter(left)
+    first, second = regions(tmp_path, 2)
+    writer.push(first)
+    writer.push(second)
+    writer.thread.join(5)
+    assert first.file.closed and second.file.closed
+
+def test_stream_socket_closes_queued_regions(tmp_path):
+    async def run():
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        _, writer = await asyncio.open_connection("127.0.0.1", port)
+        stream = StreamSocket(writer, asyncio.get_running_loop())
+        stream.abort()
+        # Derrière la fin de file: jamais envoyées
+        queued = regions(tmp_path, 2)
+        for region in queued:
+            stream.push(region)
+        await asyncio.wait_for(stream.task, 5)
+        server.close()
+        await server.wait_closed()
+        return queued
+    
+    assert all(region.file.closed for region in asyncio.run(run()))
\ No newline at end of file
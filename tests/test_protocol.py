@@ -0,0 +1,123 @@
+import asyncio
+import socket
+import struct
+import threading
+import zlib
+
+import pytest
+
+from protocol import Protocol, Message, MessageType, CompactCodec, FrameDecoder, zstd
+
+def chat(content, message_type=MessageType.PRIVATE_MESSAGE):
+    return Message(type=message_type, sender="alice", recipient="bob", content=content,
+                   timestamp="2024-01-01T00:00:00", message_id="m1")
+
+def decode(frame: bytes) -> Message:
+    return Protocol.decode_frame(frame[Protocol.HEADER_SIZE:])
+
+@pytest.mark.parametrize("content", [
+    "bonjour",
+    {"file_id": "f1", "missing": [[0, 10], [20, 30]], "ok": True, "none": None},
+    {"texte": "é" * 300, "nombres": [0, -1, 2 ** 40, 1.5]}
+])
+def test_compact_codec_round_trip(content):
+    message = chat(content)
+    data = CompactCodec.encode(message)
+    assert data[0] == CompactCodec.FRAME_KIND
+    assert CompactCodec.decode(data) == message
+
+def test_compact_codec_tags_are_unique():
+    assert len(set(CompactCodec.TYPE_TAGS.values())) == len(CompactCodec.TYPE_TAGS)
+    assert set(CompactCodec.TYPE_TAGS) == set(MessageType)
+
+@pytest.mark.parametrize("features", [(), (Protocol.FEATURE_COMPACT,)])
+def test_pack_message_round_trip(features):
+    message = chat({"data": "x"})
+    assert decode(Protocol.pack_message(message, features)) == message
+
+@pytest.mark.parametrize("algorithm", [
+    Protocol.FEATURE_ZLIB,
+    pytest.param(Protocol.FEATURE_ZSTD, marks=pytest.mark.skipif(zstd is None, reason="zstandard absent"))
+])
+@pytest.mark.parametrize("codec", [None, Protocol.FEATURE_COMPACT])
+def test_compressed_frame_round_trip(algorithm, codec):
+    features = (algorithm,) if codec is None else (algorithm, codec)
+    message = chat("bla " * 2000)
+    frame = Protocol.pack_message(message, features)
+    assert frame[Protocol.HEADER_SIZE] == Protocol.FRAME_COMPRESSED
+    assert len(frame) < 8000
+    assert decode(frame) == message
+
+def test_small_frames_are_not_compressed():
+    frame = Protocol.pack_message(chat("court"), (Protocol.FEATURE_ZLIB,))
+    assert frame[Protocol.HEADER_SIZE:Protocol.HEADER_SIZE + 1] == b"{"
+
+def test_decompression_is_bounded():
+    data = bytes((Protocol.FRAME_COMPRESSED, 1)) + zlib.compress(b"{" + b" " * 100000)
+    with pytest.raises(ValueError):
+        Protocol.decode_frame(data, max_frame_size=1000)
+
+def test_nested_compression_is_refused():
+    inner = Protocol.compress(chat("x" * 2000).to_json(), Protocol.FEATURE_ZLIB)
+    with pytest.raises(ValueError):
+        Protocol.decode_frame(Protocol.compress(inner, Protocol.FEATURE_ZLIB))
+    with pytest.raises(ValueError):
+        Protocol.decode_frame(Protocol.compress(b"", Protocol.FEATURE_ZLIB))
+
+def test_binary_chunk_round_trip():
+    frame = Protocol.pack_file_chunk("f1", 3, 9, b"\x00\x01" * 100, offset=12345)
+    message = decode(frame)
+    assert message.type == MessageType.FILE_CHUNK
+    assert message.content == {"chunk_number": 3, "total_chunks": 9, "offset": 12345,
+                               "file_id": "f1", "data": b"\x00\x01" * 100}
+
+def frames_for(messages, features=()):
+    return b"".join(Protocol.pack_message(message, features) for message in messages)
+
+def test_frame_decoder_split_feeds():
+    messages = [chat(f"m{i}" * i) for i in range(50)]
+    data = frames_for(messages, (Protocol.FEATURE_COMPACT,))
+    decoder = FrameDecoder(buffer_size=64)
+    decoded = []
+    for i in range(0, len(data), 7):
+        decoder.feed(data[i:i + 7])
+        decoded.extend(Protocol.decode_frame(frame) for frame in decoder.frames())
+    assert decoded == messages
+
+def test_frame_decoder_grows_then_shrinks():
+    decoder = FrameDecoder(buffer_size=1024)
+    big = chat("x" * 100000)
+    decoder.feed(Protocol.pack_message(big))
+    assert [Protocol.decode_frame(frame) for frame in decoder.frames()] == [big]
+    assert len(decoder.buffer) > 1024
+    decoder.feed(Protocol.pack_message(chat("petit")))
+    assert len(decoder.buffer) == 1024
+
+def test_frame_decoder_refuses_oversized_frames():
+    decoder = FrameDecoder(max_frame_size=100)
+    decoder.feed(struct.pack("!I", 101) + b"{")
+    with pytest.raises(ValueError):
+        list(decoder.frames())
+
+def test_frame_decoder_socket():
+    messages = [chat(f"m{i}" * 1000) for i in range(20)]
+    left, right = socket.socketpair()
+    try:
+        # Depuis un thread: sendall bloquerait sur un tampon socket plein
+        sender = threading.Thread(target=lambda: (left.sendall(frames_for(messages)), left.close()))
+        sender.start()
+        assert list(FrameDecoder(buffer_size=256).messages(right)) == messages
+        sender.join()
+    finally:
+        right.close()
+
+def test_frame_decoder_stream_reader():
+    messages = [chat(f"m{i}" * 500) for i in range(20)]
+    
+    async def read_all():
+        reader = asyncio.StreamReader()
+        reader.feed_data(frames_for(messages))
+        reader.feed_eof()
+        return [message async for message in FrameDecoder(buffer_size=256).messages_async(reader)]
+    
+    assert asyncio.run(read_all()) == messages
\ No newline at end of file
@@ -0,0 +1,281 @@
+import hashlib
+import os
+from datetime import datetime
+
+import pytest
+
+from conftest import connect
+from models import Group, Message as ChatMessage
+from protocol import Protocol, Message, MessageType
+
+@pytest.fixture
+def group(server):
+    group = Group(name="Équipe", created_by="alice", group_id="group_1", members=["alice", "bob"])
+    server.db.create_group(group)
+    return group
+
+def request(server, sender, message_type, content, recipient=None):
+    server.handle_message(sender, Message(type=message_type, sender=sender, recipient=recipient, content=content))
+
+def history(server, sender, **content):
+    request(server, sender, MessageType.HISTORY_REQUEST, content)
+
+def history_done(collector):
+    done = collector.messages[-1]
+    assert done.type == MessageType.HISTORY_RESPONSE and done.content["done"]
+    return done.content
+
+def history_messages(collector):
+    return [
+        message["content"]
+        for response in collector.messages if response.type == MessageType.HISTORY_RESPONSE
+        for message in response.content["messages"]
+    ]
+
+def test_group_history_is_for_members(server, group):
+    alice = connect(server, "alice")
+    mallory = connect(server, "mallory")
+    request(server, "alice", MessageType.GROUP_MESSAGE, "secret", recipient=group.group_id)
+    
+    history(server, "mallory", target=group.group_id)
+    assert history_done(mallory)["error"] == "Accès refusé"
+    assert history_messages(mallory) == []
+    
+    history(server, "alice", target=group.group_id)
+    assert "error" not in history_done(alice)
+    assert history_messages(alice) == ["secret"]
+
+def test_group_prefix_does_not_make_a_group(server):
+    alice = connect(server, "alice")
+    connect(server, "group_x")
+    request(server, "group_x", MessageType.PRIVATE_MESSAGE, "coucou", recipient="alice")
+    history(server, "alice", target="group_x")
+    assert "error" not in history_done(alice)
+    assert history_messages(alice) == ["coucou"]
+
+def test_group_messages_from_non_members_are_dropped(server, group):
+    bob = connect(server, "bob")
+    connect(server, "mallory")
+    request(server, "mallory", MessageType.GROUP_MESSAGE, "spam", recipient=group.group_id)
+    request(server, "mallory", MessageType.GROUP_MESSAGE, "spam", recipient="group_inconnu")
+    assert bob.messages == []
+    assert server.db.get_conversation_history(group.group_id, group.group_id) == []
+    
+    request(server, "alice", MessageType.GROUP_MESSAGE, "salut", recipient=group.group_id)
+    assert [message.content for message in bob.messages] == ["salut"]
+
+def test_removed_member_loses_access(server, group):
+    bob = connect(server, "bob")
+    server.db.remove_group_member(group.group_id, "bob")
+    server.invalidate_group(group.group_id)
+    history(server, "bob", target=group.group_id)
+    assert history_done(bob)["error"] == "Accès refusé"
+
+@pytest.mark.parametrize("limit, expected", [(0, 1), (-5, 1), ("3", 3), (10 ** 9, 40)])
+def test_history_limit_is_clamped(server, monkeypatch, limit, expected):
+    monkeypatch.setattr(server, "MAX_HISTORY_PAGE", 40)
+    alice = connect(server, "alice")
+    for i in range(50):
+        server.db.save_message(ChatMessage(sender="alice", recipient="bob", content=str(i), message_type="text"))
+    history(server, "alice", target="bob", limit=limit)
+    assert len(history_messages(alice)) == expected
+
+@pytest.mark.parametrize("content", [
+    {"target": "bob", "limit": "beaucoup"},
+    {"target": None},
+    {"limit": 5},
+    {"target": "bob", "before": 5},
+    {"target": "bob", "before": {"id": "m1"}},
+    {"target": "bob", "after": ["2024-01-01T00:00:00"]},
+    {"target": "bob", "after": ["2024-01-01T00:00:00", "7"]},
+    {"target": "bob", "before": ["2024-01-01T00:00:00", True]}
+])
+def test_invalid_history_request(server, content):
+    alice = connect(server, "alice")
+    history(server, "alice", **content)
+    assert history_done(alice)["error"] == "Requête d'historique invalide"
+
+def test_history_pair_cursor(server):
+    alice = connect(server, "alice")
+    for i in range(3):
+        server.db.save_message(ChatMessage(sender="alice", recipient="bob", content=str(i), message_type="text",
+                                           timestamp=datetime(2024, 1, 1)))
+    with server.db.read() as cursor:
+        rowid = cursor.execute("SELECT rowid FROM messages WHERE content = '1'").fetchone()[0]
+    history(server, "alice", target="bob", before=["2024-01-01T00:00:00", rowid])
+    assert history_messages(alice) == ["0"]
+    assert "error" not in history_done(alice)
+
+def transfer_request(server, sender, recipient="bob", **content):
+    content = {"file_id": "f1", "filename": "a.txt", "filesize": 10, **content}
+    request(server, sender, MessageType.FILE_TRANSFER_REQUEST, content, recipient=recipient)
+
+@pytest.mark.parametrize("file_id", ["../../etc/x", "a/b", "a_b", "a.b", "", "x" * 65, 12, None])
+def test_invalid_file_id_is_rejected(server, file_id):
+    alice = connect(server, "alice")
+    transfer_request(server, "alice", file_id=file_id)
+    reject = alice.messages[-1]
+    assert reject.type == MessageType.FILE_TRANSFER_REJECT
+    assert reject.content["error"] == "Identifiant de transfert invalide"
+    assert os.listdir("storage") == []
+    assert len(server.transfers) == 0
+
+@pytest.mark.parametrize("content, error", [
+    ({"filename": ["a"]}, "Nom de fichier invalide"),
+    ({"filesize": -1}, "Taille de fichier invalide"),
+    ({"filesize": "10"}, "Taille de fichier invalide")
+])
+def test_invalid_transfer_request(server, content, error):
+    alice = connect(server, "alice")
+    transfer_request(server, "alice", **content)
+    assert alice.messages[-1].content["error"] == error
+
+def test_valid_transfer_is_spooled(server):
+    alice = connect(server, "alice")
+    transfer_request(server, "alice", filename="../../a.txt")
+    assert alice.messages[-1].type == MessageType.FILE_TRANSFER_RESUME
+    assert os.path.exists("storage/f1_a.txt.blocks")
+
+def chunk(server, sender, chunk_number, data, offset=None, total_chunks=1, file_id="f1"):
+    content = {"file_id": file_id, "chunk_number": chunk_number, "data": data.hex(), "total_chunks": total_chunks}
+    if offset is not None:
+        content["offset"] = offset
+    request(server, sender, MessageType.FILE_CHUNK, content)
+
+def offline_messages(server, username):
+    with server.db.read() as cursor:
+        return cursor.execute("SELECT COUNT(*) FROM offline_messages WHERE username = ?", (username,)).fetchone()[0]
+
+def test_offline_recipient_is_told_once_the_file_is_stored(server):
+    connect(server, "alice")
+    transfer_request(server, "alice", recipient="carol")
+    assert offline_messages(server, "carol") == 0
+    chunk(server, "alice", 0, b"0123456789", offset=0)
+    assert offline_messages(server, "carol") == 1
+    [message] = server.db.get_offline_messages("carol")
+    assert message.message_type == "file" and os.path.isfile(message.file_path)
+
+def test_relay_ends_at_the_announced_size(server):
+    alice = connect(server, "alice")
+    bob = connect(server, "bob")
+    transfer_request(server, "alice")
+    request(server, "bob", MessageType.FILE_TRANSFER_ACCEPT, {"file_id": "f1"})
+    # Le total annoncé par l'expéditeur n'est qu'une estimation
+    chunk(server, "alice", 0, b"01234", offset=0, total_chunks=1)
+    assert server.transfers.get("f1").total_chunks == 0
+    assert not any(m.type == MessageType.FILE_TRANSFER_COMPLETE for m in bob.messages)
+    chunk(server, "alice", 1, b"56789", offset=5, total_chunks=99)
+    chunks = [m.content for m in bob.messages if m.type == MessageType.FILE_CHUNK]
+    assert [c["total_chunks"] for c in chunks] == [2, 2]
+    assert b"".join(c["data"] for c in chunks) == b"0123456789"
+    assert bob.messages[-1].type == MessageType.FILE_TRANSFER_COMPLETE
+    assert server.db.get_offline_messages("bob") == []
+    
+    for number in range(2):
+        request(server, "bob", MessageType.FILE_CHUNK_ACK, {"file_id": "f1", "chunk_number": number})
+    assert server.transfers.get("f1") is None
+    assert [m.content["chunk_number"] for m in alice.messages if m.type == MessageType.FILE_CHUNK_ACK] == [0, 1]
+
+@pytest.mark.parametrize("chunk_number, offset", [(None, 0), ("0", 0), (1.5, 0), (-1, 0), (True, 0), (1, 0), (0, 3)])
+def test_invalid_relayed_chunk(server, chunk_number, offset):
+    alice = connect(server, "alice")
+    bob = connect(server, "bob")
+    transfer_request(server, "alice")
+    request(server, "bob", MessageType.FILE_TRANSFER_ACCEPT, {"file_id": "f1"})
+    chunk(server, "alice", chunk_number, b"01234", offset=offset)
+    for collector in (alice, bob):
+        assert collector.messages[-1].type == MessageType.FILE_TRANSFER_REJECT
+        assert collector.messages[-1].content["error"] == "Morceau invalide"
+    assert server.transfers.get("f1") is None
+
+def test_relayed_chunks_stop_at_the_announced_size(server):
+    connect(server, "alice")
+    bob = connect(server, "bob")
+    transfer_request(server, "alice")
+    request(server, "bob", MessageType.FILE_TRANSFER_ACCEPT, {"file_id": "f1"})
+    chunk(server, "alice", 0, b"0123456789ab", offset=0)
+    assert bob.messages[-1].content["error"] == "Morceau invalide"
+
+@pytest.fixture
+def shared_file(server):
+    # Fichier de 1000 octets envoyé par alice à bob
+    path = "storage/blob"
+    with open(path, "wb") as f:
+        f.write(bytes(range(250)) * 4)
+    server.db.save_message(ChatMessage(sender="alice", recipient="bob", content="f",
+                                       message_type="file", file_path=path))
+    return path
+
+def test_dedup_needs_access_to_the_stored_file(server):
+    data = b"0123456789"
+    alice = connect(server, "alice")
+    mallory = connect(server, "mallory")
+    transfer_request(server, "alice", recipient="carol")
+    chunk(server, "alice", 0, data, offset=0)
+    digest = hashlib.sha256(data).hexdigest()
+    
+    # Seule l'empreinte est connue: il faut envoyer le contenu
+    transfer_request(server, "mallory", file_id="f2", sha256=digest)
+    resume = mallory.messages[-1]
+    assert resume.type == MessageType.FILE_TRANSFER_RESUME and resume.content["missing"] == [[0, 10]]
+    assert server.transfers.get("f2") is not None
+    
+    transfer_request(server, "alice", recipient="bob", file_id="f3", sha256=digest)
+    assert alice.messages[-1].type == MessageType.FILE_TRANSFER_RESUME
+    assert alice.messages[-1].content["missing"] == []
+    assert server.transfers.get("f3") is None
+    assert server.db.can_access_file("bob", server.store.reference(digest))
+
+def download(server, sender, file_path, **content):
+    request(server, sender, MessageType.FILE_DOWNLOAD_REQUEST,
+            {"file_id": "d1", "file_path": file_path, **content})
+
+@pytest.mark.parametrize("offset, length", [
+    (-1, None), (1001, None), ("0", None), (0, -1), (0, "5"), (None, None), (True, None), (0, [5])
+])
+def test_invalid_download_range(server, shared_file, offset, length):
+    bob = connect(server, "bob")
+    download(server, "bob", shared_file, offset=offset, length=length)
+    assert bob.messages[-1].content["error"] == "Plage invalide"
+    assert bob.regions == []
+
+@pytest.mark.parametrize("offset, length, expected", [(0, None, 1000), (990, 50, 10), (1000, None, 0), (10, 0, 0)])
+def test_download_range(server, shared_file, offset, length, expected):
+    bob = connect(server, "bob")
+    download(server, "bob", shared_file, offset=offset, length=length)
+    response = bob.messages[-1].content
+    assert "error" not in response
+    assert (response["offset"], response["length"]) == (offset, expected)
+    assert bob.regions == [(offset, offset + expected)]
+
+def test_download_access_checks(server, shared_file):
+    mallory = connect(server, "mallory")
+    download(server, "mallory", shared_file)
+    assert mallory.messages[-1].content["error"] == "Accès refusé"
+    download(server, "mallory", "storage/../../etc/passwd")
+    assert mallory.messages[-1].content["error"] == "Fichier introuvable"
+
+@pytest.mark.parametrize("file_path", [None, 12, ["storage/blob"], {"path": "storage/blob"}])
+def test_download_path_must_be_a_string(server, shared_file, file_path):
+    bob = connect(server, "bob")
+    download(server, "bob", file_path)
+    assert bob.messages[-1].content["error"] == "Fichier introuvable"
+
+def test_download_needs_binary_chunks(server, shared_file):
+    bob = connect(server, "bob", features=[Protocol.FEATURE_COMPACT])
+    download(server, "bob", shared_file)
+    assert bob.messages[-1].content["error"] == "Le téléchargement demande les trames binaires"
+
+def test_stalled_upload_is_suspended_and_sender_told(server, monkeypatch):
+    alice = connect(server, "alice")
+    transfer_request(server, "alice", filesize=2 * 65536)
+    chunk(server, "alice", 0, b"x" * 65536, offset=0)
+    monkeypatch.setattr(server.transfers, "stall_timeout", -1)
+    
+    server.reap_stalled_transfers()
+    reject = alice.messages[-1]
+    assert reject.type == MessageType.FILE_TRANSFER_REJECT and reject.content["file_id"] == "f1"
+    assert len(server.transfers) == 0
+    # Le fichier partiel reste pour la reprise
+    transfer_request(server, "alice", filesize=2 * 65536)
+    assert alice.messages[-1].content["missing"] == [[65536, 2 * 65536]]
\ No newline at end of file
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import socket
+import time
+
+import pytest
+
+from conftest import connect
+from database import Database
+from models import Group
+from protocol import Protocol, Message, MessageType
+from sharded_server import ShardedServer
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT"), reason="SO_REUSEPORT absent")
+
+@pytest.fixture
+def workers(tmp_path, monkeypatch, db):
+    # Deux workers dans le même processus; pump() joue le rôle des sockets Unix
+    monkeypatch.chdir(tmp_path)
+    loop = asyncio.new_event_loop()
+    servers = [ShardedServer(i, 2, "127.0.0.1", 0, str(tmp_path / "sock"), database=db) for i in range(2)]
+    for server in servers:
+        server.loop = loop
+        server.peer_queues = {1 - server.worker_id: asyncio.Queue()}
+    yield servers
+    for server in servers:
+        server.server_socket.close()
+    loop.close()
+
+def envelopes(server, worker_id):
+    server.loop.run_until_complete(asyncio.sleep(0))
+    queue = server.peer_queues[worker_id]
+    result = []
+    while not queue.empty():
+        result.append(Protocol.decode_frame(queue.get_nowait()[Protocol.HEADER_SIZE:]))
+    return result
+
+def pump(servers):
+    # Remet les enveloppes en attente à leur destinataire, jusqu'à ce qu'il n'y en ait plus
+    delivered = True
+    while delivered:
+        delivered = False
+        for server in servers:
+            for worker_id in server.peer_queues:
+                for envelope in envelopes(server, worker_id):
+                    assert envelope.type == MessageType.WORKER_ROUTE
+                    servers[worker_id].handle_route(envelope.content["worker"], envelope.content)
+                    delivered = True
+
+def login(server, username):
+    collector = connect(server, username)
+    server.broadcast_user_status(username, "online")
+    return collector
+
+def request(server, sender, message_type, content, recipient=None):
+    server.handle_message(sender, Message(type=message_type, sender=sender, recipient=recipient, content=content))
+
+def test_cross_worker_delivery(workers):
+    first, second = workers
+    alice = login(first, "alice")
+    bob = login(second, "bob")
+    pump(workers)
+    assert first.remote_users == {"bob": 1} and second.remote_users == {"alice": 0}
+    assert [m.content["username"] for m in alice.messages if m.type == MessageType.USER_STATUS] == ["bob"]
+    
+    request(first, "alice", MessageType.PRIVATE_MESSAGE, "salut", recipient="bob")
+    pump(workers)
+    assert [m.content for m in bob.messages if m.type == MessageType.PRIVATE_MESSAGE] == ["salut"]
+
+def test_group_fan_out_sends_one_envelope_per_worker(workers, db):
+    first, second = workers
+    login(first, "alice")
+    bob, carol = login(second, "bob"), login(second, "carol")
+    pump(workers)
+    db.create_group(Group(name="G", created_by="alice", group_id="group_1", members=["alice", "bob", "carol"]))
+    
+    request(first, "alice", MessageType.GROUP_MESSAGE, "tous", recipient="group_1")
+    [envelope] = envelopes(first, 1)
+    assert envelope.content["kind"] == "deliver" and envelope.content["worker"] == 0
+    assert sorted(envelope.content["targets"]) == ["bob", "carol"]
+    
+    second.handle_route(0, envelope.content)
+    for collector in (bob, carol):
+        assert [m.content for m in collector.messages if m.type == MessageType.GROUP_MESSAGE] == ["tous"]
+
+def test_group_changes_invalidate_other_workers(workers, db):
+    first, second = workers
+    bob = login(second, "bob")
+    db.create_group(Group(name="G", created_by="alice", group_id="group_1", members=["alice", "bob"]))
+    assert "bob" in second.groups.get("group_1").members
+    
+    db.remove_group_member("group_1", "bob")
+    first.invalidate_group("group_1")
+    pump(workers)
+    request(second, "bob", MessageType.HISTORY_REQUEST, {"target": "group_1"})
+    assert bob.messages[-1].content["error"] == "Accès refusé"
+
+def test_duplicate_login_keeps_lowest_worker(workers):
+    first, second = workers
+    carol = login(second, "carol")
+    kept = login(first, "alice")
+    dropped = login(second, "alice")
+    pump(workers)
+    
+    assert "alice" in first.clients and "alice" not in second.clients
+    assert dropped.messages[-1].type == MessageType.ERROR
+    assert second.remote_users["alice"] == 0 and "alice" not in first.remote_users
+    assert kept.messages[-1].type != MessageType.ERROR
+    # Pour les autres clients, alice est toujours en ligne
+    statuses = [m.content["status"] for m in carol.messages
+                if m.type == MessageType.USER_STATUS and m.content["username"] == "alice"]
+    assert statuses[-1] == "online"
+    assert second.is_online("alice")
+
+def test_storage_in_use_sees_other_workers_spools(workers):
+    first, _ = workers
+    with open("storage/f1_a.txt.blocks", "wb"):
+        pass
+    assert first.storage_in_use("storage/f1_a.txt")
+    past = time.time() - first.transfers.stall_timeout - first.TRANSFER_REAP_INTERVAL - 1
+    os.utime("storage/f1_a.txt.blocks", (past, past))
+    assert not first.storage_in_use("storage/f1_a.txt")
+
+def test_stop_cancels_peer_channels(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = Database(str(tmp_path / "shared.db"))
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    servers = [ShardedServer(i, 2, "127.0.0.1", port, str(tmp_path / "sock"), database=db) for i in range(2)]
+    
+    async def run():
+        tasks = [asyncio.ensure_future(server.serve()) for server in servers]
+        # Les deux canaux sont établis quand chacun a reçu la liste de l'autre
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            if all(server.connection_tasks for server in servers):
+                break
+        servers[0].stop()
+        await asyncio.wait_for(tasks[0], 5)
+        assert all(task.done() for task in servers[0].peer_tasks)
+        assert not servers[0].connection_tasks
+        servers[1].stop()
+        await asyncio.wait_for(tasks[1], 5)
+    
+    try:
+        asyncio.run(run())
+    finally:
+        db.close()
\ No newline at end of file
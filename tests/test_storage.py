@@ -0,0 +1,164 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+from models import Message
+from storage import PartialFile, ContentStore, StorageJanitor
+
+BLOCK = PartialFile.BLOCK_SIZE
+
+@pytest.fixture
+def store(db, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return ContentStore(db, "storage/blobs")
+
+def spool(data: bytes, name: str) -> PartialFile:
+    partial = PartialFile(f"storage/{name}", len(data))
+    partial.write(0, data)
+    partial.finish()
+    return partial
+
+def refer(db, path: str):
+    message = Message(sender="alice", recipient="bob", content="f", message_type="file", file_path=path)
+    db.save_message(message)
+
+def age(path: str, seconds: float):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+def test_partial_file_resumes_from_bitmap(tmp_path):
+    path = str(tmp_path / "f")
+    data = os.urandom(5 * BLOCK + 100)
+    partial = PartialFile(path, len(data))
+    assert not partial.resumed
+    partial.write(0, data[:BLOCK])
+    partial.write(3 * BLOCK, data[3 * BLOCK:4 * BLOCK + 10])
+    partial.close()
+    
+    partial = PartialFile(path, len(data))
+    assert partial.resumed
+    assert partial.received == 2
+    assert partial.missing() == [[BLOCK, 3 * BLOCK], [4 * BLOCK, len(data)]]
+    for start, end in partial.missing():
+        partial.write(start, data[start:end])
+    assert partial.complete
+    digest = partial.digest()
+    partial.finish()
+    assert not os.path.exists(path + ".blocks")
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert digest == hashlib.sha256(data).hexdigest()
+
+def test_partial_file_restarts_on_size_change(tmp_path):
+    path = str(tmp_path / "f")
+    partial = PartialFile(path, 3 * BLOCK)
+    partial.write(0, b"a" * BLOCK)
+    partial.close()
+    partial = PartialFile(path, 4 * BLOCK)
+    assert not partial.resumed
+    assert partial.missing() == [[0, 4 * BLOCK]]
+    partial.discard()
+
+def test_partial_file_refuses_bad_writes(tmp_path):
+    partial = PartialFile(str(tmp_path / "f"), BLOCK)
+    with pytest.raises(ValueError):
+        partial.write(BLOCK - 1, b"xx")
+    partial.close()
+    with pytest.raises(ValueError):
+        partial.write(0, b"x")
+    partial.discard()
+
+def test_content_store_dedups(store, db):
+    first = store.store(spool(b"x" * 10000, "a"))
+    second = store.store(spool(b"x" * 10000, "b"))
+    other = store.store(spool(b"y" * 10, "c"))
+    assert first == second != other
+    assert not os.path.exists("storage/a") and not os.path.exists("storage/b")
+    assert store.reference(os.path.basename(first)) == first
+    with db.read() as cursor:
+        assert cursor.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 2
+
+def test_content_store_forgets_missing_blob(store):
+    path = store.store(spool(b"z" * 100, "a"))
+    os.remove(path)
+    assert store.reference(os.path.basename(path)) is None
+    assert store.store(spool(b"z" * 100, "b")) == path
+    assert os.path.exists(path)
+
+def test_release_keeps_referenced_and_recent_blobs(store, db):
+    path = store.store(spool(b"r" * 100, "a"))
+    assert not store.release(path, time.time() - 3600)
+    refer(db, path)
+    assert not store.release(path, time.time() + 1)
+    assert os.path.exists(path)
+    
+    orphan = store.store(spool(b"o" * 100, "b"))
+    assert store.release(orphan, time.time() + 1)
+    assert not os.path.exists(orphan)
+
+def sweep(store, in_use=lambda path: False, **options):
+    janitor = StorageJanitor(root="storage", pause=0, min_free=0, **options)
+    return janitor.sweep(store, in_use)
+
+def test_janitor_removes_abandoned_partials(store):
+    partial = PartialFile("storage/old_f", 2 * BLOCK)
+    partial.write(0, b"a" * BLOCK)
+    partial.close()
+    recent = PartialFile("storage/new_f", 2 * BLOCK)
+    recent.close()
+    age("storage/old_f.blocks", 7200)
+    
+    usage = sweep(store, partial_ttl=3600)
+    assert usage["deleted"] == 2
+    assert not os.path.exists("storage/old_f") and not os.path.exists("storage/old_f.blocks")
+    assert os.path.exists("storage/new_f.blocks")
+    assert usage["partial_bytes"] > 0
+
+def test_janitor_spares_partials_in_use(store):
+    PartialFile("storage/busy_f", BLOCK).close()
+    age("storage/busy_f.blocks", 7200)
+    sweep(store, in_use=lambda path: path == "storage/busy_f", partial_ttl=3600)
+    assert os.path.exists("storage/busy_f.blocks")
+
+def test_janitor_orphan_tier(store, db):
+    kept = store.store(spool(b"k" * 100, "a"))
+    refer(db, kept)
+    orphan = store.store(spool(b"o" * 100, "b"))
+    fresh = store.store(spool(b"f" * 100, "c"))
+    with db.write() as cursor:
+        cursor.execute("UPDATE files SET last_used = '2000-01-01T00:00:00' WHERE path != ?", (fresh,))
+    for path in (kept, orphan, fresh):
+        age(path, 7200)
+    
+    usage = sweep(store, orphan_grace=3600)
+    assert usage["deleted"] == 1
+    assert os.path.exists(kept) and not os.path.exists(orphan)
+    # Utilisé il y a peu (envoi dédupliqué): son message n'est peut-être pas encore enregistré
+    assert os.path.exists(fresh)
+
+def test_janitor_expiry_tier(store, db):
+    old = store.store(spool(b"o" * 100, "a"))
+    used = store.store(spool(b"u" * 100, "b"))
+    for path in (old, used):
+        refer(db, path)
+        age(path, 10 * 86400)
+    with db.write() as cursor:
+        cursor.execute("UPDATE files SET last_used = '2000-01-01T00:00:00' WHERE path = ?", (old,))
+    db.record_download(used, 100)
+    
+    usage = sweep(store, max_age=86400)
+    assert not os.path.exists(old) and os.path.exists(used)
+    assert usage["files"] == 1
+
+def test_janitor_space_tier_evicts_least_recently_used(store, db):
+    paths = [store.store(spool(bytes([i]) * 1000, f"f{i}")) for i in range(4)]
+    for i, path in enumerate(paths):
+        refer(db, path)
+        with db.write() as cursor:
+            cursor.execute("UPDATE files SET last_used = ? WHERE path = ?", (f"2024-01-0{i + 1}T00:00:00", path))
+    
+    usage = sweep(store, max_bytes=2500, max_age=10 ** 10)
+    assert [os.path.exists(path) for path in paths] == [False, False, True, True]
+    assert usage["bytes"] == 2000 and usage["deleted"] == 2
\ No newline at end of file
@@ -0,0 +1,321 @@
+import socket
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+from protocol import Protocol, Message, MessageType, FileTransfer
+
+class FlowControl:
+    # Taille des morceaux et fenêtre d'un envoi, ajustées d'après les accusés
+    # de réception. Un morceau occupe le lien environ CHUNK_TIME au débit
+    # mesuré: gros morceaux sur un réseau rapide (moins de trames), petits
+    # sur le Wi-Fi (un message de discussion n'attend pas longtemps derrière).
+    # La fenêtre couvre deux fois le produit débit × RTT minimal, ce qui la
+    # laisse grandir tant que le débit suit.
+    CHUNK_TIME = 0.005
+    # Les mesures de débit portent sur au moins cet intervalle
+    SAMPLE_TIME = 0.02
+    # Taille des blocs suivis par le serveur (PartialFile): les morceaux en
+    # restent des multiples pour que chaque écriture couvre des blocs entiers
+    BLOCK_SIZE = 8192
+    
+    def __init__(self, chunk_size=65536, window=16, min_chunk=8192, max_chunk=1024 * 1024,
+                 min_window=4, max_window=32):
+        self.min_chunk = max(self.BLOCK_SIZE, min_chunk // self.BLOCK_SIZE * self.BLOCK_SIZE)
+        self.max_chunk = max(self.min_chunk, max_chunk // self.BLOCK_SIZE * self.BLOCK_SIZE)
+        self.min_window = min_window
+        self.max_window = max(min_window, max_window)
+        self.chunk_size = min(max(chunk_size, self.min_chunk), self.max_chunk)
+        self.window = min(max(window, self.min_window), self.max_window)
+        # (numéro, heure d'envoi, taille de trame) des morceaux non acquittés
+        self.in_flight = deque()
+        self.srtt: Optional[float] = None
+        self.min_rtt: Optional[float] = None
+        # Octets par seconde
+        self.rate: Optional[float] = None
+        self.sample_start: Optional[float] = None
+        self.sample_bytes = 0
+    
+    def on_send(self, chunk_number: int, size: int):
+        now = time.monotonic()
+        if self.sample_start is None:
+            self.sample_start = now
+        self.in_flight.append((chunk_number, now, size))
+    
+    def on_ack(self, chunk_number: int):
+        # Les accusés de réception sont cumulatifs
+        now = time.monotonic()
+        sent_at = None
+        while self.in_flight and self.in_flight[0][0] <= chunk_number:
+            _, sent_at, size = self.in_flight.popleft()
+            self.sample_bytes += size
+        if sent_at is None:
+            return
+        
+        rtt = now - sent_at
+        self.srtt = rtt if self.srtt is None else self.srtt * 0.875 + rtt * 0.125
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        
+        elapsed = now - self.sample_start
+        if elapsed < max(self.SAMPLE_TIME, self.srtt):
+            return
+        rate = self.sample_bytes / elapsed
+        self.rate = rate if self.rate is None else self.rate * 0.75 + rate * 0.25
+        self.sample_start = now
+        self.sample_bytes = 0
+        self.adjust()
+    
+    def adjust(self):
+        chunk_size = int(self.rate * self.CHUNK_TIME) // self.BLOCK_SIZE * self.BLOCK_SIZE
+        self.chunk_size = min(max(chunk_size, self.min_chunk), self.max_chunk)
+        in_flight = 2 * self.rate * self.min_rtt
+        window = -(-int(in_flight) // self.chunk_size)
+        self.window = min(max(window, self.min_window), self.max_window)
+
+class Upload:
+    # Envoi d'un fichier par morceaux, plage après plage (plages manquantes
+    # annoncées par FILE_TRANSFER_RESUME)
+    def __init__(self, transfer: FileTransfer, ranges: List[List[int]], chunk_size: int,
+                 binary: bool, window: Optional[int], features=(),
+                 flow: Optional[FlowControl] = None):
+        self.transfer = transfer
+        self.ranges = deque((start, end) for start, end in ranges if end > start)
+        self.chunk_size = chunk_size
+        self.binary = binary
+        # Morceaux envoyés sans accusé de réception; None: pas d'accusés
+        self.window = window
+        self.features = features
+        # Remplace chunk_size et window quand les accusés de réception le permettent
+        self.flow = flow if window is not None else None
+        self.chunk_number = 0
+        self.remaining = sum(end - start for start, end in self.ranges)
+        self.total_chunks = self.estimate_total(0)
+        transfer.total_chunks = self.total_chunks
+        transfer.bytes_sent = transfer.filesize - self.remaining
+        self.file = open(transfer.filepath, 'rb')
+    
+    def estimate_total(self, sent: int) -> int:
+        # Avec des morceaux de taille variable, le total annoncé est une
+        # estimation, exacte au dernier morceau et jamais inférieure au
+        # nombre de morceaux déjà envoyés
+        chunk_size = self.flow.chunk_size if self.flow else self.chunk_size
+        return sent + -(-self.remaining // chunk_size)
+    
+    @property
+    def sent_all(self) -> bool:
+        return not self.ranges
+    
+    @property
+    def complete(self) -> bool:
+        if not self.sent_all:
+            return False
+        return self.window is None or self.transfer.chunks_acked >= self.total_chunks
+    
+    def can_send(self) -> bool:
+        if self.sent_all:
+            return False
+        window = self.flow.window if self.flow else self.window
+        return window is None or self.chunk_number - self.transfer.chunks_acked < window
+    
+    def next_frame(self) -> bytes:
+        start, end = self.ranges[0]
+        chunk_size = self.flow.chunk_size if self.flow else self.chunk_size
+        count = min(chunk_size, end - start)
+        self.file.seek(start)
+        chunk = self.file.read(count)
+        if len(chunk) != count:
+            raise OSError(f"{self.transfer.filepath} a changé pendant l'envoi")
+        
+        if start + count < end:
+            self.ranges[0] = (start + count, end)
+        else:
+            self.ranges.popleft()
+        self.remaining -= count
+        self.total_chunks = self.estimate_total(self.chunk_number + 1)
+        self.transfer.total_chunks = self.total_chunks
+        
+        frame = self.pack_chunk(chunk, start)
+        self.chunk_number += 1
+        self.transfer.bytes_sent += count
+        return frame
+    
+    def pack_chunk(self, chunk: bytes, offset: int) -> bytes:
+        if self.binary:
+            return Protocol.pack_file_chunk(
+                self.transfer.file_id, self.chunk_number, self.total_chunks, chunk, offset
+            )
+        else:
+            chunk_msg = Message(
+                type=MessageType.FILE_CHUNK,
+                sender=self.transfer.sender,
+                recipient=self.transfer.recipient,
+                content={
+                    "file_id": self.transfer.file_id,
+                    "chunk_number": self.chunk_number,
+                    "offset": offset,
+                    "data": chunk.hex(),
+                    "total_chunks": self.total_chunks
+                }
+            )
+            return Protocol.pack_message(chunk_msg, self.features)
+    
+    def close(self):
+        self.file.close()
+
+class StreamUpload(Upload):
+    # Envoi d'un flux dont la taille n'est connue qu'à la fin (dossier archivé
+    # au fil de l'eau, voir archive.DirectoryArchive), sans reprise. Le total
+    # de morceaux annoncé dépasse d'un le nombre de morceaux envoyés, jusqu'au
+    # dernier où il devient exact.
+    def __init__(self, transfer: FileTransfer, stream, chunk_size: int, binary: bool,
+                 window: Optional[int], features=(), flow: Optional[FlowControl] = None):
+        self.transfer = transfer
+        # read(taille) -> bloc suivant, vide à la fin; raw_bytes; close()
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.binary = binary
+        self.window = window
+        self.features = features
+        self.flow = flow if window is not None else None
+        self.chunk_number = 0
+        self.total_chunks = 1
+        self.position = 0
+        self.finished = False
+        # Bloc lu d'avance: c'est lui qui dit si le morceau en cours est le dernier
+        self.next_block: Optional[bytes] = None
+        transfer.total_chunks = self.total_chunks
+        transfer.bytes_sent = 0
+    
+    @property
+    def sent_all(self) -> bool:
+        return self.finished
+    
+    def next_frame(self) -> bytes:
+        chunk_size = self.flow.chunk_size if self.flow else self.chunk_size
+        block = self.next_block if self.next_block is not None else self.stream.read(chunk_size)
+        if not block:
+            raise ValueError(f"Flux vide pour {self.transfer.filename}")
+        self.next_block = self.stream.read(chunk_size)
+        self.finished = not self.next_block
+        self.total_chunks = self.chunk_number + (1 if self.finished else 2)
+        self.transfer.total_chunks = self.total_chunks
+        
+        frame = self.pack_chunk(block, self.position)
+        self.position += len(block)
+        self.chunk_number += 1
+        self.transfer.bytes_sent = min(self.stream.raw_bytes, self.transfer.filesize)
+        return frame
+    
+    def close(self):
+        self.stream.close()
+
+class TransferEngine:
+    # Seul écrivain du socket du client. Les trames de discussion (et les
+    # accusés de réception) passent toujours avant les morceaux de fichier;
+    # les envois de fichiers se partagent le reste, un morceau chacun à tour
+    # de rôle, dans la limite de leur fenêtre.
+    def __init__(self, client_socket: socket.socket,
+                 on_complete: Optional[Callable[[FileTransfer], None]] = None,
+                 on_failed: Optional[Callable[[FileTransfer, Exception], None]] = None):
+        self.socket = client_socket
+        self.on_complete = on_complete
+        self.on_failed = on_failed
+        self.cond = threading.Condition()
+        self.control = deque()
+        self.uploads: Dict[str, Upload] = {}
+        self.running = True
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+    
+    def send(self, frame: bytes):
+        with self.cond:
+            if not self.running:
+                raise OSError("Connexion fermée")
+            self.control.append(frame)
+            self.cond.notify()
+    
+    def add_upload(self, upload: Upload):
+        with self.cond:
+            self.uploads[upload.transfer.file_id] = upload
+            self.cond.notify()
+        # Rien à envoyer: le serveur avait déjà tout
+        self.check_complete(upload)
+    
+    def ack(self, file_id: str, chunk_number: int):
+        with self.cond:
+            upload = self.uploads.get(file_id)
+            if upload is None:
+                return
+            transfer = upload.transfer
+            transfer.chunks_acked = max(transfer.chunks_acked, chunk_number + 1)
+            if upload.flow:
+                upload.flow.on_ack(chunk_number)
+            self.cond.notify()
+        self.check_complete(upload)
+    
+    def cancel(self, file_id: str) -> bool:
+        with self.cond:
+            upload = self.uploads.pop(file_id, None)
+        if upload is None:
+            return False
+        upload.close()
+        return True
+    
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+    
+    def check_complete(self, upload: Upload):
+        with self.cond:
+            if not upload.complete or self.uploads.get(upload.transfer.file_id) is not upload:
+                return
+            del self.uploads[upload.transfer.file_id]
+        upload.close()
+        if self.on_complete:
+            self.on_complete(upload.transfer)
+    
+    def next_work(self):
+        # (trame de discussion, None) ou (None, envoi de fichier prêt)
+        if self.control:
+            return self.control.popleft(), None
+        for file_id, upload in self.uploads.items():
+            if upload.can_send():
+                # Le suivant passera avant lui au prochain tour
+                del self.uploads[file_id]
+                self.uploads[file_id] = upload
+                return None, upload
+        return None, None
+    
+    def writer(self):
+        try:
+            while True:
+                with self.cond:
+                    frame, upload = self.next_work()
+                    while frame is None and upload is None and self.running:
+                        self.cond.wait()
+                        frame, upload = self.next_work()
+                    if not self.running:
+                        return
+                
+                # Lecture du fichier hors du verrou: send() et ack() ne l'attendent pas
+                if upload is not None:
+                    try:
+                        frame = upload.next_frame()
+                    except (OSError, ValueError) as e:
+                        # Rien à signaler si l'envoi a été annulé pendant la lecture
+                        if self.cancel(upload.transfer.file_id) and self.on_failed:
+                            self.on_failed(upload.transfer, e)
+                        continue
+                    if upload.flow:
+                        with self.cond:
+                            upload.flow.on_send(upload.chunk_number - 1, len(frame))
+                
+                self.socket.sendall(frame)
+                if upload is not None and upload.window is None:
+                    self.check_complete(upload)
+        except OSError:
+            # Le thread de réception constate la déconnexion
+            with self.cond:
+                self.running = False
\ No newline at end of file
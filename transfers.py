@@ -0,0 +1,180 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Dict, List, Optional
+
+from protocol import FileTransfer
+
+class TransferState(Enum):
+    # Relais en attente de l'acceptation du destinataire
+    PENDING = "pending"
+    RELAYING = "relaying"
+    # Tous les morceaux relayés, derniers accusés de réception attendus
+    DRAINING = "draining"
+    # Destinataire absent: le fichier est écrit dans storage/
+    SPOOLING = "spooling"
+
+@dataclass
+class TransferRecord:
+    transfer: FileTransfer
+    state: TransferState
+    started: float = field(default_factory=time.monotonic)
+    last_activity: float = field(default_factory=time.monotonic)
+    # Octets relayés ou écrits
+    bytes: int = 0
+    # Octets par seconde, moyenne glissante sur des intervalles d'au moins
+    # TransferManager.RATE_INTERVAL
+    rate: float = 0.0
+    sample_start: float = field(default_factory=time.monotonic)
+    sample_bytes: int = 0
+    # Morceaux gardés en mémoire en attendant l'acceptation
+    memory: int = 0
+    
+    @property
+    def disk_bytes(self) -> int:
+        # Le fichier est préalloué en entier dès le début du stockage
+        return self.transfer.filesize if self.transfer.partial is not None else 0
+    
+    def to_dict(self, now: float) -> dict:
+        return {
+            "file_id": self.transfer.file_id,
+            "sender": self.transfer.sender,
+            "recipient": self.transfer.recipient,
+            "filename": self.transfer.filename,
+            "state": self.state.value,
+            "filesize": self.transfer.filesize,
+            "bytes": self.bytes,
+            "disk_bytes": self.disk_bytes,
+            "memory": self.memory,
+            # Plus rien reçu depuis deux intervalles: débit nul
+            "rate": self.rate if now - self.last_activity < 2 * TransferManager.RATE_INTERVAL else 0.0,
+            "idle": now - self.last_activity,
+            "age": now - self.started
+        }
+
+class TransferManager:
+    # Transferts de fichiers en cours sur le serveur: état, dernière
+    # activité, octets sur disque et en mémoire, débit. Les nouveaux
+    # transferts sont refusés au-delà des quotas (par expéditeur et pour tout
+    # le serveur) et ceux restés inactifs plus de stall_timeout secondes sont
+    # désignés par stalled() pour être abandonnés.
+    RATE_INTERVAL = 1.0
+    
+    def __init__(self, max_user_transfers=8, max_transfers=256, max_user_bytes=8 << 30,
+                 max_bytes=64 << 30, max_memory=256 << 20, stall_timeout=300):
+        self.max_user_transfers = max_user_transfers
+        self.max_transfers = max_transfers
+        # Tailles annoncées des transferts en cours
+        self.max_user_bytes = max_user_bytes
+        self.max_bytes = max_bytes
+        # Morceaux en attente d'acceptation, tous transferts confondus
+        self.max_memory = max_memory
+        self.stall_timeout = stall_timeout
+        self.records: Dict[str, TransferRecord] = {}
+        self.lock = threading.Lock()
+        self.memory = 0
+    
+    def get(self, file_id: Optional[str]) -> Optional[FileTransfer]:
+        with self.lock:
+            record = self.records.get(file_id)
+        return record.transfer if record else None
+    
+    def add(self, transfer: FileTransfer, state: TransferState) -> Optional[str]:
+        # Message d'erreur si un quota est dépassé, sinon None
+        with self.lock:
+            if len(self.records) >= self.max_transfers:
+                return "Trop de transferts en cours sur le serveur"
+            if sum(record.transfer.filesize for record in self.records.values()) + transfer.filesize > self.max_bytes:
+                return "Espace insuffisant sur le serveur"
+            
+            own = [record for record in self.records.values() if record.transfer.sender == transfer.sender]
+            if len(own) >= self.max_user_transfers:
+                return f"Pas plus de {self.max_user_transfers} transferts à la fois"
+            if sum(record.transfer.filesize for record in own) + transfer.filesize > self.max_user_bytes:
+                return "Quota de transfert dépassé"
+            
+            self.records[transfer.file_id] = TransferRecord(transfer, state)
+        return None
+    
+    def remove(self, file_id: str) -> Optional[FileTransfer]:
+        # None si le transfert était déjà terminé ou annulé
+        with self.lock:
+            record = self.records.pop(file_id, None)
+            if record is None:
+                return None
+            self.memory -= record.memory
+        return record.transfer
+    
+    def set_state(self, transfer: FileTransfer, state: TransferState):
+        with self.lock:
+            record = self.records.get(transfer.file_id)
+            if record is not None:
+                record.state = state
+    
+    def activity(self, transfer: FileTransfer, count=0):
+        now = time.monotonic()
+        with self.lock:
+            record = self.records.get(transfer.file_id)
+            if record is None:
+                return
+            record.last_activity = now
+            record.bytes += count
+            record.sample_bytes += count
+            elapsed = now - record.sample_start
+            if elapsed >= self.RATE_INTERVAL:
+                rate = record.sample_bytes / elapsed
+                record.rate = rate if not record.rate else record.rate * 0.5 + rate * 0.5
+                record.sample_start = now
+                record.sample_bytes = 0
+    
+    def buffer(self, transfer: FileTransfer, size: int) -> bool:
+        # Réserve size octets de mémoire pour un morceau mis de côté; False
+        # si la limite du serveur est atteinte
+        with self.lock:
+            record = self.records.get(transfer.file_id)
+            if record is None or self.memory + size > self.max_memory:
+                return False
+            record.memory += size
+            self.memory += size
+        return True
+    
+    def release(self, transfer: FileTransfer):
+        # Morceaux mis de côté relayés: leur mémoire est rendue
+        with self.lock:
+            record = self.records.get(transfer.file_id)
+            if record is not None:
+                self.memory -= record.memory
+                record.memory = 0
+    
+    def involving(self, username: str) -> List[FileTransfer]:
+        with self.lock:
+            return [
+                record.transfer for record in self.records.values()
+                if username in (record.transfer.sender, record.transfer.recipient)
+            ]
+    
+    def stalled(self) -> List[FileTransfer]:
+        limit = time.monotonic() - self.stall_timeout
+        with self.lock:
+            return [record.transfer for record in self.records.values() if record.last_activity < limit]
+    
+    def __len__(self) -> int:
+        return len(self.records)
+    
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            transfers = [record.to_dict(now) for record in self.records.values()]
+            memory = self.memory
+        states = {}
+        for transfer in transfers:
+            states[transfer["state"]] = states.get(transfer["state"], 0) + 1
+        return {
+            "count": len(transfers),
+            "states": states,
+            "disk_bytes": sum(transfer["disk_bytes"] for transfer in transfers),
+            "memory": memory,
+            "rate": sum(transfer["rate"] for transfer in transfers),
+            "transfers": transfers
+        }
\ No newline at end of file